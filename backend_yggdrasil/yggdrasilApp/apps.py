@@ -1,8 +1,26 @@
 from django.apps import AppConfig
+import multiprocessing
 import os
+import sys
 import threading
 
 
+def es_proceso_servidor():
+    """True en los procesos que atienden peticiones (Daphne, runserver).
+
+    Los comandos de manage.py y los procesos hijos que crean (por ejemplo los
+    de rellenar_meses) cargan las apps igual, pero no deben arrancar hilos
+    de mantenimiento.
+    """
+    if multiprocessing.parent_process() is not None:
+        return False
+    if os.path.basename(sys.argv[0]) == 'manage.py':
+        comando = sys.argv[1] if len(sys.argv) > 1 else None
+        # Con el autoreload sólo el proceso hijo (RUN_MAIN) sirve peticiones
+        return comando == 'runserver' and os.environ.get('RUN_MAIN') == 'true'
+    return True
+
+
 class YggdrasilConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'yggdrasilApp'
@@ -10,7 +28,14 @@ class YggdrasilConfig(AppConfig):
     _thread_started = False
 
     def ready(self):
+        from .modulos.cache_referencia import conectar_senales
+        conectar_senales()
+
         if not YggdrasilConfig._thread_started:
             YggdrasilConfig._thread_started = True
             from .thread import iniciar_flujo_actualizacion
-            iniciar_flujo_actualizacion()
\ No newline at end of file
+            iniciar_flujo_actualizacion()
+            from django.conf import settings
+            if getattr(settings, 'CALENTAMIENTO_ACTIVO', True) and es_proceso_servidor():
+                from .modulos.calentamiento_dashboard import calentador_dashboard
+                calentador_dashboard.iniciar()
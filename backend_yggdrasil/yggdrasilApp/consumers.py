@@ -1,4 +1,5 @@
 import json
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
 
@@ -68,3 +69,36 @@ class BoxesConsumer(AsyncWebsocketConsumer):
             'box_id': event.get('box_id'),
             'evento': event.get('evento')
         }))
+
+
+class MimirConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
+        from .modulos.trabajos_mimir import COMPLETADO, ERROR, cola_mimir, grupo_trabajo
+
+        # Unirse al grupo del trabajo (ws/mimir/<trabajo_id>/)
+        trabajo_id = self.scope['url_route']['kwargs']['trabajo_id']
+        self.grupo = grupo_trabajo(trabajo_id)
+        await self.channel_layer.group_add(self.grupo, self.channel_name)
+        await self.accept()
+
+        # Si el trabajo terminó antes de suscribirse, el resultado ya no se publicará
+        trabajo = await sync_to_async(cola_mimir.obtener)(trabajo_id)
+        if trabajo and trabajo['estado'] in (COMPLETADO, ERROR):
+            await self.mimir_resultado({'trabajo': trabajo})
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(self.grupo, self.channel_name)
+
+    # Handler para el avance de un trabajo (sin resultado)
+    async def mimir_progreso(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'mimir_progreso',
+            'trabajo': event.get('trabajo')
+        }))
+
+    # Handler para el estado final de un trabajo (completado o error)
+    async def mimir_resultado(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'mimir_resultado',
+            'trabajo': event.get('trabajo')
+        }))
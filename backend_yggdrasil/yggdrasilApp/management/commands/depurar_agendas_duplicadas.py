@@ -0,0 +1,68 @@
+"""
+Comando para revisar (y opcionalmente eliminar) agendas con la clave natural repetida
+Requisito para aplicar la migración 0004, que crea el índice único
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Min
+from yggdrasilApp.models import Agendabox
+
+CLAVE = ('idmedico', 'idbox', 'fechaagenda', 'horainicioagenda', 'horafinagenda')
+
+
+def grupos_duplicados():
+    """Claves (dict) repetidas en agendabox, con la cantidad y el menor id de cada una"""
+    return list(
+        Agendabox.objects.values(*CLAVE)
+        .annotate(cantidad=Count('id'), conservar=Min('id'))
+        .filter(cantidad__gt=1)
+        .order_by('fechaagenda', 'idbox')
+    )
+
+
+def sobrantes(grupo):
+    """Agendas del grupo salvo la de menor id; los NULL se comparan como iguales"""
+    filtro = {}
+    for campo in CLAVE:
+        if grupo[campo] is None:
+            filtro[f'{campo}__isnull'] = True
+        else:
+            filtro[campo] = grupo[campo]
+    return Agendabox.objects.filter(**filtro).exclude(id=grupo['conservar'])
+
+
+class Command(BaseCommand):
+    help = 'Lista las agendas con (médico, box, fecha, inicio, fin) repetidos; con --eliminar deja la de menor id'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--eliminar',
+            action='store_true',
+            help='Eliminar las agendas repetidas (por defecto sólo se listan)'
+        )
+
+    def handle(self, *args, **options):
+        grupos = grupos_duplicados()
+        if not grupos:
+            self.stdout.write(self.style.SUCCESS('✅ No hay agendas duplicadas'))
+            return
+
+        for grupo in grupos:
+            ids = list(sobrantes(grupo).values_list('id', flat=True))
+            self.stdout.write(
+                f"  box {grupo['idbox']} médico {grupo['idmedico']} {grupo['fechaagenda']} "
+                f"{grupo['horainicioagenda']}-{grupo['horafinagenda']}: "
+                f"se conserva {grupo['conservar']}, repetidas {ids}"
+            )
+
+        if not options['eliminar']:
+            self.stdout.write(self.style.WARNING(
+                f'⚠️ {len(grupos)} claves repetidas. Ejecute con --eliminar para borrarlas'
+            ))
+            return
+
+        eliminadas = 0
+        with transaction.atomic():
+            for grupo in grupos:
+                eliminadas += sobrantes(grupo).delete()[0]
+        self.stdout.write(self.style.SUCCESS(f'✅ {eliminadas} agendas duplicadas eliminadas'))
@@ -0,0 +1,61 @@
+"""
+Comando para generar (o rellenar hacia atrás) las estadísticas mensuales por box
+"""
+from django.core.management.base import BaseCommand, CommandError
+from yggdrasilApp.modulos.estadisticas_mensuales import (
+    mes_anterior, rango_meses, rellenar_meses, unificar_estadisticas
+)
+
+
+def _parsear_mes(valor):
+    try:
+        anio, mes = (int(parte) for parte in valor.split('-'))
+    except ValueError:
+        raise CommandError(f"Mes inválido '{valor}', use el formato AAAA-MM")
+    if not 1 <= mes <= 12:
+        raise CommandError(f"Mes inválido '{valor}', use el formato AAAA-MM")
+    return anio, mes
+
+
+class Command(BaseCommand):
+    help = 'Genera EstadisticasBox para un rango de meses (por defecto el mes anterior)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--desde',
+            help='Primer mes a generar (AAAA-MM). Por defecto el mes anterior'
+        )
+        parser.add_argument(
+            '--hasta',
+            help='Último mes a generar (AAAA-MM). Por defecto igual a --desde'
+        )
+        parser.add_argument(
+            '--procesos',
+            type=int,
+            default=1,
+            help='Procesos en paralelo (un mes por proceso)'
+        )
+        parser.add_argument(
+            '--sobrescribir',
+            action='store_true',
+            help='Recalcular también los meses que ya tienen estadísticas'
+        )
+
+    def handle(self, *args, **options):
+        desde = _parsear_mes(options['desde']) if options['desde'] else mes_anterior()
+        hasta = _parsear_mes(options['hasta']) if options['hasta'] else desde
+        meses = rango_meses(desde, hasta)
+        if not meses:
+            raise CommandError('--hasta debe ser igual o posterior a --desde')
+
+        eliminados = unificar_estadisticas()
+        if eliminados:
+            self.stdout.write(self.style.WARNING(f'⚠️ {eliminados} estadísticas duplicadas eliminadas'))
+
+        self.stdout.write(f'📊 Generando estadísticas de {len(meses)} meses con {options["procesos"]} procesos...')
+        total = 0
+        for anio, mes, escritos in rellenar_meses(meses, options['sobrescribir'], options['procesos']):
+            total += escritos
+            self.stdout.write(f'  {anio:04d}-{mes:02d}: {escritos} boxes')
+
+        self.stdout.write(self.style.SUCCESS(f'✅ Estadísticas mensuales generadas ({total} documentos)'))
@@ -11,6 +11,7 @@ from yggdrasilApp.mongo_models import (
     InventarioBox, AgendaExtendida, DashboardCache, 
     EstadisticasBox, AlertasInteligentes, MetricasBasicas
 )
+from yggdrasilApp.modulos.persistencia_mongo import a_documento, insertar_documentos
 import logging
 
 logger = logging.getLogger(__name__)
@@ -131,12 +132,13 @@ class Command(BaseCommand):
             
             marcas = ['Philips', 'GE Healthcare', 'Siemens', 'Medtronic', 'Dräger', 'Mindray']
             
-            inventarios_creados = 0
+            # Boxes que ya tienen inventario, en una sola consulta
+            boxes_con_inventario = set(InventarioBox.objects.scalar('box_id'))
+            inventarios = []
             
             for box in boxes:
                 # Verificar si ya existe inventario
-                inventario_existente = InventarioBox.objects(box_id=box.idbox).first()
-                if inventario_existente:
+                if box.idbox in boxes_con_inventario:
                     self.stdout.write(f'⚠️  Box {box.idbox} ya tiene inventario, saltando...')
                     continue
                 
@@ -168,11 +170,13 @@ class Command(BaseCommand):
                     inventario.implementos[-1].fecha_ultimo_mantenimiento = fecha_ultimo
                     inventario.implementos[-1].fecha_proximo_mantenimiento = fecha_proximo
                 
-                inventario.save()
-                inventarios_creados += 1
+                inventarios.append(inventario)
                 
                 self.stdout.write(f'📦 Box {box.idbox}: {num_implementos} implementos')
             
+            # Un insert_many por lote en vez de un save() por box
+            inventarios_creados = insertar_documentos(InventarioBox, inventarios)
+            
             self.stdout.write(
                 self.style.SUCCESS(f'✅ {inventarios_creados} inventarios de boxes creados')
             )
@@ -188,16 +192,23 @@ class Command(BaseCommand):
         
         try:
             # Obtener TODAS las agendas disponibles (no solo médicas)
-            todas_agendas = Agendabox.objects.all().order_by('-fechaagenda')
+            todas_agendas = Agendabox.objects.select_related('idmedico').order_by('-fechaagenda')
+            total_agendas = todas_agendas.count()
             
             # Debug: mostrar cuántas agendas encontramos
-            self.stdout.write(f'🔍 Encontradas {todas_agendas.count()} agendas en total')
+            self.stdout.write(f'🔍 Encontradas {total_agendas} agendas en total')
             
             medicos = list(Medico.objects.all())
             self.stdout.write(f'👨‍⚕️ Encontrados {len(medicos)} médicos en la base de datos')
             
             # Ya no calculamos probabilidad - procesamos TODAS las agendas
-            self.stdout.write(f'🎯 Objetivo: Poblar TODAS las {todas_agendas.count()} agendas con datos extendidos')
+            self.stdout.write(f'🎯 Objetivo: Poblar TODAS las {total_agendas} agendas con datos extendidos')
+            
+            # Agendas que ya tienen extensión y primer tipo de cada box, en una consulta cada uno
+            agendas_con_extension = set(AgendaExtendida.objects.scalar('agenda_id'))
+            tipo_por_box = {}
+            for box_id, tipo in BoxTipoBox.objects.values_list('idbox_id', 'idtipobox__tipo'):
+                tipo_por_box.setdefault(box_id, tipo or '')
             
             tipos_procedimiento_por_especialidad = {
                 'CIRUGIA': [
@@ -257,60 +268,39 @@ class Command(BaseCommand):
             agendas_creadas = 0
             agendas_procesadas = 0
             agendas_saltadas_existentes = 0
+            pendientes = []
             
-            for agenda in todas_agendas:
+            def insertar_pendientes():
+                # Un insert_many por lote en vez de un save() por agenda
+                nonlocal agendas_creadas
+                agendas_creadas += insertar_documentos(AgendaExtendida, pendientes)
+                pendientes.clear()
+                porcentaje = (agendas_procesadas / total_agendas) * 100
+                self.stdout.write(f'✅ {agendas_creadas} agendas extendidas creadas ({porcentaje:.1f}% completado)')
+            
+            for agenda in todas_agendas.iterator(chunk_size=2000):
                 agendas_procesadas += 1
                 
                 # NO usar probabilidad - procesar TODAS las agendas
                 
                 # Verificar si ya existe agenda extendida
-                agenda_ext_existente = AgendaExtendida.objects(agenda_id=agenda.id).first()
-                if agenda_ext_existente:
+                if agenda.id in agendas_con_extension:
                     agendas_saltadas_existentes += 1
                     if agendas_saltadas_existentes % 1000 == 0:
                         self.stdout.write(f'⚠️ {agendas_saltadas_existentes} agendas ya tienen extensión...')
                     continue
                 
-                # Debug: mostrar progreso cada 2000 agendas
-                if agendas_creadas % 2000 == 0 and agendas_creadas > 0:
-                    porcentaje = (agendas_procesadas / todas_agendas.count()) * 100
-                    self.stdout.write(f'🔄 Progreso: {agendas_creadas} creadas, {agendas_procesadas} procesadas ({porcentaje:.1f}%)')
-                
                 # Determinar tipo de procedimiento basado en el box
                 tipo_box = 'CONSULTA'  # Default
-                try:
-                    if agenda.idbox:
-                        # Intentar determinar el tipo de box
-                        box_tipos = BoxTipoBox.objects.filter(idbox=agenda.idbox)
-                        if box_tipos.exists():
-                            # Corregir el nombre del campo - podría ser nombretipobox, nombre, o descripcion
-                            tipo_box_obj = box_tipos.first().idtipobox
-                            primer_tipo = ""
-                            
-                            # Intentar diferentes nombres de campo
-                            if hasattr(tipo_box_obj, 'nombretipobox'):
-                                primer_tipo = tipo_box_obj.nombretipobox.upper()
-                            elif hasattr(tipo_box_obj, 'nombre'):
-                                primer_tipo = tipo_box_obj.nombre.upper()
-                            elif hasattr(tipo_box_obj, 'descripcion'):
-                                primer_tipo = tipo_box_obj.descripcion.upper()
-                            elif hasattr(tipo_box_obj, 'tipo'):
-                                primer_tipo = tipo_box_obj.tipo.upper()
-                            else:
-                                # Si no encontramos el campo, usar string representation
-                                primer_tipo = str(tipo_box_obj).upper()
-                            
-                            if any(keyword in primer_tipo for keyword in ['CIRUG', 'QUIROF']):
-                                tipo_box = 'CIRUGIA'
-                            elif any(keyword in primer_tipo for keyword in ['IMAGEN', 'RADIO', 'TOMO']):
-                                tipo_box = 'IMAGENOLOGIA'
-                            elif any(keyword in primer_tipo for keyword in ['DIAG', 'ENDO', 'ECO']):
-                                tipo_box = 'DIAGNOSTICO'
-                            elif any(keyword in primer_tipo for keyword in ['TERAP', 'QUIMIO', 'DIALISIS']):
-                                tipo_box = 'TERAPIA'
-                except Exception as e:
-                    # Silenciar el error ya que no afecta la funcionalidad
-                    pass  # Mantener default
+                primer_tipo = tipo_por_box.get(agenda.idbox_id, '').upper()
+                if any(keyword in primer_tipo for keyword in ['CIRUG', 'QUIROF']):
+                    tipo_box = 'CIRUGIA'
+                elif any(keyword in primer_tipo for keyword in ['IMAGEN', 'RADIO', 'TOMO']):
+                    tipo_box = 'IMAGENOLOGIA'
+                elif any(keyword in primer_tipo for keyword in ['DIAG', 'ENDO', 'ECO']):
+                    tipo_box = 'DIAGNOSTICO'
+                elif any(keyword in primer_tipo for keyword in ['TERAP', 'QUIMIO', 'DIALISIS']):
+                    tipo_box = 'TERAPIA'
                 
                 agenda_ext = AgendaExtendida(
                     agenda_id=agenda.id,
@@ -488,54 +478,56 @@ class Command(BaseCommand):
                     detalle=f'Agenda extendida generada para {tipo_box}: {agenda_ext.tipo_procedimiento}'
                 )
                 
-                # Intentar guardar la agenda extendida
+                # Validar y encolar la agenda extendida; se insertan de a 5000
                 try:
-                    agenda_ext.save()
-                    agendas_creadas += 1
-                    
-                    # Mostrar progreso cada 5000 agendas creadas
-                    if agendas_creadas % 5000 == 0:
-                        porcentaje = (agendas_procesadas / todas_agendas.count()) * 100
-                        self.stdout.write(f'✅ {agendas_creadas} agendas extendidas creadas ({porcentaje:.1f}% completado)')
-                
+                    pendientes.append(a_documento(agenda_ext))
                 except Exception as e:
                     self.stdout.write(f'❌ Error guardando agenda extendida {agenda.id}: {str(e)}')
                     continue
                 
+                if len(pendientes) >= 5000:
+                    insertar_pendientes()
+                
                 # Mostrar progreso cada 10000 agendas procesadas
                 if agendas_procesadas % 10000 == 0:
-                    porcentaje_completado = (agendas_procesadas / todas_agendas.count()) * 100
-                    tiempo_estimado = "Calculando..." if agendas_procesadas < 1000 else f"~{int((todas_agendas.count() - agendas_procesadas) / 1000)} min restantes"
-                    self.stdout.write(f'📊 Procesadas {agendas_procesadas}/{todas_agendas.count()} ({porcentaje_completado:.1f}%) - Creadas: {agendas_creadas} - {tiempo_estimado}')
+                    porcentaje_completado = (agendas_procesadas / total_agendas) * 100
+                    tiempo_estimado = "Calculando..." if agendas_procesadas < 1000 else f"~{int((total_agendas - agendas_procesadas) / 1000)} min restantes"
+                    self.stdout.write(f'📊 Procesadas {agendas_procesadas}/{total_agendas} ({porcentaje_completado:.1f}%) - Creadas: {agendas_creadas} - {tiempo_estimado}')
+            
+            if pendientes:
+                insertar_pendientes()
             
             self.stdout.write(
                 self.style.SUCCESS(f'✅ {agendas_creadas} agendas extendidas creadas de {agendas_procesadas} agendas procesadas')
             )
             self.stdout.write(f'📊 Agendas saltadas (ya existían): {agendas_saltadas_existentes}')
-            self.stdout.write(f'📊 Total de agendas en el sistema: {todas_agendas.count()}')
-            self.stdout.write(f'📊 Porcentaje de cobertura: {((agendas_creadas + agendas_saltadas_existentes) / todas_agendas.count()) * 100:.1f}%')
-            
-            # Estadísticas de médicos múltiples
-            agendas_con_multiples_medicos = 0
-            total_medicos_adicionales = 0
-            for agenda_ext in AgendaExtendida.objects.all():
-                if len(agenda_ext.medicos) > 1:
-                    agendas_con_multiples_medicos += 1
-                    total_medicos_adicionales += len(agenda_ext.medicos) - 1
+            self.stdout.write(f'📊 Total de agendas en el sistema: {total_agendas}')
+            self.stdout.write(f'📊 Porcentaje de cobertura: {((agendas_creadas + agendas_saltadas_existentes) / max(total_agendas, 1)) * 100:.1f}%')
+            
+            # Estadísticas de médicos múltiples, calculadas en MongoDB
+            coleccion = AgendaExtendida._get_collection()
+            multiples = list(coleccion.aggregate([
+                {'$project': {'num_medicos': {'$size': {'$ifNull': ['$medicos', []]}}}},
+                {'$match': {'num_medicos': {'$gt': 1}}},
+                {'$group': {'_id': None, 'agendas': {'$sum': 1}, 'adicionales': {'$sum': {'$subtract': ['$num_medicos', 1]}}}}
+            ]))
+            agendas_con_multiples_medicos = multiples[0]['agendas'] if multiples else 0
+            total_medicos_adicionales = multiples[0]['adicionales'] if multiples else 0
             
             if agendas_creadas > 0:
                 porcentaje_multiples = (agendas_con_multiples_medicos / (agendas_creadas + agendas_saltadas_existentes)) * 100
                 self.stdout.write(f'📊 Agendas con múltiples médicos: {agendas_con_multiples_medicos} ({porcentaje_multiples:.1f}%)')
                 self.stdout.write(f'📊 Total de médicos adicionales agregados: {total_medicos_adicionales}')
             
-            tipos_generados = {}
-            for agenda_ext in AgendaExtendida.objects.all():
-                tipo = agenda_ext.tipo_procedimiento
-                tipos_generados[tipo] = tipos_generados.get(tipo, 0) + 1
+            tipos_generados = coleccion.aggregate([
+                {'$group': {'_id': '$tipo_procedimiento', 'cantidad': {'$sum': 1}}},
+                {'$sort': {'cantidad': -1}},
+                {'$limit': 5}
+            ])
             
             self.stdout.write('📊 Tipos de procedimientos generados:')
-            for tipo, cantidad in sorted(tipos_generados.items(), key=lambda x: x[1], reverse=True)[:5]:
-                self.stdout.write(f'   • {tipo}: {cantidad}')
+            for tipo in tipos_generados:
+                self.stdout.write(f'   • {tipo["_id"]}: {tipo["cantidad"]}')
             
         except Exception as e:
             self.stdout.write(
@@ -548,15 +540,17 @@ class Command(BaseCommand):
         self.stdout.write('📊 Generando estadísticas históricas...')
         
         try:
-            from yggdrasilApp.modulos.dashboard_optimizer import DashboardOptimizer
+            from yggdrasilApp.modulos.estadisticas_mensuales import (
+                mes_anterior, rango_meses, rellenar_meses, restar_meses, unificar_estadisticas
+            )
+            unificar_estadisticas()
             
-            # Generar estadísticas para los últimos 3 meses
-            fecha_actual = datetime.now()
+            # Generar estadísticas para los últimos 3 meses cerrados
+            hasta = mes_anterior()
+            desde = restar_meses(hasta, 2)
             
-            for i in range(3):  # Últimos 3 meses
-                mes_fecha = fecha_actual - timedelta(days=30 * i)
-                DashboardOptimizer.generar_estadisticas_mensuales_boxes()
-                self.stdout.write(f'📊 Estadísticas generadas para mes {mes_fecha.strftime("%B %Y")}')
+            for anio, mes, escritos in rellenar_meses(rango_meses(desde, hasta)):
+                self.stdout.write(f'📊 Estadísticas generadas para mes {mes:02d}/{anio} ({escritos} boxes)')
             
             self.stdout.write(
                 self.style.SUCCESS('✅ Estadísticas históricas generadas')
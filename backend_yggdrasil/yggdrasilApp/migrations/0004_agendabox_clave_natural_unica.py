@@ -0,0 +1,63 @@
+from django.db import migrations
+
+# Claves naturales repetidas (GROUP BY agrupa también los NULL entre sí)
+SQL_DUPLICADOS = (
+    "SELECT COUNT(*) FROM ("
+    "SELECT 1 FROM agendabox "
+    "GROUP BY idMedico, idBox, fechaAgenda, horaInicioAgenda, horaFinAgenda "
+    "HAVING COUNT(*) > 1"
+    ") repetidas"
+)
+
+# Índice funcional (MySQL 8.0.13+). Los NULL se reemplazan por valores que no
+# pueden ser reales (id -1, hora negativa) para que choquen entre sí y no con
+# un médico o una hora de fin 00:00 verdaderos
+SQL_INDICE = (
+    "CREATE UNIQUE INDEX agendabox_clave_natural_uniq ON agendabox "
+    "((COALESCE(idMedico, -1)), idBox, fechaAgenda, horaInicioAgenda, "
+    "(COALESCE(horaFinAgenda, TIME '-00:00:01')))"
+)
+
+
+def _tabla_existe(schema_editor):
+    # La tabla no es administrada por Django: no existe en las bases de prueba
+    return 'agendabox' in schema_editor.connection.introspection.table_names()
+
+
+def crear_indice(apps, schema_editor):
+    if not _tabla_existe(schema_editor):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(SQL_DUPLICADOS)
+        repetidas = cursor.fetchone()[0]
+    if repetidas:
+        raise RuntimeError(
+            f"agendabox tiene {repetidas} claves naturales repetidas y no admite el índice único. "
+            "Revíselas con 'python manage.py depurar_agendas_duplicadas' y elimínelas con "
+            "'--eliminar' antes de volver a migrar."
+        )
+    schema_editor.execute(SQL_INDICE)
+
+
+def quitar_indice(apps, schema_editor):
+    if _tabla_existe(schema_editor):
+        schema_editor.execute("DROP INDEX agendabox_clave_natural_uniq ON agendabox")
+
+
+class Migration(migrations.Migration):
+    """Índice único por clave natural de agendabox.
+
+    Permite que la ingesta descarte por clave las agendas que el feed de
+    origen repite, también las sin médico o sin hora de fin. La tabla no es
+    administrada por Django, por eso el índice se crea con SQL directo. Si ya
+    hay duplicados la migración falla sin tocar filas: se depuran antes con
+    el comando `depurar_agendas_duplicadas`.
+    """
+
+    dependencies = [
+        ('yggdrasilApp', '0003_alter_historialmodificacionesbox_table'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_indice, quitar_indice),
+    ]
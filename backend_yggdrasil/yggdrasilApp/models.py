@@ -18,6 +18,8 @@ class Agendabox(models.Model):
     class Meta:
         db_table = 'agendabox'
         managed = False
+        # Índice único (idMedico, idBox, fechaAgenda, horaInicioAgenda, horaFinAgenda) creado en la migración 0004,
+        # sobre COALESCE de idMedico y horaFinAgenda para cubrir también los NULL (MySQL 8.0.13+)
 class AuthGroup(models.Model):
     name = models.CharField(unique=True, max_length=150)
 
@@ -1,22 +1,120 @@
 
 from ..models import Agendabox
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from .observable import Observable
 from .cache_manager import CacheSignals
+from .indice_agendas import indice_agendas, normalizar_fecha, normalizar_hora
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
-import hashlib
+from collections import OrderedDict
+import time as reloj
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ConjuntoRecientes:
+    """Conjunto acotado con expiración (LRU + TTL) para claves ya procesadas.
+
+    Reemplaza al set que se vaciaba completo al llegar a 1000 elementos: al
+    superar `max_elementos` se descartan sólo las claves más antiguas.
+    """
+
+    def __init__(self, max_elementos=50000, ttl_segundos=6 * 3600):
+        self.max_elementos = max_elementos
+        self.ttl_segundos = ttl_segundos
+        self._claves = OrderedDict()
+
+    def __contains__(self, clave):
+        registrado = self._claves.get(clave)
+        if registrado is None:
+            return False
+        if reloj.monotonic() - registrado > self.ttl_segundos:
+            del self._claves[clave]
+            return False
+        self._claves.move_to_end(clave)
+        return True
+
+    def __len__(self):
+        return len(self._claves)
+
+    def add(self, clave):
+        self._claves[clave] = reloj.monotonic()
+        self._claves.move_to_end(clave)
+        while len(self._claves) > self.max_elementos:
+            self._claves.popitem(last=False)
+
+    def discard(self, clave):
+        self._claves.pop(clave, None)
+
+
+def clave_natural(agenda):
+    """(medico, box, fecha, inicio, fin) normalizado, igual al índice único de agendabox"""
+    return (
+        agenda.idmedico_id,
+        agenda.idbox_id,
+        normalizar_fecha(agenda.fechaagenda),
+        normalizar_hora(agenda.horainicioagenda),
+        normalizar_hora(agenda.horafinagenda) if agenda.horafinagenda is not None else None,
+    )
+
 
 class ActualizadorDatos(Observable):
     def __init__(self):
         super().__init__()
-        # ⭐ Cache temporal para evitar duplicados en la misma ejecución
-        self._agendas_procesadas_cache = set()
+        # ⭐ Claves ya procesadas recientemente (acotado, sin vaciados completos)
+        self._agendas_procesadas_cache = ConjuntoRecientes()
+
+    def _claves_existentes(self, claves):
+        """Devuelve cuáles de las claves ya están en la BD, con una sola consulta"""
+        if not claves:
+            return set()
+        # Un Q por (box, fecha): filtrar cada columna con __in por separado
+        # traía el producto cartesiano de boxes, fechas y horas del lote
+        filtro = Q()
+        for box_id, fecha in {(c[1], c[2]) for c in claves}:
+            filtro |= Q(idbox_id=box_id, fechaagenda=fecha)
+        existentes = Agendabox.objects.filter(filtro).values_list(
+            'idmedico_id', 'idbox_id', 'fechaagenda', 'horainicioagenda', 'horafinagenda'
+        )
+        return claves & set(existentes)
 
-    def _generar_hash_agenda(self, agenda):
-        """Generar un hash único para una agenda"""
-        datos = f"{agenda.idmedico.idmedico}_{agenda.idbox.idbox}_{agenda.fechaagenda}_{agenda.horainicioagenda}_{agenda.horafinagenda}"
-        return hashlib.md5(datos.encode()).hexdigest()
+    @staticmethod
+    def _es_clave_duplicada(error):
+        """True si el IntegrityError viene del índice único (MySQL 1062) y no de otra restricción"""
+        return (error.args and error.args[0] == 1062) or 'UNIQUE constraint' in str(error)
+
+    def _guardar(self, agendas):
+        """Inserta las agendas y devuelve (guardadas, duplicadas).
+
+        Se intenta un solo bulk_create; si otro proceso insertó alguna de las
+        claves entretanto se reintenta fila por fila descartando sólo las que
+        chocan con el índice único. Cualquier otro error de integridad (FK,
+        truncado) se propaga sin guardar nada: un INSERT IGNORE los ocultaría.
+        """
+        try:
+            with transaction.atomic():
+                Agendabox.objects.bulk_create(agendas)
+            return agendas, 0
+        except IntegrityError as e:
+            if not self._es_clave_duplicada(e):
+                raise
+
+        guardadas = []
+        duplicadas = 0
+        # Un savepoint por fila dentro de una transacción del lote: si falla
+        # con otro error no queda ninguna fila guardada a medias
+        with transaction.atomic():
+            for agenda in agendas:
+                try:
+                    with transaction.atomic():
+                        agenda.save(force_insert=True)
+                    guardadas.append(agenda)
+                except IntegrityError as e:
+                    if not self._es_clave_duplicada(e):
+                        raise
+                    duplicadas += 1
+        return guardadas, duplicadas
 
     def actualizar(self, nuevos_agenda_boxes):
         if not nuevos_agenda_boxes:
@@ -30,40 +128,26 @@ class ActualizadorDatos(Observable):
         duplicados_bd = 0
         duplicados_cache = 0
         
+        # ⭐ DEDUPLICAR EN MEMORIA (cache reciente y repetidos dentro del lote)
+        candidatas = {}
         for agenda, accion in nuevos_agenda_boxes:
-            if accion == 'INSERT':
-                # ⭐ GENERAR HASH ÚNICO PARA ESTA AGENDA
-                hash_agenda = self._generar_hash_agenda(agenda)
-                
-                # ⭐ VERIFICAR CACHE TEMPORAL PRIMERO (más rápido)
-                if hash_agenda in self._agendas_procesadas_cache:
-                    duplicados_cache += 1
-                    print(f"⚡ Duplicado en cache detectado: {hash_agenda[:8]}...")
-                    continue
-                
-                # ⭐ VERIFICAR SI YA EXISTE EN LA BASE DE DATOS
-                existe = Agendabox.objects.filter(
-                    idmedico=agenda.idmedico,
-                    idbox=agenda.idbox,
-                    fechaagenda=agenda.fechaagenda,
-                    horainicioagenda=agenda.horainicioagenda,
-                    horafinagenda=agenda.horafinagenda
-                ).exists()
-                
-                if not existe:
-                    agenda_to_save.append(agenda)
-                    # ⭐ AGREGAR AL CACHE TEMPORAL
-                    self._agendas_procesadas_cache.add(hash_agenda)
-                    actualizo = True
-                    print(f"✅ Agenda nueva válida: Box {agenda.idbox.idbox}, {agenda.fechaagenda} {agenda.horainicioagenda}")
-                else:
-                    duplicados_bd += 1
-                    print(f"⚠️ Duplicado en BD detectado: Box {agenda.idbox.idbox}, {agenda.fechaagenda} {agenda.horainicioagenda}")
+            if accion != 'INSERT':
+                continue
+            clave = clave_natural(agenda)
+            if clave in self._agendas_procesadas_cache or clave in candidatas:
+                duplicados_cache += 1
+                continue
+            candidatas[clave] = agenda
         
-        # ⭐ LIMPIAR CACHE DESPUÉS DE UN TIEMPO (evitar crecimiento infinito)
-        if len(self._agendas_procesadas_cache) > 1000:
-            self._agendas_procesadas_cache.clear()
-            print("🧹 Cache temporal limpiado")
+        # ⭐ VERIFICAR TODO EL LOTE CONTRA LA BASE DE DATOS EN UNA CONSULTA
+        existentes = self._claves_existentes(set(candidatas))
+        for clave, agenda in candidatas.items():
+            self._agendas_procesadas_cache.add(clave)
+            if clave in existentes:
+                duplicados_bd += 1
+                continue
+            agenda_to_save.append(agenda)
+            actualizo = True
 
         # Resumen del procesamiento
         print(f"📊 Resumen: {len(agenda_to_save)} nuevas, {duplicados_bd} duplicadas en BD, {duplicados_cache} duplicadas en cache")
@@ -74,15 +158,36 @@ class ActualizadorDatos(Observable):
             print(f"💾 Guardando {cantidad_nuevas} nuevas agendas únicas")
             
             try:
-                Agendabox.objects.bulk_create(agenda_to_save)
-                print(f"✅ Guardado exitoso de {cantidad_nuevas} agendas")
-                
+                agenda_to_save, duplicados_carrera = self._guardar(agenda_to_save)
+            except Exception as e:
+                print(f"❌ Error al guardar agendas: {e}")
+                # No se guardó ninguna: se olvidan sus claves para reintentarlas
+                for agenda in agenda_to_save:
+                    self._agendas_procesadas_cache.discard(clave_natural(agenda))
+                # Quien llama no debe dar el lote por procesado (marca del feed, cursor del polling)
+                raise
+
+            cantidad_nuevas = len(agenda_to_save)
+            if duplicados_carrera:
+                print(f"ℹ️ {duplicados_carrera} agendas ya insertadas por otro proceso")
+            if not agenda_to_save:
+                return
+            print(f"✅ Guardado exitoso de {cantidad_nuevas} agendas")
+
+            # Las agendas ya están en la BD: un fallo de aquí en adelante no las deshace
+            try:
+                indice_agendas.invalidar_agendas(agenda_to_save)
+
                 # ⭐ NUEVO: Invalidar cache automáticamente
                 CacheSignals.bulk_agendas_creadas(
                     cantidad_agendas=cantidad_nuevas,
+                    agendas=agenda_to_save,
                     fuente='thread_externo'
                 )
-                
+            except Exception:
+                logger.exception("Error invalidando caches tras guardar agendas")
+
+            try:
                 print('🔔 Enviando notificación WebSocket...')
                 # Notificar por websocket usando Channels
                 channel_layer = get_channel_layer()
@@ -93,16 +198,15 @@ class ActualizadorDatos(Observable):
                         'message': 'actualizacion_agenda'
                     }
                 )
+            except Exception:
+                logger.exception("Error enviando la notificación WebSocket de agendas")
+
+            try:
                 # Si quieres mantener la notificación a observadores Python:
                 self.notificar_observadores()
-                
-            except Exception as e:
-                print(f"❌ Error al guardar agendas: {e}")
-                # Limpiar cache en caso de error para reintentarlo
-                for agenda in agenda_to_save:
-                    hash_agenda = self._generar_hash_agenda(agenda)
-                    self._agendas_procesadas_cache.discard(hash_agenda)
-                
+            except Exception:
+                logger.exception("Error notificando a los observadores de agendas")
+
         elif not agenda_to_save:
             print("ℹ️ No hay nuevas agendas para procesar (todas eran duplicadas)")
         else:
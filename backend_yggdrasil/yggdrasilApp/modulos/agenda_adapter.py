@@ -1,55 +1,157 @@
 from ..models import Agendabox, Box, Medico
+import numpy as np
 import pandas as pd
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def resolver_boxes_medicos(box_ids, medico_ids):
+    """Resuelve todos los ids distintos con un in_bulk por modelo"""
+    boxes = Box.objects.in_bulk({int(i) for i in box_ids})
+    medicos = Medico.objects.in_bulk({int(i) for i in medico_ids})
+    return boxes, medicos
+
+
+def _parsear_horas(serie):
+    """Parsea horas probando primero los formatos habituales (vectorizado)"""
+    texto = serie.astype(str).str.strip()
+    horas = pd.to_datetime(texto, format='%H:%M', errors='coerce')
+    for formato in ('%H:%M:%S', 'mixed'):
+        faltan = horas.isna()
+        if not faltan.any():
+            break
+        horas[faltan] = pd.to_datetime(texto[faltan], format=formato, errors='coerce')
+    return horas
+
+
+def _a_entero(valor):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return None
 
 
 class AgendaAdapter:
+    """Adapta los registros JSON de la API de origen.
+
+    Las filas con ids desconocidos o inválidos no abortan el lote: se omiten
+    y quedan en `self.errores` con su posición y el motivo.
+    """
+
+    def __init__(self):
+        self.errores = []
+
     def adaptar_datos(self, datos):
         """Convierte los datos JSON a instancias de AgendaBox."""
+        self.errores = []
+        box_ids = [_a_entero(item.get('idBox')) for item in datos]
+        medico_ids = [_a_entero(item.get('idMedico')) for item in datos]
+        boxes, medicos = resolver_boxes_medicos(
+            {i for i in box_ids if i is not None},
+            {i for i in medico_ids if i is not None}
+        )
+
         agenda_boxes = []
-        for item in datos:
-            box_instance = Box.objects.get(idbox=int(item['idBox']))
-            medico_instance = Medico.objects.get(idmedico=item['idMedico'])
+        for posicion, (item, box_id, medico_id) in enumerate(zip(datos, box_ids, medico_ids)):
+            errores_fila = []
+            if box_id not in boxes:
+                errores_fila.append(f"idBox {item.get('idBox')} no existe")
+            if medico_id not in medicos:
+                errores_fila.append(f"idMedico {item.get('idMedico')} no existe")
+            if errores_fila:
+                self.errores.append({'fila': posicion, 'id': item.get('id'), 'errores': errores_fila})
+                continue
+
             agenda_box = Agendabox(
-                idmedico=medico_instance,
-                idbox=box_instance,
+                idmedico=medicos[medico_id],
+                idbox=boxes[box_id],
                 fechaagenda=item['fecha'],
                 horainicioagenda=item['horaInicio'],
                 horafinagenda=item['horaFin'],
-                habilitada=1
+                habilitada=1,
+                esMedica=1
             )
             agenda_boxes.append((agenda_box, item['accion']))
+
+        if self.errores:
+            logger.warning(f"{len(self.errores)} registros omitidos por ids inválidos")
         return agenda_boxes
 
 
 class SimuladorAdapter:
+    """Adapta el archivo del simulador (DataFrame) a instancias de Agendabox.
+
+    Convierte cada columna de una vez con pandas, resuelve boxes y médicos
+    con un in_bulk y reporta en `self.errores` las filas inválidas (número
+    de fila como en la planilla, contando el encabezado) sin abortar el archivo.
+    """
+
+    COLUMNAS = ['idBox', 'idMedico', 'fecha', 'horaInicio', 'horaFin']
+
+    def __init__(self):
+        self.errores = []
+
     def adaptar_datos(self, datos):
-        print(datos.info())
-        df = datos[['idBox', 'idMedico', 'fecha', 'horaInicio', 'horaFin']]
+        self.errores = []
+        faltantes = [col for col in self.COLUMNAS if col not in datos.columns]
+        if faltantes:
+            raise ValueError(f"Faltan columnas en el archivo: {', '.join(faltantes)}")
+        df = datos[self.COLUMNAS]
 
-        print(df)
-        cols_int = ['idBox', 'idMedico']
-        cols_date = ['fecha']
-        cols_time = ['horaInicio', 'horaFin']
-        for col in cols_int:
-            df.loc[:, col] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(int)
+        box_ids = pd.to_numeric(df['idBox'], errors='coerce')
+        medico_ids = pd.to_numeric(df['idMedico'], errors='coerce')
+        fechas = pd.to_datetime(df['fecha'], errors='coerce')
+        inicios = _parsear_horas(df['horaInicio'])
+        fines = _parsear_horas(df['horaFin'])
 
-        for col in cols_date:
-            df.loc[:, col] = pd.to_datetime(df[col], errors='coerce').dt.date
+        boxes, medicos = resolver_boxes_medicos(
+            box_ids.dropna().unique(), medico_ids.dropna().unique()
+        )
 
-        for col in cols_time:
-            df.loc[:, col] = pd.to_datetime(df[col], errors='coerce').dt.time
+        box_ok = box_ids.isin(list(boxes)).to_numpy()
+        medico_ok = medico_ids.isin(list(medicos)).to_numpy()
+        fecha_ok = fechas.notna().to_numpy()
+        inicio_ok = inicios.notna().to_numpy()
+        fin_ok = fines.notna().to_numpy()
+        validas = box_ok & medico_ok & fecha_ok & inicio_ok & fin_ok
 
-        agenda_boxes = []
-        for fila in df.itertuples():
-            box_instance = Box.objects.get(idbox=fila.idBox)
-            medico_instance = Medico.objects.get(idmedico=fila.idMedico)
-            agenda_box = Agendabox(
-                idmedico=medico_instance,
-                idbox=box_instance,
-                fechaagenda=fila.fecha,
-                horainicioagenda=fila.horaInicio,
-                horafinagenda=fila.horaFin,
-                habilitada=1
+        if not validas.all():
+            self._registrar_errores(df, ~validas, box_ok, medico_ok, fecha_ok, inicio_ok, fin_ok)
+
+        columnas = zip(
+            box_ids.to_numpy()[validas].astype(int),
+            medico_ids.to_numpy()[validas].astype(int),
+            fechas[validas].dt.date,
+            inicios[validas].dt.time,
+            fines[validas].dt.time,
+        )
+        return [
+            Agendabox(
+                idmedico=medicos[medico_id],
+                idbox=boxes[box_id],
+                fechaagenda=fecha,
+                horainicioagenda=inicio,
+                horafinagenda=fin,
+                habilitada=1,
+                esMedica=1
             )
-            agenda_boxes.append(agenda_box)
-        return agenda_boxes
+            for box_id, medico_id, fecha, inicio, fin in columnas
+        ]
+
+    def _registrar_errores(self, df, invalidas, box_ok, medico_ok, fecha_ok, inicio_ok, fin_ok):
+        mensajes = [
+            (box_ok, 'idBox', 'idBox {} no existe'),
+            (medico_ok, 'idMedico', 'idMedico {} no existe'),
+            (fecha_ok, 'fecha', 'fecha inválida: {}'),
+            (inicio_ok, 'horaInicio', 'horaInicio inválida: {}'),
+            (fin_ok, 'horaFin', 'horaFin inválida: {}'),
+        ]
+        for posicion in np.flatnonzero(invalidas):
+            errores_fila = [
+                plantilla.format(df[columna].iat[posicion])
+                for ok, columna, plantilla in mensajes
+                if not ok[posicion]
+            ]
+            self.errores.append({'fila': int(posicion) + 2, 'errores': errores_fila})
+        logger.warning(f"{len(self.errores)} filas del archivo con errores")
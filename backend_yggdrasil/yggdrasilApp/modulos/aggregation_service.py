@@ -0,0 +1,236 @@
+"""
+Agregados incrementales por (box, fecha) para el dashboard
+Cada escritura refresca sólo los buckets afectados y los dashboards de
+cualquier período se pliegan desde esos buckets con una agregación MongoDB
+"""
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+from ..models import Agendabox
+from ..mongo_models import AgregadoBoxDia, DiaAgregado, VERSION_AGREGADOS
+from .indice_agendas import normalizar_fecha
+import logging
+
+logger = logging.getLogger(__name__)
+
+INICIO_AM = time(8, 0)
+FIN_AM = time(13, 0)
+INICIO_PM = time(13, 0)
+FIN_PM = time(18, 0)
+
+CAMPOS_FILA = ('idbox_id', 'fechaagenda', 'horainicioagenda', 'horafinagenda', 'esMedica')
+
+
+def _a_datetime(fecha):
+    """Las fechas se guardan en Mongo como datetime a medianoche"""
+    return datetime(fecha.year, fecha.month, fecha.day)
+
+
+def _minutos(hora):
+    return hora.hour * 60 + hora.minute
+
+
+def _bucket_vacio(box_id, fecha):
+    return {
+        'box_id': box_id,
+        'fecha': _a_datetime(fecha),
+        'total_reservas': 0,
+        'reservas_medicas': 0,
+        'reservas_no_medicas': 0,
+        'reservas_am': 0,
+        'reservas_pm': 0,
+        'minutos_ocupados': 0,
+        'reservas_con_duracion': 0,
+        'minutos_muertos': 0.0,
+    }
+
+
+class ServicioAgregados:
+    """Mantiene la colección `agregados_box_dia` y pliega períodos desde ella.
+
+    Refrescar un bucket lo recalcula completo desde las agendas de ese
+    (box, fecha): es una consulta pequeña e indexada, el resultado es
+    idempotente (notificaciones repetidas o desordenadas no acumulan error)
+    y los minutos muertos dependen de las agendas vecinas de todos modos.
+    Los días se materializan bajo demanda la primera vez que un período los
+    pliega; hasta entonces las escrituras sobre ellos no cuestan nada.
+    """
+
+    @staticmethod
+    def calcular_buckets(filas):
+        """Calcula los buckets a partir de filas (box, fecha, inicio, fin, esMedica)"""
+        buckets = {}
+        ultimo_fin = {}
+        for box_id, fecha, inicio, fin, es_medica in sorted(
+            filas, key=lambda f: (f[0], f[1], f[2] or time.min)
+        ):
+            clave = (box_id, fecha)
+            bucket = buckets.get(clave)
+            if bucket is None:
+                bucket = buckets[clave] = _bucket_vacio(box_id, fecha)
+
+            bucket['total_reservas'] += 1
+            if es_medica == 1:
+                bucket['reservas_medicas'] += 1
+            elif es_medica == 0:
+                bucket['reservas_no_medicas'] += 1
+
+            if inicio is None or fin is None:
+                continue
+
+            bucket['minutos_ocupados'] += _minutos(fin) - _minutos(inicio)
+            bucket['reservas_con_duracion'] += 1
+            if inicio >= INICIO_AM and fin <= FIN_AM:
+                bucket['reservas_am'] += 1
+            if inicio >= INICIO_PM and fin <= FIN_PM:
+                bucket['reservas_pm'] += 1
+
+            # Hueco desde el mayor fin visto en el box y día (misma definición
+            # que analisis_huecos.huecos_por_dia): una agenda larga que cubre
+            # a otras no genera huecos falsos
+            fin_maximo = ultimo_fin.get(clave)
+            if fin_maximo is not None:
+                hueco = (
+                    datetime.combine(fecha, inicio) - datetime.combine(fecha, fin_maximo)
+                ).total_seconds() / 60
+                if hueco > 0:
+                    bucket['minutos_muertos'] += hueco
+            ultimo_fin[clave] = fin if fin_maximo is None else max(fin, fin_maximo)
+
+        return buckets
+
+    @staticmethod
+    def _dias_materializados(fechas):
+        # Las marcas vencen para recoger escrituras que no pasaron por CacheSignals
+        vigencia = timedelta(hours=getattr(settings, 'AGREGADOS_VIGENCIA_HORAS', 24))
+        marcados = DiaAgregado.objects(
+            fecha__in=[_a_datetime(f) for f in fechas],
+            materializado_en__gt=datetime.now() - vigencia,
+            version=VERSION_AGREGADOS
+        ).scalar('fecha')
+        return {f.date() for f in marcados}
+
+    @staticmethod
+    def _guardar_buckets(buckets):
+        if not buckets:
+            return
+        ahora = datetime.now()
+        operaciones = [
+            ReplaceOne(
+                {'box_id': b['box_id'], 'fecha': b['fecha']},
+                dict(b, actualizado_en=ahora),
+                upsert=True
+            )
+            for b in buckets.values()
+        ]
+        AgregadoBoxDia._get_collection().bulk_write(operaciones, ordered=False)
+
+    @staticmethod
+    def materializar_rango(desde, hasta):
+        """Asegura que todos los días del rango tengan sus buckets calculados"""
+        dias = [desde + timedelta(days=i) for i in range((hasta - desde).days + 1)]
+        faltantes = set(dias) - ServicioAgregados._dias_materializados(dias)
+        if not faltantes:
+            return 0
+
+        filas = Agendabox.objects.filter(
+            fechaagenda__gte=min(faltantes),
+            fechaagenda__lte=max(faltantes)
+        ).values_list(*CAMPOS_FILA)
+        buckets = ServicioAgregados.calcular_buckets(
+            fila for fila in filas if fila[1] in faltantes
+        )
+
+        # Primero se reemplazan los buckets y después se borran sólo los que
+        # ya no tienen agendas: un plegado concurrente nunca ve el día vacío
+        ServicioAgregados._guardar_buckets(buckets)
+        boxes_por_dia = {}
+        for box_id, fecha in buckets:
+            boxes_por_dia.setdefault(fecha, []).append(box_id)
+        AgregadoBoxDia._get_collection().bulk_write([
+            DeleteMany({'fecha': _a_datetime(f), 'box_id': {'$nin': boxes_por_dia.get(f, [])}})
+            for f in faltantes
+        ], ordered=False)
+
+        ahora = datetime.now()
+        DiaAgregado._get_collection().bulk_write([
+            UpdateOne(
+                {'fecha': _a_datetime(f)},
+                {'$set': {'materializado_en': ahora, 'version': VERSION_AGREGADOS}},
+                upsert=True
+            )
+            for f in faltantes
+        ], ordered=False)
+
+        logger.info(f"Agregados materializados para {len(faltantes)} días ({len(buckets)} buckets)")
+        return len(faltantes)
+
+    @staticmethod
+    def refrescar_buckets(pares):
+        """Recalcula los buckets (box_id, fecha) tocados por una escritura.
+
+        Sólo se refrescan los días ya materializados; el resto se calculará
+        completo cuando algún período los necesite.
+        """
+        normalizados = set()
+        for box_id, fecha in pares:
+            if box_id is None or fecha is None:
+                continue
+            try:
+                normalizados.add((int(box_id), normalizar_fecha(fecha)))
+            except ValueError as e:
+                logger.warning(f"Bucket ({box_id}, {fecha!r}) no refrescado: {str(e)}")
+        pares = normalizados
+        if not pares:
+            return 0
+
+        materializados = ServicioAgregados._dias_materializados({f for _, f in pares})
+        pares = {(b, f) for b, f in pares if f in materializados}
+        if not pares:
+            return 0
+
+        filas = Agendabox.objects.filter(
+            idbox_id__in={b for b, _ in pares},
+            fechaagenda__in={f for _, f in pares}
+        ).values_list(*CAMPOS_FILA)
+        buckets = ServicioAgregados.calcular_buckets(
+            fila for fila in filas if (fila[0], fila[1]) in pares
+        )
+
+        vacios = pares - set(buckets)
+        if vacios:
+            coleccion = AgregadoBoxDia._get_collection()
+            for box_id, fecha in vacios:
+                coleccion.delete_one({'box_id': box_id, 'fecha': _a_datetime(fecha)})
+        ServicioAgregados._guardar_buckets(buckets)
+        return len(pares)
+
+    @staticmethod
+    def plegar(desde, hasta):
+        """Suma los buckets del rango: totales del período y detalle por box"""
+        ServicioAgregados.materializar_rango(desde, hasta)
+
+        por_box = list(AgregadoBoxDia._get_collection().aggregate([
+            {'$match': {'fecha': {'$gte': _a_datetime(desde), '$lte': _a_datetime(hasta)}}},
+            {'$group': {
+                '_id': '$box_id',
+                'total_reservas': {'$sum': '$total_reservas'},
+                'reservas_medicas': {'$sum': '$reservas_medicas'},
+                'reservas_no_medicas': {'$sum': '$reservas_no_medicas'},
+                'reservas_am': {'$sum': '$reservas_am'},
+                'reservas_pm': {'$sum': '$reservas_pm'},
+                'minutos_ocupados': {'$sum': '$minutos_ocupados'},
+                'reservas_con_duracion': {'$sum': '$reservas_con_duracion'},
+                'minutos_muertos': {'$sum': '$minutos_muertos'},
+            }},
+        ]))
+
+        campos = (
+            'total_reservas', 'reservas_medicas', 'reservas_no_medicas', 'reservas_am',
+            'reservas_pm', 'minutos_ocupados', 'reservas_con_duracion', 'minutos_muertos'
+        )
+        totales = {campo: sum(fila[campo] for fila in por_box) for campo in campos}
+        for fila in por_box:
+            fila['box_id'] = fila.pop('_id')
+        totales['por_box'] = por_box
+        return totales
@@ -0,0 +1,272 @@
+"""
+Almacén columnar de agendas para analítica
+Guarda las agendas de cada mes como arreglos NumPy (un .npy por columna)
+mapeados en memoria desde disco, para que dashboard y estadísticas lean
+rangos largos sin volver a escanear Agendabox
+"""
+from datetime import date, datetime
+from pathlib import Path
+import json
+import os
+import shutil
+import threading
+import time as reloj
+
+import numpy as np
+from django.conf import settings
+
+from ..models import Agendabox
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Columna -> (campo de Agendabox, dtype). Las horas van en minutos desde
+# medianoche (NaN si faltan) y los ids nulos como -1.
+COLUMNAS = {
+    'id': ('id', np.int64),
+    'box': ('idbox_id', np.int32),
+    'dia': ('fechaagenda', np.int32),
+    'inicio': ('horainicioagenda', np.float32),
+    'fin': ('horafinagenda', np.float32),
+    'es_medica': ('esMedica', np.int8),
+    'medico': ('idmedico_id', np.int32),
+    'habilitada': ('habilitada', np.int8),
+}
+
+
+def _minutos(hora):
+    return np.nan if hora is None else hora.hour * 60 + hora.minute + hora.second / 60
+
+
+def _meses(desde, hasta):
+    anio, mes = desde.year, desde.month
+    while (anio, mes) <= (hasta.year, hasta.month):
+        yield anio, mes
+        anio, mes = (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+
+
+def _vacias():
+    return {nombre: np.empty(0, dtype=dtype) for nombre, (_, dtype) in COLUMNAS.items()}
+
+
+def ordenar(columnas):
+    """Reordena las columnas por (box, dia, inicio, fin) en el lugar"""
+    orden = np.lexsort((columnas['fin'], columnas['inicio'], columnas['dia'], columnas['box']))
+    for nombre in columnas:
+        columnas[nombre] = columnas[nombre][orden]
+    return columnas
+
+
+class AlmacenColumnar:
+    """Particiones mensuales de agendas en formato columnar.
+
+    Cada partición vive en `<dir>/<AAAA-MM>-<generacion>/` con un .npy por
+    columna, ordenada por (box, dia, inicio, fin), y un puntero
+    `<dir>/<AAAA-MM>.json` que se reemplaza atómicamente al regenerarla; así
+    otros procesos nunca ven una partición a medio escribir y detectan la
+    nueva generación comparando el puntero. La generación reemplazada se
+    conserva hasta la siguiente regeneración, para que un proceso que leyó
+    el puntero anterior todavía pueda abrirla.
+
+    Las rutas de escritura marcan como sucios los meses que tocan (en el
+    puntero, para que lo vean todos los procesos) y la partición se regenera
+    con una consulta indexada en la siguiente lectura, fuera del lock (los
+    demás meses se siguen leyendo mientras tanto). Además vencen por tiempo,
+    más rápido los meses abiertos, para recoger escrituras que no pasaron
+    por CacheSignals.
+    """
+
+    def __init__(self, directorio=None):
+        self._directorio = directorio
+        self._lock = threading.Lock()
+        self._particiones = {}
+        self._sucias = set()
+        # Meses regenerándose en este proceso: los demás hilos esperan el evento
+        self._generando = {}
+        self.regeneraciones = 0
+
+    @property
+    def directorio(self):
+        directorio = self._directorio or getattr(
+            settings, 'ALMACEN_COLUMNAR_DIR', Path(settings.BASE_DIR) / 'almacen_columnar'
+        )
+        return Path(directorio)
+
+    def _vigencia(self, anio, mes):
+        hoy = date.today()
+        if (anio, mes) < (hoy.year, hoy.month):
+            return getattr(settings, 'ALMACEN_COLUMNAR_VIGENCIA_CERRADO', 86400)
+        return getattr(settings, 'ALMACEN_COLUMNAR_VIGENCIA_ABIERTO', 300)
+
+    # Lectura
+
+    def columnas(self, desde, hasta, box_ids=None):
+        """Columnas de las agendas con fecha en [desde, hasta], ordenadas por (box, dia, inicio, fin).
+
+        Devuelve un dict nombre -> ndarray; `dia` es el ordinal de la fecha.
+        """
+        desde = desde.date() if isinstance(desde, datetime) else desde
+        hasta = hasta.date() if isinstance(hasta, datetime) else hasta
+        if desde > hasta:
+            return _vacias()
+
+        partes = []
+        for anio, mes in _meses(desde, hasta):
+            particion = self.particion(anio, mes)
+            if len(particion['id']):
+                partes.append(particion)
+        if not partes:
+            return _vacias()
+
+        resultado = {nombre: np.concatenate([p[nombre] for p in partes]) for nombre in COLUMNAS}
+        mascara = (resultado['dia'] >= desde.toordinal()) & (resultado['dia'] <= hasta.toordinal())
+        if box_ids is not None:
+            mascara &= np.isin(resultado['box'], np.fromiter(box_ids, dtype=np.int32))
+        resultado = {nombre: valores[mascara] for nombre, valores in resultado.items()}
+        if len(partes) > 1:
+            ordenar(resultado)
+        return resultado
+
+    def particion(self, anio, mes):
+        """Columnas (mapeadas en memoria) del mes indicado, regenerándolo si hace falta"""
+        clave = (anio, mes)
+        while True:
+            with self._lock:
+                puntero = self._leer_puntero(anio, mes)
+                vigente = (
+                    puntero is not None
+                    and not puntero.get('sucia')
+                    and clave not in self._sucias
+                    and reloj.time() - puntero['generada_en'] <= self._vigencia(anio, mes)
+                )
+                if vigente:
+                    return self._cargar(clave, puntero)
+                generando = self._generando.get(clave)
+                if generando is None:
+                    generando = self._generando[clave] = threading.Event()
+                    # Lo que se invalide desde ahora vuelve a marcarlo
+                    self._sucias.discard(clave)
+                    break
+            generando.wait()
+
+        try:
+            puntero = self._generar(anio, mes)
+        finally:
+            with self._lock:
+                del self._generando[clave]
+            generando.set()
+        with self._lock:
+            return self._cargar(clave, puntero)
+
+    def _cargar(self, clave, puntero):
+        cargada = self._particiones.get(clave)
+        if cargada is None or cargada['generacion'] != puntero['generacion']:
+            cargada = {
+                'generacion': puntero['generacion'],
+                'columnas': self._abrir(puntero),
+            }
+            self._particiones[clave] = cargada
+        return cargada['columnas']
+
+    def _leer_puntero(self, anio, mes):
+        try:
+            with open(self.directorio / f"{anio:04d}-{mes:02d}.json") as archivo:
+                return json.load(archivo)
+        except (OSError, ValueError):
+            return None
+
+    def _escribir_puntero(self, anio, mes, puntero):
+        temporal = self.directorio / f"{anio:04d}-{mes:02d}.json.{os.getpid()}.{threading.get_ident()}"
+        with open(temporal, 'w') as archivo:
+            json.dump(puntero, archivo)
+        os.replace(temporal, self.directorio / f"{anio:04d}-{mes:02d}.json")
+
+    def _abrir(self, puntero):
+        if not puntero['filas']:
+            return _vacias()
+        carpeta = self.directorio / puntero['generacion']
+        return {
+            nombre: np.load(carpeta / f"{nombre}.npy", mmap_mode='r')
+            for nombre in COLUMNAS
+        }
+
+    # Escritura
+
+    def _generar(self, anio, mes):
+        """Reescribe la partición del mes desde Agendabox y publica el nuevo puntero"""
+        inicio = reloj.perf_counter()
+        consultado_en = reloj.time()
+        primero = date(anio, mes, 1)
+        siguiente = date(anio + 1, 1, 1) if mes == 12 else date(anio, mes + 1, 1)
+        filas = list(Agendabox.objects.filter(
+            fechaagenda__gte=primero, fechaagenda__lt=siguiente
+        ).values_list(*(campo for campo, _ in COLUMNAS.values())))
+
+        columnas = {}
+        for posicion, (nombre, (_, dtype)) in enumerate(COLUMNAS.items()):
+            valores = [fila[posicion] for fila in filas]
+            if nombre == 'dia':
+                valores = [fecha.toordinal() for fecha in valores]
+            elif nombre in ('inicio', 'fin'):
+                valores = [_minutos(hora) for hora in valores]
+            elif nombre == 'medico':
+                valores = [-1 if valor is None else valor for valor in valores]
+            columnas[nombre] = np.array(valores, dtype=dtype)
+        ordenar(columnas)
+
+        directorio = self.directorio
+        directorio.mkdir(parents=True, exist_ok=True)
+        generacion = f"{anio:04d}-{mes:02d}-{reloj.time_ns()}"
+        carpeta = directorio / generacion
+        carpeta.mkdir()
+        for nombre, valores in columnas.items():
+            np.save(carpeta / f"{nombre}.npy", valores)
+
+        anterior = self._leer_puntero(anio, mes)
+        puntero = {'generacion': generacion, 'filas': len(filas), 'generada_en': reloj.time()}
+        if anterior and anterior.get('sucia_en', 0) >= consultado_en:
+            # Alguien escribió en el mes mientras se consultaba: la nueva ya nace sucia
+            puntero.update(sucia=True, sucia_en=anterior['sucia_en'])
+        self._escribir_puntero(anio, mes, puntero)
+
+        # Se conservan la nueva generación y la que acaba de reemplazar (puede
+        # haber un lector entre _leer_puntero y np.load); las más viejas ya no
+        # las apunta nadie. Los mapas ya abiertos siguen siendo válidos.
+        conservar = {generacion, anterior['generacion'] if anterior else None}
+        for carpeta_vieja in directorio.glob(f"{anio:04d}-{mes:02d}-*"):
+            if carpeta_vieja.is_dir() and carpeta_vieja.name not in conservar:
+                shutil.rmtree(carpeta_vieja, ignore_errors=True)
+
+        self.regeneraciones += 1
+        logger.debug(
+            f"Partición columnar {anio:04d}-{mes:02d} regenerada: {len(filas)} agendas "
+            f"en {(reloj.perf_counter() - inicio) * 1000:.1f}ms"
+        )
+        return puntero
+
+    def invalidar(self, fechas=None, motivo=None):
+        """Marca como sucios los meses de las fechas dadas (todos si no se indican)"""
+        with self._lock:
+            if fechas is None:
+                meses = {tuple(int(p) for p in ruta.stem.split('-')) for ruta in self.directorio.glob('*.json')}
+                meses.update(self._particiones)
+            else:
+                meses = {(f.year, f.month) for f in fechas if f is not None}
+            self._sucias.update(meses)
+            for anio, mes in meses:
+                puntero = self._leer_puntero(anio, mes)
+                if puntero:
+                    self._escribir_puntero(anio, mes, dict(puntero, sucia=True, sucia_en=reloj.time()))
+        logger.debug(f"Almacén columnar invalidado ({motivo})")
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                'particiones_cargadas': len(self._particiones),
+                'particiones_sucias': len(self._sucias),
+                'regeneraciones': self.regeneraciones,
+                'directorio': str(self.directorio),
+            }
+
+
+almacen_columnar = AlmacenColumnar()
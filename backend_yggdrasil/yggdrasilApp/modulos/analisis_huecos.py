@@ -0,0 +1,123 @@
+"""
+Análisis de huecos (horas muertas) entre agendas
+Calcula los tiempos ociosos de cada box dentro de cada día con arreglos
+NumPy ordenados y los resume en distribuciones por box y por pasillo
+"""
+from datetime import date
+
+import numpy as np
+
+from .almacen_columnar import almacen_columnar
+from .cache_referencia import snapshot_boxes
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def huecos_por_dia(columnas):
+    """Huecos ociosos entre agendas del mismo box y día.
+
+    Las columnas deben venir ordenadas por (box, dia, inicio). El hueco se
+    mide desde el mayor fin visto hasta ese momento, así una agenda larga que
+    cubre a otras no genera huecos falsos. Nunca cruza de un día al
+    siguiente. Devuelve (box, dia, minutos) como arreglos paralelos.
+    """
+    inicio = columnas['inicio'].astype(float)
+    fin = columnas['fin'].astype(float)
+    completas = ~(np.isnan(inicio) | np.isnan(fin))
+    box = columnas['box'][completas].astype(np.int64)
+    dia = columnas['dia'][completas].astype(np.int64)
+    inicio, fin = inicio[completas], fin[completas]
+    if len(inicio) < 2:
+        vacio = np.empty(0, dtype=np.int64)
+        return vacio, vacio, np.empty(0, dtype=float)
+
+    nuevo_grupo = np.ones(len(inicio), dtype=bool)
+    nuevo_grupo[1:] = (box[1:] != box[:-1]) | (dia[1:] != dia[:-1])
+
+    # Máximo acumulado de fin dentro de cada (box, dia), desplazando cada grupo
+    numero_grupo = np.cumsum(nuevo_grupo)
+    fin_maximo = np.maximum.accumulate(numero_grupo * 2000.0 + fin) - numero_grupo * 2000.0
+
+    huecos = inicio[1:] - fin_maximo[:-1]
+    validos = ~nuevo_grupo[1:] & (huecos > 0)
+    return box[1:][validos], dia[1:][validos], huecos[validos]
+
+
+def distribucion(claves, valores):
+    """Total, media, p90 y cantidad de `valores` agrupados por `claves` (enteras).
+
+    Ordena una vez por (clave, valor) y saca cada percentil con la misma
+    interpolación lineal que np.percentile, sin recorrer grupo por grupo.
+    """
+    if not len(valores):
+        return {}
+    orden = np.lexsort((valores, claves))
+    claves, valores = claves[orden], valores[orden]
+    unicas, inicios, cantidades = np.unique(claves, return_index=True, return_counts=True)
+
+    totales = np.add.reduceat(valores, inicios)
+    posicion = inicios + 0.9 * (cantidades - 1)
+    bajo = np.floor(posicion).astype(np.int64)
+    alto = np.ceil(posicion).astype(np.int64)
+    p90 = valores[bajo] + (valores[alto] - valores[bajo]) * (posicion - bajo)
+
+    return {
+        clave: {
+            'total_minutos': round(float(total), 2),
+            'media': round(float(total / cantidad), 2),
+            'p90': round(float(percentil), 2),
+            'huecos': int(cantidad),
+        }
+        for clave, total, cantidad, percentil in zip(unicas.tolist(), totales, cantidades, p90)
+    }
+
+
+def _resumen(valores):
+    if not len(valores):
+        return {'total_minutos': 0, 'media': 0, 'p90': 0, 'huecos': 0}
+    return {
+        'total_minutos': round(float(valores.sum()), 2),
+        'media': round(float(valores.mean()), 2),
+        'p90': round(float(np.percentile(valores, 90)), 2),
+        'huecos': int(len(valores)),
+    }
+
+
+def analizar_huecos(desde, hasta, pasillo=None):
+    """Distribución de huecos del rango: global, por box, por pasillo y total por día"""
+    pasillos = {box['idbox']: box['pasillobox'] for box in snapshot_boxes.obtener()[0]}
+    box_ids = None
+    if pasillo:
+        box_ids = [box_id for box_id, nombre in pasillos.items() if nombre == pasillo]
+
+    box, dia, minutos = huecos_por_dia(almacen_columnar.columnas(desde, hasta, box_ids))
+
+    por_box = distribucion(box, minutos)
+
+    nombres_pasillo, codigo_pasillo = np.unique(
+        np.array([pasillos.get(b) or '' for b in box.tolist()], dtype=str), return_inverse=True
+    )
+    por_pasillo = distribucion(codigo_pasillo.astype(np.int64), minutos)
+
+    dias, posicion_dia = np.unique(dia, return_inverse=True)
+    total_dia = np.bincount(posicion_dia, weights=minutos) if len(dias) else []
+
+    return {
+        'desde': desde,
+        'hasta': hasta,
+        'pasillo': pasillo,
+        **_resumen(minutos),
+        'por_box': [
+            dict(idbox=box_id, pasillo=pasillos.get(box_id), **datos)
+            for box_id, datos in por_box.items()
+        ],
+        'por_pasillo': [
+            dict(pasillo=str(nombres_pasillo[codigo]) or None, **datos)
+            for codigo, datos in por_pasillo.items()
+        ],
+        'por_dia': [
+            {'fecha': date.fromordinal(int(d)), 'total_minutos': round(float(total), 2)}
+            for d, total in zip(dias, total_dia)
+        ],
+    }
@@ -0,0 +1,369 @@
+"""
+Cache de dos niveles compartido entre procesos
+Un LRU en memoria de cada proceso delante de Redis. Los valores se guardan en
+Redis serializados con msgpack bajo claves versionadas por espacio, y las
+invalidaciones se avisan por pub/sub a todos los workers de Daphne
+"""
+from collections import OrderedDict
+from datetime import date, datetime, time
+from decimal import Decimal
+import threading
+import time as reloj
+import uuid
+
+import msgpack
+import redis
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+CANAL_INVALIDACIONES = 'ygg:invalidaciones'
+
+
+class RedisEnPausa(redis.ConnectionError):
+    """Redis no se consulta hasta que vence la pausa tras un error de conexión"""
+
+
+def _a_msgpack(valor):
+    if isinstance(valor, (datetime, date, time)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return float(valor)
+    if hasattr(valor, 'item'):
+        # Escalares de NumPy
+        return valor.item()
+    raise TypeError(f"Tipo no serializable en el cache distribuido: {type(valor).__name__}")
+
+
+def serializar(valor):
+    return msgpack.packb(valor, default=_a_msgpack, use_bin_type=True)
+
+
+def deserializar(datos):
+    return msgpack.unpackb(datos, raw=False)
+
+
+class CacheDistribuido:
+    """LRU en proceso (nivel 1) delante de Redis (nivel 2).
+
+    Cada espacio ('dashboard', ...) tiene una versión en Redis que forma
+    parte de las claves: `invalidar(espacio)` la incrementa y deja huérfano
+    todo lo anterior sin recorrer claves; `invalidar(espacio, claves)` borra
+    sólo esas. En ambos casos se publica el cambio y cada proceso descarta
+    su nivel 1 al recibirlo. Mientras la suscripción no está activa la
+    versión se lee de Redis en cada consulta. Si Redis no responde el cache
+    sigue funcionando sólo con el nivel 1: tras un error de conexión no se
+    vuelve a intentar durante `CACHE_DISTRIBUIDO_PAUSA_REDIS` segundos, así
+    las lecturas no pagan el timeout de la conexión una y otra vez.
+    """
+
+    def __init__(self, url=None, maximo_l1=None, ttl_l1=None):
+        self._url = url
+        self._maximo_l1 = maximo_l1
+        self._ttl_l1 = ttl_l1
+        self._cliente = None
+        self._sin_redis_hasta = 0.0
+        self._lock = threading.Lock()
+        self._l1 = OrderedDict()
+        self._versiones = {}
+        self._suscrito = False
+        self._hilo = None
+        self._stats = {
+            'aciertos_l1': 0,
+            'aciertos_l2': 0,
+            'fallos': 0,
+            'escrituras': 0,
+            'invalidaciones': 0,
+            'invalidaciones_recibidas': 0,
+            'errores_redis': 0,
+            'omitidas_redis': 0,
+        }
+
+    @property
+    def url(self):
+        return self._url or getattr(settings, 'CACHE_DISTRIBUIDO_URL', 'redis://localhost:6379/1')
+
+    @property
+    def maximo_l1(self):
+        if self._maximo_l1 is not None:
+            return self._maximo_l1
+        return getattr(settings, 'CACHE_DISTRIBUIDO_L1_MAX', 256)
+
+    @property
+    def ttl_l1(self):
+        if self._ttl_l1 is not None:
+            return self._ttl_l1
+        return getattr(settings, 'CACHE_DISTRIBUIDO_L1_TTL', 30)
+
+    @property
+    def cliente(self):
+        if self._cliente is None:
+            self._cliente = redis.Redis.from_url(self.url, socket_timeout=1, socket_connect_timeout=1)
+        return self._cliente
+
+    @property
+    def pausa_redis(self):
+        return getattr(settings, 'CACHE_DISTRIBUIDO_PAUSA_REDIS', 10)
+
+    def _redis(self):
+        """Cliente de Redis, o RedisEnPausa si hace poco que no respondió"""
+        if reloj.monotonic() < self._sin_redis_hasta:
+            raise RedisEnPausa('Redis en pausa tras un error de conexión')
+        return self.cliente
+
+    @staticmethod
+    def _clave_version(espacio):
+        return f'ygg:{espacio}:version'
+
+    @staticmethod
+    def _clave_redis(espacio, version, clave):
+        return f'ygg:{espacio}:v{version}:{clave}'
+
+    def _error_redis(self, operacion, error):
+        if isinstance(error, RedisEnPausa):
+            with self._lock:
+                self._stats['omitidas_redis'] += 1
+            return
+        with self._lock:
+            self._stats['errores_redis'] += 1
+            if isinstance(error, (redis.ConnectionError, redis.TimeoutError)):
+                self._sin_redis_hasta = reloj.monotonic() + self.pausa_redis
+        logger.warning(f"Cache distribuido sin Redis en {operacion}: {error}")
+
+    def _version(self, espacio):
+        with self._lock:
+            if self._suscrito and espacio in self._versiones:
+                return self._versiones[espacio]
+        version = int(self._redis().get(self._clave_version(espacio)) or 0)
+        with self._lock:
+            self._versiones[espacio] = version
+        return version
+
+    # Nivel 1
+
+    def _l1_obtener(self, espacio, clave):
+        with self._lock:
+            entrada = self._l1.get((espacio, clave))
+            if entrada is None:
+                return None
+            valor, version, guardado_en = entrada
+            if version != self._versiones.get(espacio) or reloj.monotonic() - guardado_en > self.ttl_l1:
+                del self._l1[(espacio, clave)]
+                return None
+            self._l1.move_to_end((espacio, clave))
+            return valor
+
+    def _l1_guardar(self, espacio, clave, valor, version):
+        with self._lock:
+            self._l1[(espacio, clave)] = (valor, version, reloj.monotonic())
+            self._l1.move_to_end((espacio, clave))
+            while len(self._l1) > self.maximo_l1:
+                self._l1.popitem(last=False)
+
+    def _l1_descartar(self, espacio, clave=None):
+        with self._lock:
+            if clave is not None:
+                self._l1.pop((espacio, clave), None)
+                return
+            for llave in [llave for llave in self._l1 if llave[0] == espacio]:
+                del self._l1[llave]
+
+    # API
+
+    def obtener(self, espacio, clave):
+        """Valor guardado o None"""
+        self._asegurar_suscripcion()
+        try:
+            version = self._version(espacio)
+            disponible = True
+        except redis.RedisError as e:
+            self._error_redis('obtener', e)
+            version = self._versiones.get(espacio)
+            disponible = False
+
+        valor = self._l1_obtener(espacio, clave)
+        if valor is not None:
+            with self._lock:
+                self._stats['aciertos_l1'] += 1
+            return valor
+
+        datos = None
+        if disponible:
+            try:
+                datos = self._redis().get(self._clave_redis(espacio, version, clave))
+            except redis.RedisError as e:
+                self._error_redis('obtener', e)
+        if datos is None:
+            with self._lock:
+                self._stats['fallos'] += 1
+            return None
+
+        valor = deserializar(datos)
+        self._l1_guardar(espacio, clave, valor, version)
+        with self._lock:
+            self._stats['aciertos_l2'] += 1
+        return valor
+
+    def guardar(self, espacio, clave, valor, ttl):
+        """Guarda el valor en ambos niveles; en Redis vence a los `ttl` segundos"""
+        self._asegurar_suscripcion()
+        ttl = max(1, int(ttl))
+        datos = serializar(valor)
+        version = self._versiones.get(espacio)
+        try:
+            version = self._version(espacio)
+            self._redis().set(self._clave_redis(espacio, version, clave), datos, ex=ttl)
+        except redis.RedisError as e:
+            self._error_redis('guardar', e)
+        # En el nivel 1 se guarda la copia deserializada, igual a la que devolvería Redis
+        self._l1_guardar(espacio, clave, deserializar(datos), version)
+        with self._lock:
+            self._stats['escrituras'] += 1
+
+    def invalidar(self, espacio, claves=None, motivo=None):
+        """Invalida un espacio completo (nueva versión) o sólo algunas claves, en todos los procesos"""
+        with self._lock:
+            self._stats['invalidaciones'] += 1
+        try:
+            if claves is None:
+                version = self._redis().incr(self._clave_version(espacio))
+                with self._lock:
+                    self._versiones[espacio] = version
+                self._l1_descartar(espacio)
+                self._redis().publish(CANAL_INVALIDACIONES, f'{espacio}|v|{version}')
+            else:
+                version = self._version(espacio)
+                claves = list(claves)
+                if claves:
+                    self._redis().delete(*[self._clave_redis(espacio, version, clave) for clave in claves])
+                for clave in claves:
+                    self._l1_descartar(espacio, clave)
+                    self._redis().publish(CANAL_INVALIDACIONES, f'{espacio}|k|{clave}')
+        except redis.RedisError as e:
+            self._error_redis('invalidar', e)
+            self._l1_descartar(espacio)
+        logger.debug(f"Cache distribuido '{espacio}' invalidado ({motivo})")
+
+    # Locks entre procesos
+
+    @staticmethod
+    def _clave_lock(nombre):
+        return f'ygg:lock:{nombre}'
+
+    def adquirir_lock(self, nombre, ttl):
+        """Toma el lock `nombre` por `ttl` segundos (SET NX PX).
+
+        Devuelve el token con el que se renueva o libera, o None si otro
+        proceso lo tiene. Sin Redis no hay con quién coordinar: se devuelve
+        un token local y cada proceso sigue por su cuenta.
+        """
+        token = uuid.uuid4().hex
+        try:
+            if self._redis().set(self._clave_lock(nombre), token, nx=True, px=int(ttl * 1000)):
+                return token
+            return None
+        except redis.RedisError as e:
+            self._error_redis('adquirir_lock', e)
+            return token
+
+    def _si_es_propio(self, nombre, token, operacion):
+        clave = self._clave_lock(nombre)
+        try:
+            with self._redis().pipeline() as pipe:
+                pipe.watch(clave)
+                actual = pipe.get(clave)
+                if actual is None or actual.decode() != token:
+                    return False
+                pipe.multi()
+                operacion(pipe, clave)
+                pipe.execute()
+                return True
+        except redis.WatchError:
+            return False
+        except redis.RedisError as e:
+            self._error_redis('lock', e)
+            return False
+
+    def renovar_lock(self, nombre, token, ttl):
+        """Extiende el lock si sigue siendo de `token`; False si se perdió"""
+        return self._si_es_propio(nombre, token, lambda pipe, clave: pipe.pexpire(clave, int(ttl * 1000)))
+
+    def liberar_lock(self, nombre, token):
+        """Libera el lock sólo si sigue siendo de `token`"""
+        return self._si_es_propio(nombre, token, lambda pipe, clave: pipe.delete(clave))
+
+    def lock_tomado(self, nombre):
+        try:
+            return bool(self._redis().exists(self._clave_lock(nombre)))
+        except redis.RedisError as e:
+            self._error_redis('lock_tomado', e)
+            return False
+
+    def estadisticas(self):
+        with self._lock:
+            lecturas = self._stats['aciertos_l1'] + self._stats['aciertos_l2'] + self._stats['fallos']
+            aciertos = self._stats['aciertos_l1'] + self._stats['aciertos_l2']
+            return dict(
+                self._stats,
+                tamano_l1=len(self._l1),
+                maximo_l1=self.maximo_l1,
+                suscrito=self._suscrito,
+                redis_en_pausa=reloj.monotonic() < self._sin_redis_hasta,
+                versiones=dict(self._versiones),
+                tasa_aciertos=round(aciertos / lecturas * 100, 2) if lecturas else 0.0,
+            )
+
+    # Pub/sub
+
+    def _asegurar_suscripcion(self):
+        if self._hilo is not None and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._escuchar, daemon=True, name='cache-distribuido')
+                self._hilo.start()
+
+    def _escuchar(self):
+        espera = 1.0
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.cliente.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CANAL_INVALIDACIONES)
+                # Lo ocurrido antes de suscribirse no se recibió: releer versiones
+                with self._lock:
+                    self._versiones.clear()
+                    self._l1.clear()
+                    self._suscrito = True
+                espera = 1.0
+                while True:
+                    mensaje = pubsub.get_message(timeout=5.0)
+                    if mensaje and mensaje['type'] == 'message':
+                        self._recibir(mensaje['data'])
+            except Exception as e:
+                logger.warning(f"Suscripción del cache distribuido interrumpida: {e}")
+            finally:
+                with self._lock:
+                    self._suscrito = False
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            reloj.sleep(espera)
+            espera = min(espera * 2, 30.0)
+
+    def _recibir(self, datos):
+        espacio, tipo, valor = datos.decode().split('|', 2)
+        with self._lock:
+            self._stats['invalidaciones_recibidas'] += 1
+        if tipo == 'v':
+            with self._lock:
+                self._versiones[espacio] = max(int(valor), self._versiones.get(espacio, 0))
+            self._l1_descartar(espacio)
+        else:
+            self._l1_descartar(espacio, valor)
+
+
+cache_distribuido = CacheDistribuido()
@@ -2,8 +2,13 @@
 Sistema de gestión automática del cache del dashboard
 Se invalida automáticamente cuando hay cambios en agendas
 """
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import threading
+import time as reloj
+from django.conf import settings
 from django.core.cache import cache
+from django.utils import timezone
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 import logging
@@ -22,8 +27,14 @@ class CacheManager:
     }
     
     @staticmethod
-    def invalidar_cache_dashboard(motivo="cambio_agenda", detalles=None):
-        """Invalida el cache del dashboard y programa regeneración"""
+    def invalidar_cache_dashboard(motivo="cambio_agenda", detalles=None, pares=None):
+        """Invalida el cache del dashboard y programa regeneración.
+        
+        Si se indican los pares (box_id, fecha) afectados, se refrescan sólo
+        esos agregados y se invalidan sólo los caches cuyo rango los incluye;
+        sin pares se invalida todo como antes. El almacén columnar marca como
+        sucios los mismos meses.
+        """
         try:
             logger.info(f"Invalidando cache del dashboard. Motivo: {motivo}")
             
@@ -31,23 +42,78 @@ class CacheManager:
             for key in CacheManager.CACHE_KEYS.values():
                 cache.delete(key)
             
-            # Invalidar cache en MongoDB
+            # Las recomendaciones de Mimir guardadas dependen de las agendas
+            from .trabajos_mimir import invalidar_resultados
+            invalidar_resultados(motivo)
+            
             from ..mongo_models import DashboardCache
-            DashboardCache.objects(expires_at__gt=datetime.now()).update(
-                set__expires_at=datetime.now() - timedelta(seconds=1)
-            )
+            from .almacen_columnar import almacen_columnar
+            vigentes = DashboardCache.objects(expires_at__gt=datetime.now())
+            objetivos = None
+            
+            if pares:
+                pares = CacheManager._normalizar_pares(pares)
+            
+            if pares:
+                # Aplicar el cambio a los agregados por (box, fecha)
+                from .aggregation_service import ServicioAgregados
+                ServicioAgregados.refrescar_buckets(pares)
+                
+                fechas = [fecha for _, fecha in pares if fecha is not None]
+                almacen_columnar.invalidar(fechas, motivo)
+                if fechas:
+                    vigentes = vigentes.filter(
+                        fecha_inicio__lte=max(fechas),
+                        fecha_fin__gte=min(fechas)
+                    )
+                    objetivos = [
+                        (c.periodo, c.fecha_inicio.date())
+                        for c in vigentes.only('periodo', 'fecha_inicio')
+                    ]
+            else:
+                almacen_columnar.invalidar(motivo=motivo)
+            
+            # Invalidar cache en MongoDB
+            vigentes.update(set__expires_at=datetime.now() - timedelta(seconds=1))
+            
+            # Invalidar el cache distribuido en todos los workers
+            from .cache_distribuido import cache_distribuido
+            from .dashboard_optimizer import DashboardCacheService
+            if objetivos is not None:
+                claves = [DashboardCacheService.clave_cache(p, f) for p, f in objetivos]
+                cache_distribuido.invalidar(DashboardCacheService.ESPACIO, claves, motivo)
+            else:
+                cache_distribuido.invalidar(DashboardCacheService.ESPACIO, motivo=motivo)
             
             # Notificar por WebSocket que el dashboard necesita actualizarse
             CacheManager._notificar_invalidacion_cache()
             
             # Programar regeneración asíncrona del cache
-            CacheManager._programar_regeneracion_cache()
+            CacheManager._programar_regeneracion_cache(objetivos)
             
             logger.info("Cache invalidado correctamente")
             
         except Exception as e:
             logger.error(f"Error invalidando cache: {str(e)}")
     
+    @staticmethod
+    def _normalizar_pares(pares):
+        """Pares (box_id, fecha) con la fecha como date.
+        
+        En modo polling las agendas llegan con la fecha como texto
+        'YYYY-MM-DD'. Si alguna no se puede interpretar se devuelve None y se
+        invalida todo.
+        """
+        from .indice_agendas import normalizar_fecha
+        try:
+            return {
+                (box_id, normalizar_fecha(fecha) if fecha is not None else None)
+                for box_id, fecha in pares
+            }
+        except ValueError as e:
+            logger.warning(f"Pares de invalidación inválidos, se invalida todo: {str(e)}")
+            return None
+    
     @staticmethod
     def _notificar_invalidacion_cache():
         """Notifica via WebSocket que el cache fue invalidado"""
@@ -68,40 +134,34 @@ class CacheManager:
             logger.error(f"Error enviando notificación WebSocket: {str(e)}")
     
     @staticmethod
-    def _programar_regeneracion_cache():
-        """Programa la regeneración del cache de forma asíncrona"""
+    def _programar_regeneracion_cache(objetivos=None):
+        """Encola la regeneración del cache en el planificador.
+        
+        `objetivos` es una lista de (periodo, fecha_referencia); por defecto
+        se regeneran día, semana, mes y año actuales.
+        """
         try:
-            # Importar aquí para evitar circular imports
-            from ..modulos.dashboard_optimizer import DashboardOptimizer
-            import threading
-            
-            def regenerar_cache():
-                """Regenera el cache en background"""
-                try:
-                    periodos = ['day', 'week', 'month']
-                    for periodo in periodos:
-                        DashboardOptimizer.precalcular_dashboard(periodo)
-                        logger.info(f"Cache regenerado para período: {periodo}")
-                except Exception as e:
-                    logger.error(f"Error regenerando cache: {str(e)}")
-            
-            # Ejecutar en hilo separado para no bloquear
-            thread = threading.Thread(target=regenerar_cache, daemon=True)
-            thread.start()
-            
+            if objetivos is None:
+                objetivos = [(periodo, None) for periodo in ['day', 'week', 'month', 'year']]
+            for periodo, fecha_referencia in objetivos:
+                planificador_regeneracion.programar(periodo, fecha_referencia)
         except Exception as e:
             logger.error(f"Error programando regeneración: {str(e)}")
     
     @staticmethod
     def obtener_cache_valido(periodo='week'):
-        """Obtiene cache válido o None si no existe/expiró"""
+        """Obtiene el cache válido de la ventana actual del período o None si no existe/expiró"""
         try:
-            from ..mongo_models import DashboardCache
+            from ..mongo_models import DashboardCache, VERSION_DASHBOARD_CACHE
+            from .dashboard_optimizer import DashboardOptimizer
             
+            fecha_inicio = DashboardOptimizer._calcular_rango_fechas(periodo, timezone.now().date())[0]
             cache_obj = DashboardCache.objects(
                 periodo=periodo,
+                fecha_inicio=fecha_inicio,
+                version=VERSION_DASHBOARD_CACHE,
                 expires_at__gt=datetime.now()
-            ).order_by('-created_at').first()
+            ).exclude('respuesta_json', 'respuesta_gzip', 'respuesta_br').first()
             
             return cache_obj
             
@@ -127,6 +187,164 @@ class CacheManager:
             return True
 
 
+class PlanificadorRegeneracion:
+    """Planificador único para regenerar el cache del dashboard en segundo plano.
+    
+    Las invalidaciones se agrupan por (periodo, fecha_inicio): mientras llegan
+    nuevas dentro de la ventana de debounce el trabajo pendiente se posterga
+    (hasta un máximo de espera) en lugar de encolar otro. Un hilo despachador
+    entrega los trabajos vencidos a un pool acotado y nunca corre dos veces el
+    mismo período a la vez; si al ejecutarse el cache ya fue regenerado después
+    de la última invalidación, el trabajo se descarta.
+    """
+    
+    def __init__(self, debounce=None, max_espera=None, max_workers=None):
+        self.debounce = debounce if debounce is not None else getattr(
+            settings, 'CACHE_REGENERACION_DEBOUNCE', 2.0)
+        self.max_espera = max_espera if max_espera is not None else getattr(
+            settings, 'CACHE_REGENERACION_MAX_ESPERA', 10.0)
+        self.max_workers = max_workers or getattr(settings, 'CACHE_REGENERACION_WORKERS', 2)
+        self._cond = threading.Condition()
+        self._pendientes = {}
+        self._en_ejecucion = set()
+        self._pool = None
+        self._hilo = None
+        self._stats = {
+            'solicitudes': 0,
+            'ejecuciones': 0,
+            'omitidas': 0,
+            'errores': 0,
+            'ultima_ejecucion': None,
+        }
+    
+    @staticmethod
+    def _clave(periodo, fecha_referencia):
+        from ..modulos.dashboard_optimizer import DashboardOptimizer
+        if fecha_referencia is None:
+            fecha_referencia = timezone.now().date()
+        fecha_inicio, _, _ = DashboardOptimizer._calcular_rango_fechas(periodo, fecha_referencia)
+        return (periodo, fecha_inicio)
+    
+    def programar(self, periodo, fecha_referencia=None, inmediato=False):
+        """Registra una invalidación; se ejecuta una sola regeneración por ventana.
+        
+        Con `inmediato` (un lector está recibiendo datos obsoletos) no se
+        espera el debounce. Si el período ya se está regenerando no se encola
+        otra regeneración.
+        """
+        clave = self._clave(periodo, fecha_referencia)
+        ahora = reloj.monotonic()
+        with self._cond:
+            self._stats['solicitudes'] += 1
+            pendiente = self._pendientes.get(clave)
+            if inmediato and (pendiente or clave in self._en_ejecucion):
+                self._stats['omitidas'] += 1
+                if pendiente:
+                    pendiente['vence'] = ahora
+                    self._cond.notify_all()
+                return
+            espera = 0 if inmediato else self.debounce
+            if pendiente:
+                # Coalescer: la regeneración ya encolada cubrirá este cambio
+                self._stats['omitidas'] += 1
+                pendiente['vence'] = min(ahora + espera, pendiente['primera'] + self.max_espera)
+                pendiente['solicitada_en'] = datetime.now()
+            else:
+                self._pendientes[clave] = {
+                    'primera': ahora,
+                    'vence': ahora + espera,
+                    'solicitada_en': datetime.now(),
+                }
+            self._asegurar_hilo()
+            self._cond.notify_all()
+    
+    def _asegurar_hilo(self):
+        if self._hilo is None or not self._hilo.is_alive():
+            self._pool = self._pool or ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix='regeneracion-cache'
+            )
+            self._hilo = threading.Thread(target=self._despachar, daemon=True)
+            self._hilo.start()
+    
+    def _despachar(self):
+        while True:
+            with self._cond:
+                while True:
+                    ahora = reloj.monotonic()
+                    candidatos = [
+                        (pendiente['vence'], clave)
+                        for clave, pendiente in self._pendientes.items()
+                        if clave not in self._en_ejecucion
+                    ]
+                    espera = None
+                    if candidatos and len(self._en_ejecucion) < self.max_workers:
+                        vence, clave = min(candidatos)
+                        if vence <= ahora:
+                            break
+                        espera = vence - ahora
+                    self._cond.wait(espera)
+                pendiente = self._pendientes.pop(clave)
+                self._en_ejecucion.add(clave)
+            self._pool.submit(self._ejecutar, clave, pendiente['solicitada_en'])
+    
+    def _ejecutar(self, clave, solicitada_en):
+        periodo, fecha_inicio = clave
+        try:
+            from ..modulos.dashboard_optimizer import DashboardCacheService
+            from ..mongo_models import DashboardCache, VERSION_DASHBOARD_CACHE
+            
+            # Otro proceso o una lectura ya lo regeneró con datos posteriores al
+            # último cambio: created_at es el inicio del cálculo (consulta
+            # cubierta por el índice de vigencia)
+            if DashboardCache.objects(
+                periodo=periodo,
+                fecha_inicio=fecha_inicio,
+                version=VERSION_DASHBOARD_CACHE,
+                expires_at__gt=datetime.now(),
+                created_at__gte=solicitada_en
+            ).only('created_at').exclude('id').as_pymongo().first():
+                with self._cond:
+                    self._stats['omitidas'] += 1
+                return
+            
+            # Forzado: el documento vigente puede venir de un cálculo que empezó
+            # antes de la invalidación
+            resultado = DashboardCacheService.calcular(periodo, fecha_inicio, forzar=True)
+            with self._cond:
+                if resultado is None:
+                    self._stats['errores'] += 1
+                else:
+                    self._stats['ejecuciones'] += 1
+                    self._stats['ultima_ejecucion'] = datetime.now().isoformat()
+            logger.info(f"Cache regenerado para período: {periodo} ({fecha_inicio})")
+        except Exception as e:
+            with self._cond:
+                self._stats['errores'] += 1
+            logger.error(f"Error regenerando cache: {str(e)}")
+        finally:
+            with self._cond:
+                self._en_ejecucion.discard(clave)
+                self._cond.notify_all()
+    
+    def estadisticas(self):
+        """Estado del planificador para monitoreo"""
+        with self._cond:
+            return dict(
+                self._stats,
+                en_cola=len(self._pendientes),
+                en_ejecucion=len(self._en_ejecucion),
+                pendientes=[
+                    {'periodo': periodo, 'fecha_inicio': fecha_inicio.isoformat()}
+                    for periodo, fecha_inicio in self._pendientes
+                ],
+                debounce_segundos=self.debounce,
+                max_workers=self.max_workers,
+            )
+
+
+planificador_regeneracion = PlanificadorRegeneracion()
+
+
 class CacheSignals:
     """Señales para invalidación automática del cache"""
     
@@ -140,41 +358,51 @@ class CacheSignals:
                 'box_id': agenda_obj.idbox_id,
                 'fecha': agenda_obj.fechaagenda.isoformat() if agenda_obj.fechaagenda else None,
                 'es_medica': agenda_obj.esMedica
-            }
+            },
+            pares={(agenda_obj.idbox_id, agenda_obj.fechaagenda)}
         )
     
     @staticmethod
     def agenda_modificada(agenda_obj, **kwargs):
-        """Cuando se modifica una agenda existente"""
+        """Cuando se modifica una agenda existente (box_anterior/fecha_anterior si se movió)"""
+        pares = {(agenda_obj.idbox_id, agenda_obj.fechaagenda)}
+        if kwargs.get('box_anterior') is not None and kwargs.get('fecha_anterior') is not None:
+            pares.add((kwargs['box_anterior'], kwargs['fecha_anterior']))
         CacheManager.invalidar_cache_dashboard(
             motivo="agenda_modificada",
             detalles={
                 'agenda_id': agenda_obj.id,
                 'box_id': agenda_obj.idbox_id,
                 'cambios': kwargs.get('cambios', {})
-            }
+            },
+            pares=pares
         )
     
     @staticmethod
-    def agenda_eliminada(agenda_id, box_id, **kwargs):
+    def agenda_eliminada(agenda_id, box_id, fecha=None, **kwargs):
         """Cuando se elimina una agenda"""
         CacheManager.invalidar_cache_dashboard(
             motivo="agenda_eliminada",
             detalles={
                 'agenda_id': agenda_id,
                 'box_id': box_id
-            }
+            },
+            pares={(box_id, fecha)} if fecha is not None else None
         )
     
     @staticmethod
-    def bulk_agendas_creadas(cantidad_agendas, **kwargs):
-        """Cuando se crean múltiples agendas (desde thread externo)"""
+    def bulk_agendas_creadas(cantidad_agendas, agendas=None, **kwargs):
+        """Cuando se crean múltiples agendas (desde thread externo o simulador)"""
+        pares = None
+        if agendas:
+            pares = {(agenda.idbox_id, agenda.fechaagenda) for agenda in agendas}
         CacheManager.invalidar_cache_dashboard(
             motivo="bulk_agendas_thread",
             detalles={
                 'cantidad': cantidad_agendas,
-                'fuente': 'thread_externo'
-            }
+                'fuente': kwargs.get('fuente', 'thread_externo')
+            },
+            pares=pares
         )
     
     @staticmethod
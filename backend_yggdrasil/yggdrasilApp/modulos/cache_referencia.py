@@ -0,0 +1,233 @@
+"""
+Cache en memoria de datos de referencia (boxes, tipos y nombres de médicos)
+Los datos cambian poco y se leen en cada carga de la grilla de boxes, en la
+resolución de conflictos y en los listados de agendas
+"""
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import threading
+import time as reloj
+
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _tasa(aciertos, fallos):
+    total = aciertos + fallos
+    return round(aciertos / total * 100, 2) if total else 0.0
+
+
+class DatoReferencia(ABC):
+    """Dato de referencia versionado e invalidable con lectura a través del cache.
+
+    La primera lectura llama a `cargar()` y las siguientes lo sirven desde
+    memoria. Se invalida al cambiar boxes o tipos y expira tras
+    `CACHE_REFERENCIA_TTL` segundos por si otro proceso escribió en la BD.
+    `version` cambia en cada invalidación o recarga.
+    """
+
+    clave = 'referencia'
+
+    def __init__(self, ttl_segundos=None):
+        self._ttl = ttl_segundos
+        self._lock = threading.Lock()
+        self._datos = None
+        self._cargado_en = 0.0
+        self.version = 0
+        self.aciertos = 0
+        self.fallos = 0
+
+    @property
+    def ttl(self):
+        if self._ttl is not None:
+            return self._ttl
+        return getattr(settings, 'CACHE_REFERENCIA_TTL', 300)
+
+    @abstractmethod
+    def cargar(self):
+        """Lee el dato desde la BD"""
+
+    def obtener(self):
+        """Devuelve (datos, version). Los datos no deben modificarse."""
+        with self._lock:
+            if self._datos is None or reloj.monotonic() - self._cargado_en > self.ttl:
+                self.fallos += 1
+                self._datos = self.cargar()
+                self._cargado_en = reloj.monotonic()
+                self.version += 1
+            else:
+                self.aciertos += 1
+            return self._datos, self.version
+
+    def invalidar(self, motivo=None):
+        with self._lock:
+            self._datos = None
+            self.version += 1
+        logger.debug(f"Cache de {self.clave} invalidado ({motivo})")
+
+    def estadisticas(self):
+        return {
+            'version': self.version,
+            'cargado': self._datos is not None,
+            'aciertos': self.aciertos,
+            'fallos': self.fallos,
+            'tasa_aciertos': _tasa(self.aciertos, self.fallos),
+        }
+
+
+class SnapshotBoxes(DatoReferencia):
+    """Lista serializada de boxes armada con `BoxSerializer.queryset_listado()` (2 consultas)"""
+
+    clave = 'boxes'
+
+    def cargar(self):
+        from ..serializers import BoxSerializer
+        return BoxSerializer(BoxSerializer.queryset_listado(), many=True).data
+
+
+class TiposBoxes(DatoReferencia):
+    """Nombres de Tipobox y tipos asignados a cada box (2 consultas).
+
+    `obtener()` devuelve ({'tipos': {idtipobox: tipo}, 'por_box': {idbox:
+    [(idtipobox, tipo, tipoprincipal), ...]}}, version).
+    """
+
+    clave = 'tipos'
+
+    def cargar(self):
+        from ..models import Tipobox, BoxTipoBox
+        tipos = dict(Tipobox.objects.values_list('idtipobox', 'tipo'))
+        por_box = {}
+        for box_id, tipo_id, principal in BoxTipoBox.objects.values_list('idbox_id', 'idtipobox_id', 'tipoprincipal'):
+            por_box.setdefault(box_id, []).append((tipo_id, tipos.get(tipo_id), principal))
+        return {'tipos': tipos, 'por_box': por_box}
+
+    def nombre_tipo(self, idtipobox):
+        return self.obtener()[0]['tipos'].get(idtipobox)
+
+    def tipos_de_box(self, idbox):
+        """Lista de (idtipobox, tipo, tipoprincipal) del box"""
+        return self.obtener()[0]['por_box'].get(idbox, [])
+
+
+class NombresMedicos:
+    """LRU acotado de nombres de médicos por idmedico.
+
+    Los ids que faltan se cargan juntos con una consulta, fuera del lock; si
+    mientras tanto hubo una invalidación, lo leído se devuelve pero no se
+    guarda. Guarda como mucho `CACHE_REFERENCIA_MEDICOS_MAX` nombres, y cada
+    uno vence tras `CACHE_REFERENCIA_TTL` segundos.
+    """
+
+    clave = 'medicos'
+
+    def __init__(self, maximo=None, ttl_segundos=None):
+        self._maximo = maximo
+        self._ttl = ttl_segundos
+        self._lock = threading.Lock()
+        self._nombres = OrderedDict()
+        # Cambia en cada invalidación: descarta las cargas que empezaron antes
+        self._generacion = 0
+        self.aciertos = 0
+        self.fallos = 0
+
+    @property
+    def maximo(self):
+        if self._maximo is not None:
+            return self._maximo
+        return getattr(settings, 'CACHE_REFERENCIA_MEDICOS_MAX', 5000)
+
+    @property
+    def ttl(self):
+        if self._ttl is not None:
+            return self._ttl
+        return getattr(settings, 'CACHE_REFERENCIA_TTL', 300)
+
+    def nombres(self, medico_ids):
+        """{idmedico: nombre} para los ids dados (los inexistentes no aparecen)"""
+        ahora = reloj.monotonic()
+        encontrados = {}
+        faltantes = set()
+        with self._lock:
+            for medico_id in set(medico_ids):
+                if medico_id is None:
+                    continue
+                entrada = self._nombres.get(medico_id)
+                if entrada and ahora - entrada[1] <= self.ttl:
+                    self._nombres.move_to_end(medico_id)
+                    encontrados[medico_id] = entrada[0]
+                    self.aciertos += 1
+                else:
+                    faltantes.add(medico_id)
+                    self.fallos += 1
+            generacion = self._generacion
+        if not faltantes:
+            return encontrados
+
+        from ..models import Medico
+        cargados = dict(Medico.objects.filter(idmedico__in=faltantes).values_list('idmedico', 'nombre'))
+        with self._lock:
+            if generacion == self._generacion:
+                for medico_id, nombre in cargados.items():
+                    self._nombres[medico_id] = (nombre, ahora)
+                    self._nombres.move_to_end(medico_id)
+                while len(self._nombres) > self.maximo:
+                    self._nombres.popitem(last=False)
+        encontrados.update(cargados)
+        return encontrados
+
+    def nombre(self, medico_id):
+        return self.nombres([medico_id]).get(medico_id)
+
+    def invalidar(self, medico_id=None, motivo=None):
+        with self._lock:
+            self._generacion += 1
+            if medico_id is None:
+                self._nombres.clear()
+            else:
+                self._nombres.pop(medico_id, None)
+        logger.debug(f"Cache de médicos invalidado ({motivo})")
+
+    def estadisticas(self):
+        return {
+            'tamano': len(self._nombres),
+            'maximo': self.maximo,
+            'aciertos': self.aciertos,
+            'fallos': self.fallos,
+            'tasa_aciertos': _tasa(self.aciertos, self.fallos),
+        }
+
+
+snapshot_boxes = SnapshotBoxes()
+tipos_boxes = TiposBoxes()
+nombres_medicos = NombresMedicos()
+
+
+def estadisticas():
+    """Aciertos, fallos y tamaño de cada cache de referencia"""
+    return {cache.clave: cache.estadisticas() for cache in (snapshot_boxes, tipos_boxes, nombres_medicos)}
+
+
+def invalidar_por_senal(sender, **kwargs):
+    """Receptor de post_save/post_delete de Box, Tipobox y BoxTipoBox"""
+    snapshot_boxes.invalidar(motivo=f"{sender.__name__} modificado")
+    tipos_boxes.invalidar(motivo=f"{sender.__name__} modificado")
+
+
+def invalidar_medico_por_senal(sender, instance=None, **kwargs):
+    """Receptor de post_save/post_delete de Medico"""
+    nombres_medicos.invalidar(getattr(instance, 'idmedico', None), motivo='Medico modificado')
+
+
+def conectar_senales():
+    """Registra la invalidación ante cambios de boxes, tipos y médicos (se llama desde apps.ready)"""
+    from django.db.models.signals import post_save, post_delete
+    from ..models import Box, Tipobox, BoxTipoBox, Medico
+
+    for modelo in (Box, Tipobox, BoxTipoBox):
+        post_save.connect(invalidar_por_senal, sender=modelo, dispatch_uid=f'cache_referencia_{modelo.__name__}_save')
+        post_delete.connect(invalidar_por_senal, sender=modelo, dispatch_uid=f'cache_referencia_{modelo.__name__}_delete')
+    post_save.connect(invalidar_medico_por_senal, sender=Medico, dispatch_uid='cache_referencia_Medico_save')
+    post_delete.connect(invalidar_medico_por_senal, sender=Medico, dispatch_uid='cache_referencia_Medico_delete')
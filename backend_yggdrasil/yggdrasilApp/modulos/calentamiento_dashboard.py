@@ -0,0 +1,195 @@
+"""
+Precalentamiento del cache del dashboard
+Un hilo en segundo plano calcula por adelantado las ventanas que están por
+empezar (mañana, la próxima semana, el próximo mes o año) y mantiene
+vigentes las ventanas actuales y las consultadas recientemente, para que la
+primera lectura después de medianoche, del lunes o del día 1 no pague el
+cálculo completo. Todos los procesos servidores arrancan el hilo, pero sólo
+el que tiene el lock de líder en Redis calcula
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import threading
+import time as reloj
+
+from django.conf import settings
+import logging
+
+logger = logging.getLogger(__name__)
+
+PERIODOS = ('day', 'week', 'month', 'year')
+LOCK_LIDER = 'calentamiento_dashboard'
+
+
+def _tasa(parte, total):
+    return round(parte / total * 100, 2) if total else 0.0
+
+
+class CalentadorDashboard:
+    """Planificador de precálculo de ventanas del dashboard.
+
+    Cada `CALENTAMIENTO_INTERVALO` segundos recorre las ventanas objetivo y
+    recalcula las que no existen o vencen dentro de `CALENTAMIENTO_ANTICIPACION`
+    segundos. Las lecturas se registran con `registrar_lectura()`: alimentan el
+    conjunto de ventanas recientes (como mucho `CALENTAMIENTO_RECIENTES_MAX`,
+    durante `CALENTAMIENTO_RECIENTES_HORAS`) y la tasa de lecturas servidas en
+    caliente.
+
+    Los ciclos y la depuración de versiones anteriores sólo corren en el
+    proceso que tiene el lock `LOCK_LIDER`, renovado en cada ciclo y con
+    vencimiento de tres intervalos: si el líder muere, otro lo reemplaza.
+    """
+
+    def __init__(self, intervalo=None, anticipacion=None, max_recientes=None, horas_recientes=None):
+        self.intervalo = intervalo or getattr(settings, 'CALENTAMIENTO_INTERVALO', 60)
+        self.anticipacion = anticipacion or getattr(settings, 'CALENTAMIENTO_ANTICIPACION', 900)
+        self.max_recientes = max_recientes or getattr(settings, 'CALENTAMIENTO_RECIENTES_MAX', 32)
+        self.horas_recientes = horas_recientes or getattr(settings, 'CALENTAMIENTO_RECIENTES_HORAS', 24)
+        self._lock = threading.Lock()
+        self._recientes = OrderedDict()
+        self._hilo = None
+        self._token_lider = None
+        self._stats = {
+            'lecturas': 0,
+            'calientes': 0,
+            'obsoletas': 0,
+            'frias': 0,
+            'forzadas': 0,
+            'ciclos': 0,
+            'precalculos': 0,
+            'errores': 0,
+            'ultimo_ciclo': None,
+        }
+
+    def registrar_lectura(self, periodo, fecha_inicio, resultado):
+        """Anota una lectura: resultado es 'caliente', 'obsoleta', 'fria' o 'forzada'"""
+        with self._lock:
+            clave = (periodo, fecha_inicio)
+            self._recientes[clave] = reloj.monotonic()
+            self._recientes.move_to_end(clave)
+            while len(self._recientes) > self.max_recientes:
+                self._recientes.popitem(last=False)
+            if resultado == 'forzada':
+                self._stats['forzadas'] += 1
+                return
+            self._stats['lecturas'] += 1
+            self._stats[{'caliente': 'calientes', 'obsoleta': 'obsoletas'}.get(resultado, 'frias')] += 1
+
+    def ventanas_objetivo(self, ahora=None):
+        """Lista de (periodo, fecha_inicio) a mantener calculadas"""
+        from .dashboard_optimizer import DashboardOptimizer
+
+        ahora = ahora or datetime.now()
+        hoy = ahora.date()
+        objetivos = []
+        for periodo in PERIODOS:
+            inicio, fin, _ = DashboardOptimizer._calcular_rango_fechas(periodo, hoy)
+            objetivos.append((periodo, inicio))
+            # La ventana siguiente empieza el día después del fin de la actual
+            siguiente = fin + timedelta(days=1)
+            if datetime.combine(siguiente, datetime.min.time()) - ahora <= timedelta(seconds=self.anticipacion):
+                objetivos.append((periodo, DashboardOptimizer._calcular_rango_fechas(periodo, siguiente)[0]))
+
+        limite = reloj.monotonic() - self.horas_recientes * 3600
+        with self._lock:
+            for clave in [clave for clave, leida_en in self._recientes.items() if leida_en < limite]:
+                del self._recientes[clave]
+            recientes = list(reversed(self._recientes))
+        for clave in recientes:
+            if clave not in objetivos:
+                objetivos.append(clave)
+        return objetivos
+
+    def _por_vencer(self, periodo, fecha_inicio, ahora):
+        from ..mongo_models import DashboardCache, VERSION_DASHBOARD_CACHE
+        # Proyección cubierta por el índice (periodo, fecha_inicio, version, expires_at, created_at)
+        return not DashboardCache.objects(
+            periodo=periodo,
+            fecha_inicio=fecha_inicio,
+            version=VERSION_DASHBOARD_CACHE,
+            expires_at__gt=ahora + timedelta(seconds=self.anticipacion)
+        ).only('expires_at').exclude('id').as_pymongo().first()
+
+    def ciclo(self):
+        """Recalcula las ventanas objetivo que faltan o están por vencer"""
+        from .dashboard_optimizer import DashboardCacheService
+
+        ahora = datetime.now()
+        calculadas = 0
+        for periodo, fecha_inicio in self.ventanas_objetivo(ahora):
+            try:
+                if not self._por_vencer(periodo, fecha_inicio, ahora):
+                    continue
+                if DashboardCacheService.calcular(periodo, fecha_inicio, forzar=True) is None:
+                    raise RuntimeError("precalcular_dashboard no devolvió resultado")
+                calculadas += 1
+            except Exception as e:
+                with self._lock:
+                    self._stats['errores'] += 1
+                logger.error(f"Error precalentando dashboard {periodo} {fecha_inicio}: {str(e)}")
+        with self._lock:
+            self._stats['ciclos'] += 1
+            self._stats['precalculos'] += calculadas
+            self._stats['ultimo_ciclo'] = datetime.now().isoformat()
+        if calculadas:
+            logger.info(f"Dashboard precalentado: {calculadas} ventanas")
+        return calculadas
+
+    def iniciar(self):
+        """Arranca el hilo de precalentamiento (una vez por proceso)"""
+        with self._lock:
+            if self._hilo is not None and self._hilo.is_alive():
+                return
+            self._hilo = threading.Thread(target=self._ejecutar, daemon=True, name='calentamiento-dashboard')
+            self._hilo.start()
+
+    def es_lider(self):
+        """Toma o renueva el lock de líder; True si este proceso lo tiene"""
+        from .cache_distribuido import cache_distribuido
+
+        ttl = self.intervalo * 3
+        if self._token_lider is not None and cache_distribuido.renovar_lock(LOCK_LIDER, self._token_lider, ttl):
+            return True
+        era_lider = self._token_lider is not None
+        self._token_lider = cache_distribuido.adquirir_lock(LOCK_LIDER, ttl)
+        if self._token_lider is not None and not era_lider:
+            logger.info("Este proceso pasa a precalentar el dashboard")
+            self._al_asumir()
+        return self._token_lider is not None
+
+    def _al_asumir(self):
+        from .dashboard_optimizer import DashboardCacheService
+        try:
+            DashboardCacheService.depurar_versiones_anteriores()
+        except Exception as e:
+            logger.error(f"Error depurando DashboardCache: {str(e)}")
+
+    def _ejecutar(self):
+        while True:
+            try:
+                if self.es_lider():
+                    self.ciclo()
+            except Exception as e:
+                logger.error(f"Error en el ciclo de precalentamiento: {str(e)}")
+            reloj.sleep(self.intervalo)
+
+    def estadisticas(self):
+        with self._lock:
+            return dict(
+                self._stats,
+                tasa_calientes=_tasa(self._stats['calientes'], self._stats['lecturas']),
+                tasa_sin_espera=_tasa(
+                    self._stats['calientes'] + self._stats['obsoletas'], self._stats['lecturas']
+                ),
+                recientes=[
+                    {'periodo': periodo, 'fecha_inicio': fecha_inicio.isoformat()}
+                    for periodo, fecha_inicio in self._recientes
+                ],
+                activo=self._hilo is not None and self._hilo.is_alive(),
+                lider=self._token_lider is not None,
+                intervalo_segundos=self.intervalo,
+                anticipacion_segundos=self.anticipacion,
+            )
+
+
+calentador_dashboard = CalentadorDashboard()
@@ -2,13 +2,19 @@
 Servicio optimizado para pre-calcular métricas del dashboard
 Reduce las consultas complejas en tiempo real
 """
-from datetime import datetime, timedelta, time
-from django.db.models import Count, Sum, Avg, F, ExpressionWrapper, DurationField, IntegerField
-from django.db.models.functions import ExtractWeekDay, ExtractHour, ExtractMinute
+from datetime import datetime, timedelta
+import threading
+import time as reloj
+from django.conf import settings
 from django.utils import timezone
-from ..models import Box, Agendabox, BoxTipoBox, Medico
+from ..models import Box, BoxTipoBox
+from .aggregation_service import ServicioAgregados
+from .almacen_columnar import almacen_columnar
+from .cache_distribuido import cache_distribuido
+from . import serializacion_dashboard
+from .persistencia_mongo import guardar_documento
 from ..mongo_models import (
-    DashboardCache, EstadisticasBox, AlertasInteligentes, 
+    DashboardCache, VERSION_DASHBOARD_CACHE, AlertasInteligentes, 
     InventarioBox, MetricasBasicas
 )
 import logging
@@ -20,8 +26,11 @@ class DashboardOptimizer:
     """Optimizador de consultas del dashboard usando agregaciones MongoDB"""
     
     @staticmethod
-    def precalcular_dashboard(periodo='week', fecha_referencia=None):
-        """Pre-calcula todas las métricas del dashboard para un período"""
+    def precalcular_dashboard(periodo='week', fecha_referencia=None, forzar=False):
+        """Pre-calcula todas las métricas del dashboard para un período.
+        
+        Con `forzar` se recalcula aunque exista un cache vigente.
+        """
         if fecha_referencia is None:
             fecha_referencia = timezone.now().date()
         
@@ -33,53 +42,49 @@ class DashboardOptimizer:
             cache_existente = DashboardCache.objects(
                 periodo=periodo,
                 fecha_inicio=start_date,
+                version=VERSION_DASHBOARD_CACHE,
                 expires_at__gt=datetime.now()
             ).first()
             
-            if cache_existente:
+            if cache_existente and not forzar:
                 logger.info(f"Cache válido encontrado para {periodo}")
                 return cache_existente
             
             # Calcular métricas
             inicio_calculo = datetime.now()
             
-            # Consultas base optimizadas
-            reservas_query = Agendabox.objects.filter(
-                fechaagenda__gte=start_date,
-                fechaagenda__lte=end_date
-            ).select_related('idbox', 'idmedico')
-            
+            # Los totales se pliegan desde los agregados por (box, fecha)
             total_boxes = Box.objects.count()
-            total_reservas = reservas_query.count()
-            reservas_medicas = reservas_query.filter(esMedica=True).count()
-            reservas_no_medicas = reservas_query.filter(esMedica=False).count()
+            agregados = ServicioAgregados.plegar(start_date, end_date)
+            total_reservas = agregados['total_reservas']
+            reservas_medicas = agregados['reservas_medicas']
+            reservas_no_medicas = agregados['reservas_no_medicas']
             
             # Cálculos de ocupación optimizados
             ocupacion_data = DashboardOptimizer._calcular_ocupacion_optimizada(
-                reservas_query, total_boxes, days
+                agregados, total_boxes, days
             )
             
             # Rankings y estadísticas
-            ranking_boxes = DashboardOptimizer._calcular_ranking_boxes(reservas_query)
+            ranking_boxes = DashboardOptimizer._calcular_ranking_boxes(agregados)
             box_mas_utilizado = ranking_boxes[0] if ranking_boxes else {}
             box_menos_utilizado = ranking_boxes[-1] if ranking_boxes else {}
             
             # Ocupación por turnos
-            ocupacion_turnos = DashboardOptimizer._calcular_ocupacion_turnos(reservas_query)
+            ocupacion_turnos = DashboardOptimizer._calcular_ocupacion_turnos(agregados)
             
             # Especialidades
             especialidades_stats = DashboardOptimizer._calcular_especialidades_optimizado()
             
             # Alertas automáticas
-            alertas = DashboardOptimizer._generar_alertas_inteligentes(
-                reservas_query, ranking_boxes
-            )
+            alertas = DashboardOptimizer._generar_alertas_inteligentes(ranking_boxes)
             
             # Tendencias (últimos períodos)
             tendencia = DashboardOptimizer._calcular_tendencia_ocupacion(periodo, fecha_referencia)
             
             # Crear cache
             tiempo_calculo = (datetime.now() - inicio_calculo).total_seconds() * 1000
+            expires_at = datetime.now() + timedelta(hours=1)  # Cache por 1 hora
             
             cache = DashboardCache(
                 periodo=periodo,
@@ -101,10 +106,21 @@ class DashboardOptimizer:
                 alertas=alertas,
                 tendencia_ocupacion=tendencia,
                 tiempo_calculo_ms=int(tiempo_calculo),
-                expires_at=datetime.now() + timedelta(hours=1)  # Cache por 1 hora
+                # Momento desde el que se leyeron los datos: una invalidación
+                # posterior no queda cubierta por este documento
+                created_at=inicio_calculo,
+                expires_at=expires_at,
+                # Se conserva como última versión buena hasta la purga
+                purga_en=expires_at + timedelta(
+                    seconds=getattr(settings, 'DASHBOARD_OBSOLETO_MAX_SEGUNDOS', 86400)
+                )
             )
             
-            cache.save()
+            # La respuesta HTTP se serializa una vez aquí y no en cada lectura
+            DashboardCacheService.serializar_respuesta(cache)
+            
+            # Reemplaza el cache vencido del mismo período en vez de acumular documentos
+            guardar_documento(cache, ('periodo', 'fecha_inicio', 'version'))
             logger.info(f"Dashboard cache creado para {periodo} en {tiempo_calculo:.2f}ms")
             return cache
             
@@ -139,137 +155,50 @@ class DashboardOptimizer:
         return start_date, end_date, days
     
     @staticmethod
-    def _calcular_ocupacion_optimizada(reservas_query, total_boxes, days):
-        """Calcula métricas de ocupación de forma optimizada"""
-        # Calcular minutos ocupados en una sola consulta
-        ocupacion_stats = reservas_query.annotate(
-            hora_fin_minutos=ExpressionWrapper(
-                ExtractHour('horafinagenda') * 60 + ExtractMinute('horafinagenda'),
-                output_field=IntegerField()
-            ),
-            hora_inicio_minutos=ExpressionWrapper(
-                ExtractHour('horainicioagenda') * 60 + ExtractMinute('horainicioagenda'),
-                output_field=IntegerField()
-            )
-        ).annotate(
-            duracion_minutos=ExpressionWrapper(
-                F('hora_fin_minutos') - F('hora_inicio_minutos'),
-                output_field=IntegerField()
-            )
-        ).aggregate(
-            total_minutos=Sum('duracion_minutos'),
-            promedio_duracion=Avg('duracion_minutos')
+    def _calcular_ocupacion_optimizada(agregados, total_boxes, days):
+        """Calcula métricas de ocupación a partir de los agregados del período"""
+        total_minutos_ocupados = agregados['minutos_ocupados']
+        reservas_con_duracion = agregados['reservas_con_duracion']
+        promedio_duracion = (
+            total_minutos_ocupados / reservas_con_duracion if reservas_con_duracion else 0
         )
         
-        total_minutos_ocupados = ocupacion_stats['total_minutos'] or 0
-        promedio_duracion = ocupacion_stats['promedio_duracion'] or 0
-        
         # Calcular capacidad total (8-18 = 10 horas por día)
         total_minutos_disponibles = total_boxes * days * 600  # 10 horas * 60 min
         
         porcentaje_ocupacion = (total_minutos_ocupados / total_minutos_disponibles * 100) if total_minutos_disponibles > 0 else 0
         
-        # Calcular horas muertas de forma optimizada
-        horas_muertas = DashboardOptimizer._calcular_horas_muertas_optimizado(reservas_query)
-        
         return {
             'porcentaje': round(porcentaje_ocupacion, 2),
             'tiempo_promedio': round(promedio_duracion, 2),
-            'horas_muertas': horas_muertas
+            'horas_muertas': round(agregados['minutos_muertos'] / 60, 2)
         }
     
     @staticmethod
-    def _calcular_horas_muertas_optimizado(reservas_query):
-        """Calcula horas muertas de forma más eficiente"""
-        # Agrupar por box y fecha, ordenar por hora
-        reservas_por_box = {}
-        
-        reservas_data = reservas_query.values(
-            'idbox_id', 'fechaagenda', 'horainicioagenda', 'horafinagenda'
-        ).order_by('idbox_id', 'fechaagenda', 'horainicioagenda')
-        
-        for reserva in reservas_data:
-            box_id = reserva['idbox_id']
-            fecha = reserva['fechaagenda']
-            key = f"{box_id}_{fecha}"
-            
-            if key not in reservas_por_box:
-                reservas_por_box[key] = []
-            
-            reservas_por_box[key].append({
-                'inicio': reserva['horainicioagenda'],
-                'fin': reserva['horafinagenda']
-            })
-        
-        total_horas_muertas = 0
-        
-        for key, reservas_dia in reservas_por_box.items():
-            if len(reservas_dia) < 2:
-                continue
-                
-            for i in range(1, len(reservas_dia)):
-                tiempo_muerto = (
-                    datetime.combine(datetime.today(), reservas_dia[i]['inicio']) -
-                    datetime.combine(datetime.today(), reservas_dia[i-1]['fin'])
-                ).total_seconds() / 3600
-                
-                if tiempo_muerto > 0:
-                    total_horas_muertas += tiempo_muerto
-        
-        return round(total_horas_muertas, 2)
-    
-    @staticmethod
-    def _calcular_ranking_boxes(reservas_query):
+    def _calcular_ranking_boxes(agregados):
         """Calcula ranking de boxes por utilización"""
-        boxes_stats = reservas_query.annotate(
-            hora_fin_minutos=ExpressionWrapper(
-                ExtractHour('horafinagenda') * 60 + ExtractMinute('horafinagenda'),
-                output_field=IntegerField()
-            ),
-            hora_inicio_minutos=ExpressionWrapper(
-                ExtractHour('horainicioagenda') * 60 + ExtractMinute('horainicioagenda'),
-                output_field=IntegerField()
-            )
-        ).annotate(
-            duracion_minutos=ExpressionWrapper(
-                F('hora_fin_minutos') - F('hora_inicio_minutos'),
-                output_field=IntegerField()
-            )
-        ).values('idbox_id').annotate(
-            total_reservas=Count('id'),
-            total_minutos=Sum('duracion_minutos')
-        ).order_by('-total_reservas')
+        boxes_stats = sorted(agregados['por_box'], key=lambda b: -b['total_reservas'])
+        boxes = Box.objects.in_bulk([b['box_id'] for b in boxes_stats])
         
         ranking = []
         for box_stat in boxes_stats:
-            try:
-                box = Box.objects.get(idbox=box_stat['idbox_id'])
-                ranking.append({
-                    'box_id': box_stat['idbox_id'],
-                    'total_reservas': box_stat['total_reservas'],
-                    'total_minutos': box_stat['total_minutos'] or 0,
-                    'pasillo': box.pasillobox,
-                    'estado': box.estadobox
-                })
-            except Box.DoesNotExist:
+            box = boxes.get(box_stat['box_id'])
+            if box is None:
                 continue
+            ranking.append({
+                'box_id': box_stat['box_id'],
+                'total_reservas': box_stat['total_reservas'],
+                'total_minutos': box_stat['minutos_ocupados'],
+                'pasillo': box.pasillobox,
+                'estado': box.estadobox
+            })
         
         return ranking
     
     @staticmethod
-    def _calcular_ocupacion_turnos(reservas_query):
+    def _calcular_ocupacion_turnos(agregados):
         """Calcula ocupación por turnos AM/PM"""
-        ocupacion_am = reservas_query.filter(
-            horainicioagenda__gte=time(8, 0),
-            horafinagenda__lte=time(13, 0)
-        ).count()
-        
-        ocupacion_pm = reservas_query.filter(
-            horainicioagenda__gte=time(13, 0),
-            horafinagenda__lte=time(18, 0)
-        ).count()
-        
-        return {'am': ocupacion_am, 'pm': ocupacion_pm}
+        return {'am': agregados['reservas_am'], 'pm': agregados['reservas_pm']}
     
     @staticmethod
     def _calcular_especialidades_optimizado():
@@ -294,7 +223,7 @@ class DashboardOptimizer:
         return list(especialidades.values())
     
     @staticmethod
-    def _generar_alertas_inteligentes(reservas_query, ranking_boxes):
+    def _generar_alertas_inteligentes(ranking_boxes):
         """Genera alertas automáticas basadas en patrones"""
         alertas = []
         
@@ -350,10 +279,7 @@ class DashboardOptimizer:
                 inicio_semana = fecha_semana - timedelta(days=fecha_semana.weekday())
                 fin_semana = inicio_semana + timedelta(days=6)
                 
-                reservas_semana = Agendabox.objects.filter(
-                    fechaagenda__gte=inicio_semana,
-                    fechaagenda__lte=fin_semana
-                ).count()
+                reservas_semana = len(almacen_columnar.columnas(inicio_semana, fin_semana)['id'])
                 
                 tendencia.append(reservas_semana)
         
@@ -361,112 +287,287 @@ class DashboardOptimizer:
             # Últimos 6 meses
             for i in range(6):
                 fecha_mes = fecha_referencia.replace(day=1) - timedelta(days=i*30)
-                inicio_mes = fecha_mes.replace(day=1)
+                inicio_mes, fin_mes, _ = DashboardOptimizer._calcular_rango_fechas('month', fecha_mes)
                 
-                reservas_mes = Agendabox.objects.filter(
-                    fechaagenda__year=inicio_mes.year,
-                    fechaagenda__month=inicio_mes.month
-                ).count()
+                reservas_mes = len(almacen_columnar.columnas(inicio_mes, fin_mes)['id'])
                 
                 tendencia.append(reservas_mes)
         
         return tendencia[::-1]  # Invertir para orden cronológico
     
     @staticmethod
-    def generar_estadisticas_mensuales_boxes():
-        """Genera estadísticas mensuales por box para análisis histórico"""
-        fecha_actual = datetime.now()
-        mes_anterior = fecha_actual.replace(day=1) - timedelta(days=1)
+    def generar_estadisticas_mensuales_boxes(anio=None, mes=None, sobrescribir=False):
+        """Genera estadísticas mensuales por box (por defecto del mes anterior)"""
+        from .estadisticas_mensuales import generar_mes, mes_anterior
+        if anio is None or mes is None:
+            anio, mes = mes_anterior()
+        return generar_mes(anio, mes, sobrescribir)[2]
+
+
+class CalculoUnico:
+    """Una sola ejecución concurrente por clave; las demás llamadas esperan su resultado"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._en_curso = {}
+        self._stats = {'calculos': 0, 'esperas': 0}
+    
+    def ejecutar(self, clave, funcion):
+        with self._lock:
+            calculo = self._en_curso.get(clave)
+            propio = calculo is None
+            if propio:
+                calculo = {'listo': threading.Event(), 'resultado': None}
+                self._en_curso[clave] = calculo
+                self._stats['calculos'] += 1
+            else:
+                self._stats['esperas'] += 1
         
-        boxes = Box.objects.all()
+        if not propio:
+            calculo['listo'].wait()
+            return calculo['resultado']
         
-        for box in boxes:
-            # Verificar si ya existen estadísticas para este mes
-            stats_existentes = EstadisticasBox.objects(
-                box_id=box.idbox,
-                mes=mes_anterior.month,
-                anio=mes_anterior.year
-            ).first()
-            
-            if stats_existentes:
-                continue
-            
-            # Calcular estadísticas del mes anterior
-            reservas_mes = Agendabox.objects.filter(
-                idbox=box,
-                fechaagenda__year=mes_anterior.year,
-                fechaagenda__month=mes_anterior.month
-            )
-            
-            total_reservas = reservas_mes.count()
-            if total_reservas == 0:
-                continue
-            
-            # Calcular métricas
-            horas_ocupadas = sum(
-                (datetime.combine(datetime.today(), r.horafinagenda) - 
-                 datetime.combine(datetime.today(), r.horainicioagenda)).total_seconds() / 3600
-                for r in reservas_mes if r.horainicioagenda and r.horafinagenda
-            )
-            
-            # Día más ocupado
-            reservas_por_dia = reservas_mes.extra(
-                select={'weekday': 'WEEKDAY(fechaagenda)'}
-            ).values('weekday').annotate(count=Count('id')).order_by('-count')
-            
-            dia_mas_ocupado = reservas_por_dia[0]['weekday'] + 1 if reservas_por_dia else 1
-            
-            # Hora pico
-            reservas_por_hora = reservas_mes.extra(
-                select={'hora': 'HOUR(horainicioagenda)'}
-            ).values('hora').annotate(count=Count('id')).order_by('-count')
-            
-            hora_pico = reservas_por_hora[0]['hora'] if reservas_por_hora else 9
-            
-            # Verificar implementos
-            inventario = InventarioBox.objects(box_id=box.idbox).first()
-            implementos_rotos = len(inventario.get_implementos_no_operacionales()) if inventario else 0
-            
-            # Crear estadísticas
-            stats = EstadisticasBox(
-                box_id=box.idbox,
-                mes=mes_anterior.month,
-                anio=mes_anterior.year,
-                total_reservas_mes=total_reservas,
-                horas_ocupadas_mes=round(horas_ocupadas, 2),
-                eficiencia_promedio=round((horas_ocupadas / (30 * 10)) * 100, 2),  # 10 horas disponibles por día
-                dia_mas_ocupado=dia_mas_ocupado,
-                hora_pico=hora_pico,
-                implementos_no_operacionales=implementos_rotos,
-                reservas_canceladas=reservas_mes.filter(habilitada=0).count()
-            )
-            
-            stats.save()
-            logger.info(f"Estadísticas mensuales generadas para box {box.idbox}")
+        try:
+            calculo['resultado'] = funcion()
+            return calculo['resultado']
+        finally:
+            with self._lock:
+                self._en_curso.pop(clave, None)
+            calculo['listo'].set()
+    
+    def estadisticas(self):
+        with self._lock:
+            return dict(self._stats, en_curso=len(self._en_curso))
 
 
 class DashboardCacheService:
-    """Servicio para manejar el cache del dashboard de forma inteligente"""
+    """Servicio para manejar el cache del dashboard de forma inteligente.
+    
+    Con `DASHBOARD_SERVIR_OBSOLETO` activo, un dashboard vencido o invalidado
+    se responde igual con la última versión buena (marcada como obsoleta) y
+    se programa su regeneración en segundo plano, en vez de recalcularlo
+    dentro de la petición.
+    """
+    
+    ESPACIO = 'dashboard'
+    # Última respuesta buena de cada período; no se invalida, sólo vence
+    ESPACIO_OBSOLETO = 'dashboard_ultimo'
+    
+    _calculos = CalculoUnico()
+    _stats_lock = threading.Lock()
+    _stats = {'respuestas_obsoletas': 0, 'calculos_ajenos_esperados': 0}
     
     @staticmethod
-    def obtener_dashboard_optimizado(periodo='week', forzar_refresh=False):
-        """Obtiene dashboard desde cache o lo genera si es necesario"""
+    def clave_cache(periodo, fecha_inicio):
+        """Clave del dashboard en el cache distribuido"""
+        return f"{periodo}:{fecha_inicio.strftime('%Y-%m-%d')}"
+    
+    @staticmethod
+    def obtener_dashboard_serializado(periodo='week', forzar_refresh=False, fecha_referencia=None):
+        """Respuesta serializada del dashboard desde cache, o generada si es necesario.
+        
+        Devuelve la entrada de `serializacion_dashboard.serializar` ({'json',
+        'gzip', 'br', 'etag'}); en el camino habitual sale del cache
+        distribuido sin tocar MongoDB ni armar documentos. Si la respuesta es
+        obsoleta la entrada trae además 'obsoleto': True. Cada lectura se
+        registra en el calentador para mantener caliente su ventana.
+        """
+        from .calentamiento_dashboard import calentador_dashboard
+        
+        start_date = DashboardOptimizer._calcular_rango_fechas(
+            periodo, fecha_referencia or timezone.now().date()
+        )[0]
+        clave = DashboardCacheService.clave_cache(periodo, start_date)
+        
         if not forzar_refresh:
-            cache = DashboardCache.objects(
+            entrada = cache_distribuido.obtener(DashboardCacheService.ESPACIO, clave)
+            if entrada is not None:
+                calentador_dashboard.registrar_lectura(periodo, start_date, 'caliente')
+                return entrada
+            
+            entrada = DashboardCacheService._entrada_mongo(
                 periodo=periodo,
+                fecha_inicio=start_date,
                 expires_at__gt=datetime.now()
-            ).order_by('-created_at').first()
+            )
+            if entrada:
+                calentador_dashboard.registrar_lectura(periodo, start_date, 'caliente')
+                return DashboardCacheService._publicar(clave, entrada)
             
-            if cache:
-                return DashboardCacheService._convertir_cache_a_response(cache)
+            if getattr(settings, 'DASHBOARD_SERVIR_OBSOLETO', True):
+                entrada = DashboardCacheService._ultima_entrada(periodo, start_date, clave)
+                if entrada is not None:
+                    from .cache_manager import planificador_regeneracion
+                    planificador_regeneracion.programar(periodo, start_date, inmediato=True)
+                    DashboardCacheService._contar('respuestas_obsoletas')
+                    calentador_dashboard.registrar_lectura(periodo, start_date, 'obsoleta')
+                    return dict(entrada, obsoleto=True)
+        
+        calentador_dashboard.registrar_lectura(periodo, start_date, 'forzada' if forzar_refresh else 'fria')
         
         # Generar nuevo cache
-        cache = DashboardOptimizer.precalcular_dashboard(periodo)
-        if cache:
-            return DashboardCacheService._convertir_cache_a_response(cache)
+        entrada = DashboardCacheService.calcular(periodo, start_date)
+        if entrada:
+            return entrada
         else:
             raise Exception("Error generando cache del dashboard")
     
+    @staticmethod
+    def obtener_dashboard_optimizado(periodo='week', forzar_refresh=False, fecha_referencia=None):
+        """Obtiene dashboard desde cache o lo genera si es necesario.
+        
+        Si la respuesta es obsoleta, `cache_info['obsoleto']` es True.
+        """
+        entrada = DashboardCacheService.obtener_dashboard_serializado(periodo, forzar_refresh, fecha_referencia)
+        datos = serializacion_dashboard.datos(entrada)
+        if entrada.get('obsoleto'):
+            datos['cache_info']['obsoleto'] = True
+        return datos
+    
+    @staticmethod
+    def calcular(periodo, fecha_referencia=None, forzar=False):
+        """Calcula y publica el dashboard del período.
+        
+        Las llamadas simultáneas para el mismo (periodo, fecha_inicio) esperan
+        al único cálculo en curso: dentro del proceso con `CalculoUnico` y
+        entre procesos con un lock en Redis; quien no lo obtiene espera a que
+        se libere y lee el resultado publicado. Con `forzar` se recalcula
+        aunque haya un cache vigente. Devuelve la entrada serializada o None
+        si falló.
+        """
+        if fecha_referencia is None:
+            fecha_referencia = timezone.now().date()
+        start_date = DashboardOptimizer._calcular_rango_fechas(periodo, fecha_referencia)[0]
+        clave = DashboardCacheService.clave_cache(periodo, start_date)
+        
+        def calcular_y_publicar():
+            nombre_lock = f'dashboard_calculo:{clave}'
+            token = cache_distribuido.adquirir_lock(
+                nombre_lock, getattr(settings, 'DASHBOARD_CALCULO_LOCK_SEGUNDOS', 120)
+            )
+            if token is None:
+                entrada = DashboardCacheService._esperar_calculo_ajeno(periodo, start_date, clave, nombre_lock)
+                if entrada is not None:
+                    return entrada
+                # El otro proceso falló o tardó demasiado: se calcula aquí
+            try:
+                cache = DashboardOptimizer.precalcular_dashboard(periodo, fecha_referencia, forzar)
+                return DashboardCacheService.publicar(cache) if cache else None
+            finally:
+                if token is not None:
+                    cache_distribuido.liberar_lock(nombre_lock, token)
+        
+        return DashboardCacheService._calculos.ejecutar((periodo, start_date), calcular_y_publicar)
+    
+    @staticmethod
+    def _esperar_calculo_ajeno(periodo, start_date, clave, nombre_lock):
+        """Espera a que otro proceso libere el lock y devuelve lo que publicó, o None"""
+        DashboardCacheService._contar('calculos_ajenos_esperados')
+        limite = reloj.monotonic() + getattr(settings, 'DASHBOARD_CALCULO_LOCK_SEGUNDOS', 120)
+        while cache_distribuido.lock_tomado(nombre_lock) and reloj.monotonic() < limite:
+            reloj.sleep(0.2)
+        entrada = cache_distribuido.obtener(DashboardCacheService.ESPACIO, clave)
+        if entrada is not None:
+            return entrada
+        entrada = DashboardCacheService._entrada_mongo(
+            periodo=periodo,
+            fecha_inicio=start_date,
+            expires_at__gt=datetime.now()
+        )
+        return DashboardCacheService._publicar(clave, entrada) if entrada else None
+    
+    @staticmethod
+    def _contar(estadistica):
+        with DashboardCacheService._stats_lock:
+            DashboardCacheService._stats[estadistica] += 1
+    
+    @staticmethod
+    def serializar_respuesta(cache):
+        """Completa en el documento la respuesta serializada y su ETag"""
+        entrada = serializacion_dashboard.serializar(
+            DashboardCacheService._convertir_cache_a_response(cache)
+        )
+        cache.respuesta_json = entrada['json']
+        cache.respuesta_gzip = entrada['gzip']
+        cache.respuesta_br = entrada['br']
+        cache.etag = entrada['etag']
+        return entrada
+    
+    @staticmethod
+    def _entrada_mongo(**filtro):
+        """Entrada serializada leída de MongoDB sin armar el documento, o None"""
+        filtro['version'] = VERSION_DASHBOARD_CACHE
+        raw = DashboardCache.objects(**filtro).only(
+            'expires_at', 'respuesta_json', 'respuesta_gzip', 'respuesta_br', 'etag'
+        ).as_pymongo().first()
+        if not raw:
+            return None
+        return {
+            'json': bytes(raw['respuesta_json']),
+            'gzip': bytes(raw['respuesta_gzip']),
+            'br': bytes(raw['respuesta_br']) if raw.get('respuesta_br') else None,
+            'etag': raw['etag'],
+            'expires_at': raw['expires_at'],
+        }
+    
+    @staticmethod
+    def _ultima_entrada(periodo, start_date, clave):
+        """Última respuesta buena del período aunque esté vencida, o None"""
+        entrada = cache_distribuido.obtener(DashboardCacheService.ESPACIO_OBSOLETO, clave)
+        if entrada is not None:
+            return entrada
+        entrada = DashboardCacheService._entrada_mongo(periodo=periodo, fecha_inicio=start_date)
+        if entrada:
+            entrada.pop('expires_at')
+        return entrada
+    
+    @staticmethod
+    def publicar(cache):
+        """Guarda la respuesta del cache en el cache distribuido hasta su vencimiento y la devuelve"""
+        if not cache.respuesta_json:
+            DashboardCacheService.serializar_respuesta(cache)
+        entrada = {
+            'json': bytes(cache.respuesta_json),
+            'gzip': bytes(cache.respuesta_gzip),
+            'br': bytes(cache.respuesta_br) if cache.respuesta_br else None,
+            'etag': cache.etag,
+            'expires_at': cache.expires_at,
+        }
+        return DashboardCacheService._publicar(
+            DashboardCacheService.clave_cache(cache.periodo, cache.fecha_inicio), entrada
+        )
+    
+    @staticmethod
+    def _publicar(clave, entrada):
+        expires_at = entrada.pop('expires_at')
+        segundos = (expires_at - datetime.now()).total_seconds()
+        if segundos > 0:
+            cache_distribuido.guardar(DashboardCacheService.ESPACIO, clave, entrada, segundos)
+        cache_distribuido.guardar(
+            DashboardCacheService.ESPACIO_OBSOLETO,
+            clave,
+            entrada,
+            getattr(settings, 'DASHBOARD_OBSOLETO_MAX_SEGUNDOS', 86400)
+        )
+        return entrada
+    
+    @staticmethod
+    def depurar_versiones_anteriores():
+        """Borra los documentos de cache de otros formatos (no tienen índice TTL)"""
+        eliminados = DashboardCache.objects(version__ne=VERSION_DASHBOARD_CACHE).delete()
+        if eliminados:
+            logger.info(f"Eliminados {eliminados} documentos de DashboardCache de versiones anteriores")
+        return eliminados
+    
+    @staticmethod
+    def estadisticas():
+        with DashboardCacheService._stats_lock:
+            stats = dict(DashboardCacheService._stats)
+        return dict(
+            stats,
+            **DashboardCacheService._calculos.estadisticas()
+        )
+    
     @staticmethod
     def _convertir_cache_a_response(cache):
         """Convierte el cache MongoDB a formato de respuesta"""
@@ -496,6 +597,7 @@ class DashboardCacheService:
             'cache_info': {
                 'tiempo_calculo_ms': cache.tiempo_calculo_ms,
                 'generado_en': cache.created_at.isoformat(),
-                'expira_en': cache.expires_at.isoformat()
+                'expira_en': cache.expires_at.isoformat(),
+                'obsoleto': False
             }
         }
@@ -0,0 +1,162 @@
+"""
+Detector de topes (agendas solapadas) por barrido
+Recorre las agendas ordenadas por (box, fecha, inicio) en lotes y emite cada
+grupo de agendas que se solapan, sin cargar el rango completo en memoria
+"""
+import heapq
+from itertools import islice
+
+import numpy as np
+from django.db.models import Q
+
+from ..models import Agendabox
+import logging
+
+logger = logging.getLogger(__name__)
+
+CAMPOS_AGENDA = ('id', 'idbox', 'fechaagenda', 'horainicioagenda', 'horafinagenda')
+
+
+def iterar_agendas_ordenadas(desde, hasta, box_ids=None, tamano_lote=2000):
+    """Genera las agendas del rango ordenadas por (box, fecha, inicio, id).
+
+    Lee por lotes con paginación por clave (keyset) en lugar de OFFSET, así
+    cada lote es una consulta indexada y en memoria sólo vive un lote.
+    Las agendas sin hora de inicio o fin no pueden solaparse y se omiten.
+    """
+    base = Agendabox.objects.filter(
+        fechaagenda__gte=desde,
+        fechaagenda__lte=hasta,
+        horainicioagenda__isnull=False,
+        horafinagenda__isnull=False
+    )
+    if box_ids:
+        base = base.filter(idbox__in=box_ids)
+    base = base.order_by('idbox', 'fechaagenda', 'horainicioagenda', 'id').values(*CAMPOS_AGENDA)
+
+    ultima = None
+    while True:
+        consulta = base
+        if ultima is not None:
+            consulta = consulta.filter(
+                Q(idbox__gt=ultima['idbox']) |
+                Q(idbox=ultima['idbox'], fechaagenda__gt=ultima['fechaagenda']) |
+                Q(idbox=ultima['idbox'], fechaagenda=ultima['fechaagenda'],
+                  horainicioagenda__gt=ultima['horainicioagenda']) |
+                Q(idbox=ultima['idbox'], fechaagenda=ultima['fechaagenda'],
+                  horainicioagenda=ultima['horainicioagenda'], id__gt=ultima['id'])
+            )
+        lote = list(consulta[:tamano_lote])
+        if not lote:
+            return
+        yield from lote
+        if len(lote) < tamano_lote:
+            return
+        ultima = lote[-1]
+
+
+def _cerrar_grupo(grupo, pares):
+    return {
+        'idbox': grupo[0]['idbox'],
+        'fechaagenda': grupo[0]['fechaagenda'],
+        'inicio': min(a['horainicioagenda'] for a in grupo),
+        'fin': max(a['horafinagenda'] for a in grupo),
+        'agendas': grupo,
+        'pares': pares,
+    }
+
+
+def detectar_topes(desde, hasta, box_ids=None, tamano_lote=2000):
+    """Genera un dict por cada grupo de agendas que se solapan dentro de un (box, fecha).
+
+    Barrido clásico: las agendas llegan ordenadas por inicio y se mantiene un
+    heap con las activas (ordenadas por fin). Al llegar una agenda se descartan
+    las que ya terminaron y todas las que quedan se solapan con ella, de modo
+    que se detectan todos los pares, incluso una agenda larga que pisa a varias
+    posteriores. El grupo se cierra cuando una agenda empieza después del fin
+    máximo acumulado; la memoria queda acotada al tamaño del grupo.
+    """
+    clave_actual = None
+    activas = []
+    grupo = []
+    pares = []
+    fin_grupo = None
+
+    for agenda in iterar_agendas_ordenadas(desde, hasta, box_ids, tamano_lote):
+        clave = (agenda['idbox'], agenda['fechaagenda'])
+        inicio = agenda['horainicioagenda']
+        fin = agenda['horafinagenda']
+
+        if clave != clave_actual or inicio >= fin_grupo:
+            if pares:
+                yield _cerrar_grupo(grupo, pares)
+            clave_actual = clave
+            activas = []
+            grupo = []
+            pares = []
+            fin_grupo = fin
+
+        while activas and activas[0][0] <= inicio:
+            heapq.heappop(activas)
+
+        for _, _, otra in activas:
+            if otra['horainicioagenda'] < fin:
+                pares.append((otra['id'], agenda['id']))
+
+        heapq.heappush(activas, (fin, agenda['id'], agenda))
+        grupo.append(agenda)
+        fin_grupo = max(fin_grupo, fin)
+
+    if pares:
+        yield _cerrar_grupo(grupo, pares)
+
+
+def agendas_con_tope(grupos):
+    """Aplana los grupos en la lista de agendas involucradas en algún tope (sin repetir)"""
+    for grupo in grupos:
+        involucradas = {agenda_id for par in grupo['pares'] for agenda_id in par}
+        for agenda in grupo['agendas']:
+            if agenda['id'] in involucradas:
+                yield agenda
+
+
+def paginar(iterable, pagina, tamano):
+    """Devuelve los elementos de la página pedida (1-indexada) y si hay más después"""
+    inicio = (pagina - 1) * tamano
+    elementos = list(islice(iterable, inicio, inicio + tamano + 1))
+    return elementos[:tamano], len(elementos) > tamano
+
+
+def mascara_topes(columnas):
+    """Marca las agendas que se solapan con otra del mismo (box, dia).
+
+    Versión vectorizada para columnas del almacén columnar ordenadas por
+    (box, dia, inicio): una agenda está en tope si empieza antes del mayor
+    fin de las anteriores de su grupo, o si la siguiente empieza antes de
+    que ella termine. Las agendas sin inicio o fin nunca están en tope.
+    """
+    inicio = columnas['inicio'].astype(float)
+    fin = columnas['fin'].astype(float)
+    completas = ~(np.isnan(inicio) | np.isnan(fin))
+    mascara = np.zeros(len(inicio), dtype=bool)
+    if completas.sum() < 2:
+        return mascara
+
+    grupo = columnas['box'][completas].astype(np.int64) * 10_000_000 + columnas['dia'][completas]
+    inicio, fin = inicio[completas], fin[completas]
+    nuevo_grupo = np.ones(len(grupo), dtype=bool)
+    nuevo_grupo[1:] = grupo[1:] != grupo[:-1]
+
+    # Máximo acumulado de fin dentro de cada grupo (desplazado por grupo)
+    numero_grupo = np.cumsum(nuevo_grupo)
+    desplazado = np.maximum.accumulate(numero_grupo * 2000.0 + fin) - numero_grupo * 2000.0
+    fin_previo = np.full(len(fin), -np.inf)
+    fin_previo[1:] = desplazado[:-1]
+    fin_previo[nuevo_grupo] = -np.inf
+
+    pisa_anterior = inicio < fin_previo
+    pisada_por_siguiente = np.zeros(len(fin), dtype=bool)
+    pisada_por_siguiente[:-1] = (inicio[1:] < fin[:-1]) & ~nuevo_grupo[1:]
+
+    mascara[completas] = pisa_anterior | pisada_por_siguiente
+    return mascara
@@ -0,0 +1,188 @@
+"""
+Estadísticas mensuales por box (EstadisticasBox) en lote
+Todas las métricas de un mes salen de un único barrido columnar, los
+inventarios se leen de una vez y los documentos se escriben con un solo
+bulk_write; los rangos de meses se pueden rellenar en procesos paralelos
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, timedelta
+import multiprocessing
+
+import numpy as np
+from pymongo import UpdateOne
+
+from .almacen_columnar import almacen_columnar
+from .analisis_huecos import distribucion, huecos_por_dia
+from ..mongo_models import EstadisticasBox, InventarioBox
+import logging
+
+logger = logging.getLogger(__name__)
+
+HORAS_DISPONIBLES_MES = 30 * 10  # 10 horas disponibles por día
+
+
+def mes_anterior(referencia=None):
+    """(anio, mes) del mes anterior a la fecha de referencia (hoy por defecto)"""
+    ultimo_dia = (referencia or date.today()).replace(day=1) - timedelta(days=1)
+    return ultimo_dia.year, ultimo_dia.month
+
+
+def restar_meses(anio_mes, cantidad):
+    """(anio, mes) `cantidad` meses antes de otro (anio, mes)"""
+    anio, mes = anio_mes
+    indice = anio * 12 + (mes - 1) - cantidad
+    return indice // 12, indice % 12 + 1
+
+
+def rango_meses(desde, hasta):
+    """Lista de (anio, mes) entre dos (anio, mes), ambos incluidos"""
+    meses = []
+    anio, mes = desde
+    while (anio, mes) <= tuple(hasta):
+        meses.append((anio, mes))
+        anio, mes = (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+    return meses
+
+
+def calcular_estadisticas_mes(anio, mes):
+    """Documentos (dict) de EstadisticasBox para todos los boxes con agendas en el mes"""
+    primero = date(anio, mes, 1)
+    ultimo = (primero.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    c = almacen_columnar.columnas(primero, ultimo)
+    if not len(c['id']):
+        return []
+
+    boxes, posicion = np.unique(c['box'], return_inverse=True)
+    total_boxes = len(boxes)
+    total_reservas = np.bincount(posicion, minlength=total_boxes)
+
+    duracion = (c['fin'] - c['inicio']).astype(float)
+    con_duracion = ~np.isnan(duracion)
+    horas_ocupadas = np.bincount(
+        posicion[con_duracion], weights=duracion[con_duracion] / 60, minlength=total_boxes
+    )
+    reservas_canceladas = np.bincount(
+        posicion, weights=c['habilitada'] == 0, minlength=total_boxes
+    ).astype(int)
+
+    # Día más ocupado (0 = lunes, como WEEKDAY() de MySQL) y hora pico
+    reservas_por_dia = np.zeros((total_boxes, 7), dtype=int)
+    np.add.at(reservas_por_dia, (posicion, (c['dia'] - 1) % 7), 1)
+    con_inicio = ~np.isnan(c['inicio'])
+    reservas_por_hora = np.zeros((total_boxes, 24), dtype=int)
+    np.add.at(
+        reservas_por_hora,
+        (posicion[con_inicio], (c['inicio'][con_inicio] // 60).astype(int)),
+        1
+    )
+
+    box_huecos, _, minutos_huecos = huecos_por_dia(c)
+    huecos = distribucion(box_huecos, minutos_huecos)
+
+    inventarios = {}
+    for inventario in InventarioBox.objects(box_id__in=boxes.tolist()):
+        inventarios.setdefault(inventario.box_id, inventario)
+
+    documentos = []
+    for i, box_id in enumerate(boxes.tolist()):
+        inventario = inventarios.get(box_id)
+        horas = float(horas_ocupadas[i])
+        documentos.append({
+            'box_id': box_id,
+            'mes': mes,
+            'anio': anio,
+            'total_reservas_mes': int(total_reservas[i]),
+            'horas_ocupadas_mes': round(horas, 2),
+            'eficiencia_promedio': round(horas / HORAS_DISPONIBLES_MES * 100, 2),
+            'dia_mas_ocupado': int(reservas_por_dia[i].argmax()) + 1,
+            'hora_pico': int(reservas_por_hora[i].argmax()) if reservas_por_hora[i].any() else 9,
+            'implementos_no_operacionales': (
+                len(inventario.get_implementos_no_operacionales()) if inventario else 0
+            ),
+            'reservas_canceladas': int(reservas_canceladas[i]),
+            'tiempo_muerto_promedio': huecos.get(box_id, {}).get('media', 0.0),
+        })
+    return documentos
+
+
+def unificar_estadisticas():
+    """Deja un documento por (box_id, anio, mes) y crea los índices de EstadisticasBox.
+
+    EstadisticasBox no crea sus índices al primer uso (`auto_create_index`):
+    el único fallaría con duplicados o con el índice viejo de la misma clave.
+    Aquí se conserva el documento más reciente de cada clave, se quita el
+    índice no único anterior y recién entonces se crean. Devuelve la
+    cantidad de documentos eliminados.
+    """
+    coleccion = EstadisticasBox._get_collection()
+    duplicados = coleccion.aggregate([
+        {'$sort': {'_id': -1}},
+        {'$group': {
+            '_id': {'box_id': '$box_id', 'anio': '$anio', 'mes': '$mes'},
+            'ids': {'$push': '$_id'},
+            'cantidad': {'$sum': 1},
+        }},
+        {'$match': {'cantidad': {'$gt': 1}}},
+    ])
+    sobrantes = [id_ for grupo in duplicados for id_ in grupo['ids'][1:]]
+    if sobrantes:
+        coleccion.delete_many({'_id': {'$in': sobrantes}})
+        logger.warning(f"EstadisticasBox: {len(sobrantes)} documentos duplicados eliminados")
+    for nombre, indice in coleccion.index_information().items():
+        if indice['key'] == [('box_id', 1), ('anio', 1), ('mes', 1)] and not indice.get('unique'):
+            coleccion.drop_index(nombre)
+    EstadisticasBox.ensure_indexes()
+    return len(sobrantes)
+
+
+def guardar_estadisticas(documentos, sobrescribir=False):
+    """Upsert de todos los documentos con un bulk_write.
+
+    Sin `sobrescribir` los documentos que ya existen no se tocan, como hacía
+    la versión por box.
+    """
+    if not documentos:
+        return 0
+    operador = '$set' if sobrescribir else '$setOnInsert'
+    resultado = EstadisticasBox._get_collection().bulk_write([
+        UpdateOne(
+            {'box_id': doc['box_id'], 'anio': doc['anio'], 'mes': doc['mes']},
+            {operador: doc},
+            upsert=True
+        )
+        for doc in documentos
+    ], ordered=False)
+    return resultado.upserted_count + resultado.modified_count
+
+
+def generar_mes(anio, mes, sobrescribir=False):
+    """Calcula y guarda las estadísticas de un mes; devuelve (anio, mes, documentos escritos)"""
+    escritos = guardar_estadisticas(calcular_estadisticas_mes(anio, mes), sobrescribir)
+    logger.info(f"Estadísticas mensuales {anio:04d}-{mes:02d}: {escritos} documentos escritos")
+    return anio, mes, escritos
+
+
+def _iniciar_proceso():
+    # Los procesos se crean con 'spawn': no heredan conexiones de MySQL ni de MongoDB
+    import django
+    django.setup()
+
+
+def rellenar_meses(meses, sobrescribir=False, procesos=1):
+    """Genera las estadísticas de varios meses, en paralelo si `procesos` > 1.
+
+    Genera (anio, mes, documentos escritos) a medida que cada mes termina.
+    """
+    if procesos <= 1 or len(meses) <= 1:
+        for anio, mes in meses:
+            yield generar_mes(anio, mes, sobrescribir)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=procesos,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_iniciar_proceso
+    ) as ejecutor:
+        futuros = [ejecutor.submit(generar_mes, anio, mes, sobrescribir) for anio, mes in meses]
+        for futuro in as_completed(futuros):
+            yield futuro.result()
@@ -0,0 +1,164 @@
+"""
+Exportación en streaming de agendas (CSV, NDJSON y Parquet)
+Recorre las agendas por páginas con paginación por clave y va entregando
+trozos a medida que se leen, sin armar la lista completa en memoria
+"""
+import csv
+import io
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+import logging
+
+logger = logging.getLogger(__name__)
+
+COLUMNAS = ['id', 'box_id', 'fecha', 'hora_inicio', 'hora_fin', 'tipo', 'responsable', 'observaciones']
+
+FORMATOS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+def _tamano_pagina():
+    return getattr(settings, 'EXPORTACION_AGENDAS_PAGINA', 5000)
+
+
+def parquet_disponible():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _paginas(queryset, tamano):
+    """Páginas de tuplas ordenadas por (fecha, hora de inicio, id).
+
+    Cada página continúa después de la última fila de la anterior (keyset),
+    así ninguna consulta carga el rango completo y la primera vuelve enseguida.
+    """
+    campos = (
+        'id', 'idbox_id', 'fechaagenda', 'horainicioagenda', 'horafinagenda',
+        'esMedica', 'idmedico__nombre', 'nombre_responsable', 'observaciones'
+    )
+    base = queryset.order_by('fechaagenda', 'horainicioagenda', 'id').values_list(*campos)
+    pagina = list(base[:tamano])
+    while pagina:
+        yield pagina
+        if len(pagina) < tamano:
+            return
+        ultimo_id, _, fecha, hora = pagina[-1][:4]
+        pagina = list(base.filter(
+            Q(fechaagenda__gt=fecha)
+            | Q(fechaagenda=fecha, horainicioagenda__gt=hora)
+            | Q(fechaagenda=fecha, horainicioagenda=hora, id__gt=ultimo_id)
+        )[:tamano])
+
+
+def _fila(agenda_id, box_id, fecha, inicio, fin, es_medica, medico, responsable, observaciones):
+    return (
+        agenda_id,
+        box_id,
+        fecha.strftime("%Y-%m-%d"),
+        inicio.strftime("%H:%M") if inicio else None,
+        fin.strftime("%H:%M") if fin else None,
+        "Médica" if es_medica else "No Médica",
+        medico if medico is not None else (responsable or "No asignado"),
+        observaciones or "",
+    )
+
+
+def filas_agendas(queryset, tamano=None):
+    """Genera listas de filas (tuplas en el orden de COLUMNAS), una por página"""
+    for pagina in _paginas(queryset, tamano or _tamano_pagina()):
+        yield [_fila(*registro) for registro in pagina]
+
+
+def csv_en_trozos(queryset):
+    """CSV con encabezado; un trozo de texto por página"""
+    salida = io.StringIO()
+    escritor = csv.writer(salida)
+    escritor.writerow(COLUMNAS)
+    yield salida.getvalue()
+    for filas in filas_agendas(queryset):
+        salida.seek(0)
+        salida.truncate()
+        escritor.writerows(filas)
+        yield salida.getvalue()
+
+
+def ndjson_en_trozos(queryset):
+    """Un objeto JSON por línea; un trozo por página"""
+    for filas in filas_agendas(queryset):
+        yield ''.join(
+            json.dumps(dict(zip(COLUMNAS, fila)), cls=DjangoJSONEncoder) + '\n'
+            for fila in filas
+        )
+
+
+class _BufferSalida(io.RawIOBase):
+    """Destino de escritura que acumula bytes hasta que se retiran con `vaciar()`"""
+
+    def __init__(self):
+        super().__init__()
+        self._trozos = []
+        self._posicion = 0
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        datos = bytes(datos)
+        self._trozos.append(datos)
+        self._posicion += len(datos)
+        return len(datos)
+
+    def tell(self):
+        return self._posicion
+
+    def vaciar(self):
+        datos = b''.join(self._trozos)
+        self._trozos = []
+        return datos
+
+
+def parquet_en_trozos(queryset):
+    """Archivo Parquet escrito de a un row group por página (requiere pyarrow)"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    esquema = pa.schema([
+        ('id', pa.int64()),
+        ('box_id', pa.int64()),
+        ('fecha', pa.string()),
+        ('hora_inicio', pa.string()),
+        ('hora_fin', pa.string()),
+        ('tipo', pa.string()),
+        ('responsable', pa.string()),
+        ('observaciones', pa.string()),
+    ])
+    destino = _BufferSalida()
+    with pq.ParquetWriter(destino, esquema, compression='snappy') as escritor:
+        for filas in filas_agendas(queryset):
+            columnas = list(zip(*filas))
+            escritor.write_table(pa.Table.from_arrays(
+                [pa.array(valores, type=campo.type) for valores, campo in zip(columnas, esquema)],
+                schema=esquema
+            ))
+            yield destino.vaciar()
+    yield destino.vaciar()
+
+
+def exportar(queryset, formato):
+    """Generador de trozos del formato pedido ('csv', 'ndjson' o 'parquet')"""
+    if formato == 'csv':
+        return csv_en_trozos(queryset)
+    if formato == 'ndjson':
+        return ndjson_en_trozos(queryset)
+    if formato == 'parquet':
+        return parquet_en_trozos(queryset)
+    raise ValueError(f"Formato de exportación desconocido: {formato}")
@@ -0,0 +1,155 @@
+"""
+Feed de cambios sobre log_atenamb
+Sigue el log por id creciente desde la BD `simulador`, con la marca de
+agua persistida en MongoDB, en lugar de consultar la API por timestamp
+"""
+from datetime import datetime
+import time
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Max, Window
+from django.db.models.functions import RowNumber
+
+from ..models import Atenamb, LogAtenamb
+from ..mongo_models import MarcaFeedCambios
+import logging
+
+logger = logging.getLogger(__name__)
+
+ALIAS_BD = 'simulador'
+
+
+def ultimas_acciones(logs, por_fecha=False):
+    """{atenamb_id: accion} con el log más reciente de cada atenamb, en una sola consulta.
+
+    Usa ROW_NUMBER() particionado por atenamb_id. Por defecto el más
+    reciente es el de mayor id; con `por_fecha` se ordena por fecha_hora
+    (desempatando por id), como hacía la consulta por timestamp.
+    """
+    orden = [F('fecha_hora').desc(), F('id').desc()] if por_fecha else [F('id').desc()]
+    filas = logs.annotate(
+        n=Window(RowNumber(), partition_by=[F('atenamb_id')], order_by=orden)
+    ).filter(n=1).values_list('atenamb_id', 'accion')
+    return dict(filas)
+
+
+def datos_con_accion(acciones):
+    """Filas de Atenamb (formato `.values()`) con la acción indicada para cada una.
+
+    Los atenamb que ya no existen (p. ej. DELETE) no generan filas.
+    """
+    if not acciones:
+        return []
+    datos = list(
+        Atenamb.objects.using(ALIAS_BD)
+        .filter(id__in=list(acciones))
+        .values()
+    )
+    for fila in datos:
+        fila['accion'] = acciones[fila['id']]
+    return datos
+
+
+def leer_pagina_cambios(desde_id=0, limite=500, desde_fecha_hora=None):
+    """Lee la página de hasta `limite` logs con id > desde_id.
+
+    Devuelve (datos, ultimo_id, cantidad_logs): `ultimo_id` es el cursor
+    para la página siguiente y `cantidad_logs == limite` indica que puede
+    haber más. Dentro de la página queda la acción más reciente por atenamb.
+    """
+    logs = LogAtenamb.objects.using(ALIAS_BD).filter(id__gt=desde_id)
+    if desde_fecha_hora is not None:
+        logs = logs.filter(fecha_hora__gt=desde_fecha_hora)
+
+    ids = list(logs.order_by('id').values_list('id', flat=True)[:limite])
+    if not ids:
+        return [], desde_id, 0
+
+    acciones = ultimas_acciones(logs.filter(id__lte=ids[-1]))
+    return datos_con_accion(acciones), ids[-1], len(ids)
+
+
+def leer_cambios_desde_id(ultimo_id, limite=500):
+    """Lee hasta `limite` logs con id > ultimo_id y devuelve (datos, nuevo_ultimo_id, cantidad_logs).
+
+    `datos` tiene el mismo formato que /api/modificados-desde/: los campos de
+    Atenamb más la `accion` del log más reciente de cada atenamb del lote.
+    """
+    return leer_pagina_cambios(ultimo_id, limite)
+
+
+class FeedCambios:
+    """Consume log_atenamb en lotes ordenados por id.
+
+    - La marca (último id procesado) se guarda después de procesar cada
+      lote, así un reinicio retoma donde quedó y nunca se pierden logs con
+      el mismo timestamp como con el cursor por fecha + 1 segundo.
+      `procesar` debe lanzar una excepción si no pudo guardar el lote: la
+      marca no avanza y el lote se reintenta.
+    - Con atraso (lote lleno) se lee el siguiente lote de inmediato; sin
+      cambios la espera crece al doble hasta `espera_max`.
+    - La primera vez, sin marca persistida, arranca desde el id máximo
+      actual, igual que el polling arrancaba desde "ahora".
+    """
+
+    def __init__(self, procesar, nombre='agendas', lote=None, espera_min=None, espera_max=None):
+        self.procesar = procesar
+        self.nombre = nombre
+        self.lote = lote or getattr(settings, 'FEED_CAMBIOS_LOTE', 500)
+        self.espera_min = espera_min or getattr(settings, 'FEED_CAMBIOS_ESPERA_MIN', 0.5)
+        self.espera_max = espera_max or getattr(settings, 'FEED_CAMBIOS_ESPERA_MAX', 10.0)
+        self.ultimo_id = None
+
+    def cargar_marca(self):
+        marca = MarcaFeedCambios.objects(nombre=self.nombre).first()
+        if marca is not None:
+            return marca.ultimo_id
+        ultimo_id = LogAtenamb.objects.using(ALIAS_BD).aggregate(m=Max('id'))['m'] or 0
+        self.guardar_marca(ultimo_id)
+        logger.info(f"Feed '{self.nombre}' inicializado en id {ultimo_id}")
+        return ultimo_id
+
+    def guardar_marca(self, ultimo_id):
+        MarcaFeedCambios.objects(nombre=self.nombre).update_one(
+            set__ultimo_id=ultimo_id,
+            set__actualizado_en=datetime.now(),
+            upsert=True
+        )
+
+    def procesar_siguiente_lote(self):
+        """Procesa un lote y devuelve cuántos logs consumió"""
+        if self.ultimo_id is None:
+            self.ultimo_id = self.cargar_marca()
+
+        datos, nuevo_ultimo_id, cantidad = leer_cambios_desde_id(self.ultimo_id, self.lote)
+        if cantidad == 0:
+            return 0
+
+        if datos:
+            self.procesar(datos)
+        self.guardar_marca(nuevo_ultimo_id)
+        self.ultimo_id = nuevo_ultimo_id
+        logger.info(f"Feed '{self.nombre}': {cantidad} logs procesados hasta id {nuevo_ultimo_id}")
+        return cantidad
+
+    def ejecutar(self):
+        """Bucle principal: pensado para correr en un hilo daemon"""
+        espera = self.espera_min
+        while True:
+            close_old_connections()
+            try:
+                cantidad = self.procesar_siguiente_lote()
+            except Exception as e:
+                # La marca no avanzó: el lote se reintenta tras la espera
+                logger.error(f"Error en feed de cambios '{self.nombre}': {e}")
+                cantidad = 0
+
+            if cantidad >= self.lote:
+                espera = self.espera_min
+                continue
+            if cantidad:
+                espera = self.espera_min
+            else:
+                espera = min(espera * 2, self.espera_max)
+            time.sleep(espera)
@@ -0,0 +1,341 @@
+"""
+Índice en memoria de intervalos de agenda por (box, fecha)
+Responde solapamientos, bloques libres y ocupante actual sin ir a MySQL
+"""
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime, time
+import threading
+import time as reloj
+
+from django.conf import settings
+from django.utils.dateparse import parse_date, parse_time
+
+from ..models import Agendabox
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+IntervaloAgenda = namedtuple('IntervaloAgenda', ['inicio', 'fin', 'id', 'idmedico', 'esMedica'])
+
+
+def normalizar_fecha(fecha):
+    """Acepta date, datetime o 'YYYY-MM-DD' y devuelve un date"""
+    if isinstance(fecha, datetime):
+        return fecha.date()
+    if isinstance(fecha, date):
+        return fecha
+    fecha_parseada = parse_date(str(fecha))
+    if fecha_parseada is None:
+        raise ValueError(f"Fecha inválida: {fecha}")
+    return fecha_parseada
+
+
+def normalizar_hora(hora):
+    """Acepta time, datetime o 'HH:MM[:SS]' y devuelve un time"""
+    if isinstance(hora, datetime):
+        return hora.time()
+    if isinstance(hora, time):
+        return hora
+    hora_parseada = parse_time(str(hora))
+    if hora_parseada is None:
+        raise ValueError(f"Hora inválida: {hora}")
+    return hora_parseada
+
+
+def solapamiento_en_bd(box_id, fecha, hora_inicio, hora_fin, excluir_ids=()):
+    """Consulta autoritativa de solapamiento contra MySQL.
+
+    El índice es local a cada proceso y puede no ver lo que otro worker
+    escribió hace menos de `INDICE_AGENDAS_TTL` segundos: las rutas que
+    escriben deben decidir con esta consulta, el índice es sólo para lecturas.
+    """
+    return Agendabox.objects.filter(
+        idbox_id=box_id,
+        fechaagenda=fecha,
+        horainicioagenda__lt=hora_fin,
+        horafinagenda__gt=hora_inicio
+    ).exclude(id__in=[i for i in excluir_ids if i is not None]).exists()
+
+
+class _IntervalosBox:
+    """Intervalos de un box en un día, ordenados por hora de inicio.
+
+    `fin_max[i]` guarda el mayor fin entre los intervalos 0..i, de modo que
+    saber si algo solapa [a, b) es un bisect sobre los inicios más una lectura.
+    """
+
+    __slots__ = ('intervalos', 'inicios', 'fin_max')
+
+    def __init__(self):
+        self.intervalos = []
+        self.inicios = []
+        self.fin_max = []
+
+    def _recalcular_fin_max(self, desde=0):
+        fin_max = self.fin_max[:desde]
+        actual = fin_max[-1] if fin_max else None
+        for intervalo in self.intervalos[desde:]:
+            actual = intervalo.fin if actual is None or intervalo.fin > actual else actual
+            fin_max.append(actual)
+        self.fin_max = fin_max
+
+    def agregar(self, intervalo):
+        posicion = bisect_right(self.inicios, intervalo.inicio)
+        self.inicios.insert(posicion, intervalo.inicio)
+        self.intervalos.insert(posicion, intervalo)
+        self._recalcular_fin_max(posicion)
+
+    def quitar(self, agenda_id):
+        for posicion, intervalo in enumerate(self.intervalos):
+            if intervalo.id == agenda_id:
+                del self.intervalos[posicion]
+                del self.inicios[posicion]
+                self._recalcular_fin_max(posicion)
+                return True
+        return False
+
+    def solapados(self, inicio, fin, excluir_ids=()):
+        """Intervalos con inicio < fin y fin > inicio (misma regla que la consulta SQL)"""
+        limite = bisect_left(self.inicios, fin)
+        if limite == 0 or self.fin_max[limite - 1] <= inicio:
+            return []
+        return [
+            intervalo for intervalo in self.intervalos[:limite]
+            if intervalo.fin > inicio and intervalo.id not in excluir_ids
+        ]
+
+    def hay_solapamiento(self, inicio, fin, excluir_ids=()):
+        limite = bisect_left(self.inicios, fin)
+        if limite == 0 or self.fin_max[limite - 1] <= inicio:
+            return False
+        if not excluir_ids:
+            return True
+        return any(
+            intervalo.fin > inicio and intervalo.id not in excluir_ids
+            for intervalo in self.intervalos[:limite]
+        )
+
+
+class IndiceAgendas:
+    """Índice de ocupación por (box, fecha) que se carga bajo demanda.
+
+    Cada fecha se carga completa con una sola consulta la primera vez que se
+    pregunta por ella, fuera del lock. Las vistas que crean, modifican o
+    eliminan reservas actualizan el índice directamente; las inserciones
+    masivas invalidan el día afectado para que se recargue en la siguiente
+    consulta. Como otros procesos también escriben en la BD, cada día cargado
+    expira tras `INDICE_AGENDAS_TTL` segundos, y se conservan como mucho
+    `INDICE_AGENDAS_MAX_DIAS` días (los menos usados se descartan primero).
+    """
+
+    def __init__(self, ttl_segundos=None, max_dias=None):
+        self._ttl = ttl_segundos
+        self._max_dias = max_dias
+        self._lock = threading.Lock()
+        self._dias = OrderedDict()
+        # Días cargándose: pasan a True si se escribe sobre ellos mientras tanto
+        self._cargando = {}
+        self.version = 0
+
+    @property
+    def ttl(self):
+        if self._ttl is not None:
+            return self._ttl
+        return getattr(settings, 'INDICE_AGENDAS_TTL', 60)
+
+    @property
+    def max_dias(self):
+        if self._max_dias is not None:
+            return self._max_dias
+        return getattr(settings, 'INDICE_AGENDAS_MAX_DIAS', 62)
+
+    def _cargar_dia(self, fecha):
+        boxes = {}
+        filas = Agendabox.objects.filter(fechaagenda=fecha).values_list(
+            'id', 'idbox_id', 'horainicioagenda', 'horafinagenda', 'idmedico_id', 'esMedica'
+        )
+        for agenda_id, box_id, inicio, fin, medico_id, es_medica in filas:
+            if inicio is None or fin is None:
+                continue
+            boxes.setdefault(box_id, _IntervalosBox()).agregar(
+                IntervaloAgenda(inicio, fin, agenda_id, medico_id, es_medica)
+            )
+        logger.debug(f"Índice de agendas cargado para {fecha}: {len(boxes)} boxes")
+        return {'cargado_en': reloj.monotonic(), 'boxes': boxes}
+
+    def _vigente(self, fecha):
+        dia = self._dias.get(fecha)
+        if dia is None or reloj.monotonic() - dia['cargado_en'] > self.ttl:
+            return None
+        self._dias.move_to_end(fecha)
+        return dia
+
+    def _marcar_escritura(self, fecha=None):
+        for cargando in ([fecha] if fecha is not None else list(self._cargando)):
+            if cargando in self._cargando:
+                self._cargando[cargando] = True
+
+    def _dia(self, fecha):
+        fecha = normalizar_fecha(fecha)
+        with self._lock:
+            dia = self._vigente(fecha)
+            if dia is not None:
+                return dia
+            self._cargando.setdefault(fecha, False)
+
+        # La consulta no bloquea al resto de los días
+        dia = self._cargar_dia(fecha)
+
+        with self._lock:
+            actual = self._vigente(fecha)
+            if actual is not None:
+                # Otro hilo lo cargó mientras tanto
+                self._cargando.pop(fecha, None)
+                return actual
+            if self._cargando.pop(fecha, False):
+                # Hubo escrituras durante la carga: se usa para esta consulta sin guardarlo
+                return dia
+            self._dias[fecha] = dia
+            while len(self._dias) > self.max_dias:
+                self._dias.popitem(last=False)
+            self.version += 1
+            return dia
+
+    @staticmethod
+    def _box(dia, box_id):
+        return dia['boxes'].get(int(box_id))
+
+    # Consultas
+
+    def hay_solapamiento(self, box_id, fecha, hora_inicio, hora_fin, excluir_ids=()):
+        """True si el box tiene alguna agenda que se cruza con [hora_inicio, hora_fin)"""
+        inicio, fin = normalizar_hora(hora_inicio), normalizar_hora(hora_fin)
+        excluir = {int(i) for i in excluir_ids if i is not None}
+        dia = self._dia(fecha)
+        with self._lock:
+            intervalos = self._box(dia, box_id)
+            return bool(intervalos) and intervalos.hay_solapamiento(inicio, fin, excluir)
+
+    def solapamientos(self, box_id, fecha, hora_inicio, hora_fin, excluir_ids=()):
+        """Agendas del box que se cruzan con [hora_inicio, hora_fin), ordenadas por inicio"""
+        inicio, fin = normalizar_hora(hora_inicio), normalizar_hora(hora_fin)
+        excluir = {int(i) for i in excluir_ids if i is not None}
+        dia = self._dia(fecha)
+        with self._lock:
+            intervalos = self._box(dia, box_id)
+            return intervalos.solapados(inicio, fin, excluir) if intervalos else []
+
+    def ocupantes(self, box_id, fecha, hora, incluir_fin=False):
+        """Agendas en curso a la hora dada (inicio < hora < fin, o <= fin si incluir_fin)"""
+        hora = normalizar_hora(hora)
+        dia = self._dia(fecha)
+        with self._lock:
+            intervalos = self._box(dia, box_id)
+            if not intervalos:
+                return []
+            limite = bisect_left(intervalos.inicios, hora)
+            return [
+                intervalo for intervalo in intervalos.intervalos[:limite]
+                if intervalo.fin > hora or (incluir_fin and intervalo.fin == hora)
+            ]
+
+    def intervalos_box(self, box_id, fecha):
+        """Copia de las agendas del box en la fecha, ordenadas por inicio"""
+        dia = self._dia(fecha)
+        with self._lock:
+            intervalos = self._box(dia, box_id)
+            return list(intervalos.intervalos) if intervalos else []
+
+    def asegurar_dia(self, fecha):
+        """Carga el día si no está vigente, sin copiar sus agendas"""
+        self._dia(fecha)
+
+    def intervalos_dia(self, fecha):
+        """{box_id: [IntervaloAgenda, ...]} para todos los boxes con agendas en la fecha"""
+        dia = self._dia(fecha)
+        with self._lock:
+            return {
+                box_id: list(intervalos.intervalos)
+                for box_id, intervalos in dia['boxes'].items()
+            }
+
+    def bloques_libres(self, box_id, fecha, desde=time(8, 0), hasta=time(18, 0), duracion_min=0):
+        """Huecos libres del box entre `desde` y `hasta` de al menos `duracion_min` minutos"""
+        fecha = normalizar_fecha(fecha)
+        cursor = datetime.combine(fecha, desde)
+        limite = datetime.combine(fecha, hasta)
+        bloques = []
+        for intervalo in self.intervalos_box(box_id, fecha):
+            inicio = datetime.combine(fecha, intervalo.inicio)
+            if cursor < inicio:
+                diferencia = (inicio - cursor).total_seconds() / 60
+                if diferencia >= duracion_min:
+                    bloques.append((cursor.time(), inicio.time(), int(diferencia)))
+            cursor = max(cursor, datetime.combine(fecha, intervalo.fin))
+        if cursor < limite:
+            diferencia = (limite - cursor).total_seconds() / 60
+            if diferencia >= duracion_min:
+                bloques.append((cursor.time(), limite.time(), int(diferencia)))
+        return bloques
+
+    # Mantenimiento desde las rutas de escritura
+
+    def registrar(self, agenda):
+        """Agrega una agenda recién guardada a su día, si ese día ya está cargado"""
+        if agenda.horainicioagenda is None or agenda.horafinagenda is None:
+            return
+        fecha = normalizar_fecha(agenda.fechaagenda)
+        with self._lock:
+            self._marcar_escritura(fecha)
+            dia = self._dias.get(fecha)
+            if dia is None:
+                return
+            dia['boxes'].setdefault(int(agenda.idbox_id), _IntervalosBox()).agregar(
+                IntervaloAgenda(
+                    normalizar_hora(agenda.horainicioagenda),
+                    normalizar_hora(agenda.horafinagenda),
+                    agenda.id,
+                    agenda.idmedico_id,
+                    agenda.esMedica,
+                )
+            )
+            self.version += 1
+
+    def quitar(self, agenda_id, box_id, fecha):
+        """Quita una agenda eliminada o movida de su (box, fecha) anterior"""
+        fecha = normalizar_fecha(fecha)
+        with self._lock:
+            self._marcar_escritura(fecha)
+            dia = self._dias.get(fecha)
+            if dia is None:
+                return
+            intervalos = dia['boxes'].get(int(box_id))
+            if intervalos and intervalos.quitar(agenda_id):
+                self.version += 1
+
+    def actualizar(self, agenda, box_anterior, fecha_anterior):
+        """Refleja una agenda modificada: la quita de su posición anterior y la vuelve a agregar"""
+        self.quitar(agenda.id, box_anterior, fecha_anterior)
+        self.registrar(agenda)
+
+    def invalidar(self, fecha=None):
+        """Descarta un día (o todo el índice) para que se recargue en la próxima consulta"""
+        fecha = normalizar_fecha(fecha) if fecha is not None else None
+        with self._lock:
+            self._marcar_escritura(fecha)
+            if fecha is None:
+                self._dias.clear()
+            else:
+                self._dias.pop(fecha, None)
+            self.version += 1
+
+    def invalidar_agendas(self, agendas):
+        """Invalida los días tocados por una inserción masiva"""
+        fechas = {normalizar_fecha(agenda.fechaagenda) for agenda in agendas if agenda.fechaagenda}
+        for fecha in fechas:
+            self.invalidar(fecha)
+
+
+indice_agendas = IndiceAgendas()
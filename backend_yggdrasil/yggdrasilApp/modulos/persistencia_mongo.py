@@ -0,0 +1,138 @@
+"""
+Persistencia en lote para las colecciones MongoDB
+Inserciones y upserts con bulk_write/insert_many sobre pymongo, y
+actualizaciones puntuales ($set / $push) de implementos del inventario
+sin reescribir el documento completo
+"""
+from datetime import datetime
+from itertools import islice
+
+from mongoengine.errors import ValidationError
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from ..mongo_models import Implemento, InventarioBox
+import logging
+
+logger = logging.getLogger(__name__)
+
+TAMANO_LOTE = 1000
+
+
+def _lotes(iterable, tamano):
+    iterador = iter(iterable)
+    while True:
+        lote = list(islice(iterador, tamano))
+        if not lote:
+            return
+        yield lote
+
+
+def a_documento(documento):
+    """Valida un Document de mongoengine y lo convierte al dict que se guarda"""
+    documento.validate()
+    datos = documento.to_mongo().to_dict()
+    datos.pop('_id', None)
+    return datos
+
+
+def insertar_documentos(modelo, documentos, tamano_lote=TAMANO_LOTE):
+    """Inserta Documents (o dicts ya convertidos) con insert_many por lotes.
+
+    Los lotes no son ordenados: un documento duplicado o inválido no frena
+    al resto y se informa en el log. Devuelve la cantidad insertada.
+    """
+    coleccion = modelo._get_collection()
+    insertados = 0
+    for lote in _lotes(documentos, tamano_lote):
+        datos = [d if isinstance(d, dict) else a_documento(d) for d in lote]
+        try:
+            insertados += len(coleccion.insert_many(datos, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            insertados += e.details.get('nInserted', 0)
+            logger.warning(
+                f"{len(e.details.get('writeErrors', []))} documentos de "
+                f"{modelo._meta['collection']} no se insertaron"
+            )
+    return insertados
+
+
+def upsert_documentos(modelo, documentos, claves, solo_insertar=False, tamano_lote=TAMANO_LOTE):
+    """Upsert de Documents (o dicts) identificados por los campos `claves` con bulk_write.
+
+    Cada documento reemplaza por completo al existente (ReplaceOne): un campo
+    que falta en el nuevo no sobrevive del anterior. Con `solo_insertar` los
+    documentos que ya existen no se modifican ($setOnInsert). Devuelve la
+    cantidad de documentos creados o modificados.
+    """
+    coleccion = modelo._get_collection()
+    escritos = 0
+    for lote in _lotes(documentos, tamano_lote):
+        operaciones = []
+        for documento in lote:
+            datos = documento if isinstance(documento, dict) else a_documento(documento)
+            filtro = {clave: datos[clave] for clave in claves}
+            if solo_insertar:
+                operaciones.append(UpdateOne(filtro, {'$setOnInsert': datos}, upsert=True))
+            else:
+                operaciones.append(ReplaceOne(filtro, datos, upsert=True))
+        resultado = coleccion.bulk_write(operaciones, ordered=False)
+        escritos += resultado.upserted_count + resultado.modified_count
+    return escritos
+
+
+def guardar_documento(documento, claves):
+    """Upsert de un único Document por sus `claves` (reemplaza a .save())"""
+    return upsert_documentos(type(documento), [documento], claves)
+
+
+# Inventario de implementos
+
+def agregar_implemento(box_id, implemento, usuario='sistema'):
+    """Agrega un Implemento al inventario del box con $push, creándolo si no existe"""
+    implemento.validate()
+    ahora = datetime.now()
+    InventarioBox._get_collection().update_one(
+        {'box_id': int(box_id)},
+        {
+            '$push': {'implementos': implemento.to_mongo().to_dict()},
+            '$set': {'updated_at': ahora, 'updated_by': usuario},
+            '$setOnInsert': {'created_at': ahora},
+        },
+        upsert=True
+    )
+    return implemento
+
+
+def actualizar_implemento(box_id, nombre, cambios, usuario='sistema'):
+    """Actualiza campos de los implementos llamados `nombre` con $set y array_filters.
+
+    Devuelve el implemento actualizado (dict) o None si el box no tiene un
+    implemento con ese nombre. Sólo se escriben los campos indicados, que
+    se validan con los de Implemento (ValidationError si alguno no existe o
+    su valor no es válido).
+    """
+    actualizacion = {}
+    for campo, valor in cambios.items():
+        definicion = Implemento._fields.get(campo)
+        if definicion is None:
+            raise ValidationError(f"Implemento no tiene el campo '{campo}'", field_name=campo)
+        if valor is None:
+            if definicion.required:
+                raise ValidationError(f"El campo '{campo}' es obligatorio", field_name=campo)
+        else:
+            definicion.validate(valor)
+            valor = definicion.to_mongo(valor)
+        actualizacion[f'implementos.$[impl].{campo}'] = valor
+    actualizacion.update({'updated_at': datetime.now(), 'updated_by': usuario})
+
+    inventario = InventarioBox._get_collection().find_one_and_update(
+        {'box_id': int(box_id), 'implementos.nombre': nombre},
+        {'$set': actualizacion},
+        array_filters=[{'impl.nombre': nombre}],
+        projection={'implementos': {'$elemMatch': {'nombre': nombre}}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not inventario or not inventario.get('implementos'):
+        return None
+    return inventario['implementos'][0]
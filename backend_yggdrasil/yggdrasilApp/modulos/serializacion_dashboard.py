@@ -0,0 +1,87 @@
+"""
+Respuestas del dashboard serializadas una sola vez
+Al precalcular se arma el JSON completo de la respuesta, sus versiones
+comprimidas y el ETag; las lecturas entregan esos bytes tal cual
+"""
+import gzip
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MENSAJE = 'Datos obtenidos desde cache optimizado'
+
+
+def envolver(datos, mensaje=MENSAJE):
+    """Cuerpo de la respuesta de DashboardOptimizadoView"""
+    return {
+        'success': True,
+        'data': datos,
+        'optimizado': True,
+        'mensaje': mensaje
+    }
+
+
+def serializar(datos):
+    """{'json', 'gzip', 'br', 'etag'} de la respuesta con los datos del dashboard.
+
+    El JSON usa el mismo formato compacto que el renderer de DRF. 'br' es
+    None si brotli no está instalado o está desactivado.
+    """
+    cuerpo = json.dumps(
+        envolver(datos), cls=DjangoJSONEncoder, ensure_ascii=False, separators=(',', ':')
+    ).encode('utf-8')
+    nivel = getattr(settings, 'DASHBOARD_GZIP_NIVEL', 6)
+    comprimido_br = None
+    if brotli is not None and getattr(settings, 'DASHBOARD_BROTLI', True):
+        comprimido_br = brotli.compress(cuerpo)
+    return {
+        'json': cuerpo,
+        'gzip': gzip.compress(cuerpo, compresslevel=nivel, mtime=0),
+        'br': comprimido_br,
+        'etag': '"' + hashlib.blake2b(cuerpo, digest_size=16).hexdigest() + '"',
+    }
+
+
+def datos(entrada):
+    """Datos del dashboard contenidos en una entrada serializada"""
+    return json.loads(entrada['json'])['data']
+
+
+def elegir_codificacion(entrada, accept_encoding):
+    """(bytes, Content-Encoding o None) según lo que acepta el cliente"""
+    aceptadas = set()
+    for parte in (accept_encoding or '').split(','):
+        nombre, _, parametros = parte.partition(';')
+        if parametros.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        aceptadas.add(nombre.strip().lower())
+    if 'br' in aceptadas and entrada.get('br'):
+        return entrada['br'], 'br'
+    if 'gzip' in aceptadas and entrada.get('gzip'):
+        return entrada['gzip'], 'gzip'
+    return entrada['json'], None
+
+
+def etag_codificado(etag, codificacion):
+    """ETag de la representación: cada Content-Encoding lleva su sufijo dentro de las comillas"""
+    if not codificacion:
+        return etag
+    return f'{etag[:-1]}-{codificacion}"'
+
+
+def etag_coincide(etag, etags_cliente):
+    """True si If-None-Match trae el ETag en cualquiera de sus codificaciones (o '*')"""
+    if '*' in etags_cliente:
+        return True
+    variantes = {etag_codificado(etag, codificacion) for codificacion in (None, 'gzip', 'br')}
+    return not variantes.isdisjoint(etags_cliente)
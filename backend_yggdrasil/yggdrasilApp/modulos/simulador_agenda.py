@@ -1,5 +1,10 @@
 
+from bisect import bisect_left, bisect_right
+from datetime import date
+import numpy as np
+import pandas as pd
 from ..models import Agendabox
+from .indice_agendas import indice_agendas
 
 class SimuladorAgenda:
     def simular(self, datos):
@@ -22,12 +27,12 @@ class SimuladorAgenda:
         """
         Revisa en base de datos si existe solapamiento con la agenda dada
         """
-        return Agendabox.objects.filter(
-            idbox=agenda.idbox,
-            fechaagenda=agenda.fechaagenda,
-            horainicioagenda__lt=agenda.horafinagenda,
-            horafinagenda__gt=agenda.horainicioagenda
-        ).exists()
+        return indice_agendas.hay_solapamiento(
+            agenda.idbox_id,
+            agenda.fechaagenda,
+            agenda.horainicioagenda,
+            agenda.horafinagenda
+        )
     
 
     def existe_solapamiento_lista(self, lista_agendas, nueva_agenda):
@@ -45,3 +50,139 @@ class SimuladorAgenda:
         return False
 
 
+
+
+def _a_microsegundos(horas):
+    return np.fromiter(
+        ((h.hour * 3600 + h.minute * 60 + h.second) * 1_000_000 + h.microsecond for h in horas),
+        dtype=np.int64,
+        count=len(horas)
+    )
+
+
+class SimuladorAgendaLote:
+    """Simulación de cargas masivas en una sola pasada.
+
+    Mantiene la semántica de `SimuladorAgenda` (primera en llegar gana):
+    una fila se rechaza si choca con una agenda de la BD o con una fila
+    anterior del mismo archivo que haya sido aprobada; las rechazadas no
+    bloquean a las siguientes.
+
+    1. Las agendas existentes de los boxes/fechas del archivo se leen con
+       una sola consulta y el cruce con la BD se resuelve vectorizado:
+       intervalos ordenados por (grupo, inicio) con el máximo acumulado del
+       fin, y un searchsorted por fila.
+    2. Entre filas del archivo se barre cada (box, fecha) en orden de
+       llegada sobre los intervalos ya aprobados, que son disjuntos y se
+       consultan con bisect.
+    """
+
+    # Separación entre grupos al codificar (grupo, hora) en un solo int64
+    _ESCALA_GRUPO = 2 * 86_400 * 1_000_000
+
+    def simular(self, datos):
+        if not datos:
+            return [], []
+
+        box_ids = np.fromiter((a.idbox_id for a in datos), dtype=np.int64, count=len(datos))
+        fechas = np.fromiter(
+            (a.fechaagenda.toordinal() for a in datos), dtype=np.int64, count=len(datos)
+        )
+        inicios = _a_microsegundos([a.horainicioagenda for a in datos])
+        fines = _a_microsegundos([a.horafinagenda for a in datos])
+
+        # Grupo denso por (box, fecha) compartido entre el archivo y la BD
+        claves = pd.MultiIndex.from_arrays([box_ids, fechas])
+        grupos_archivo, claves_unicas = pd.factorize(claves)
+
+        aprobable = ~self._choca_con_bdd(grupos_archivo, claves_unicas, inicios, fines)
+        aprobada = self._barrer_archivo(grupos_archivo, inicios, fines, aprobable)
+
+        aprobadas = [agenda for agenda, ok in zip(datos, aprobada) if ok]
+        desaprobadas = [agenda for agenda, ok in zip(datos, aprobada) if not ok]
+        return aprobadas, desaprobadas
+
+    def _choca_con_bdd(self, grupos_archivo, claves_unicas, inicios, fines):
+        """True por fila si se cruza con alguna agenda existente de su (box, fecha)"""
+        box_unicos = {int(b) for b, _ in claves_unicas}
+        fechas_unicas = {date.fromordinal(int(f)) for _, f in claves_unicas}
+        existentes = pd.DataFrame.from_records(
+            Agendabox.objects.filter(
+                idbox__in=box_unicos,
+                fechaagenda__in=fechas_unicas,
+                horafinagenda__isnull=False
+            ).values_list('idbox_id', 'fechaagenda', 'horainicioagenda', 'horafinagenda'),
+            columns=['box', 'fecha', 'inicio', 'fin']
+        )
+        choca = np.zeros(len(grupos_archivo), dtype=bool)
+        if existentes.empty:
+            return choca
+
+        claves_bdd = pd.MultiIndex.from_arrays([
+            existentes['box'].to_numpy(dtype=np.int64),
+            np.fromiter((f.toordinal() for f in existentes['fecha']), dtype=np.int64, count=len(existentes)),
+        ])
+        grupos_bdd = claves_unicas.get_indexer(claves_bdd)
+        en_archivo = grupos_bdd >= 0
+        if not en_archivo.any():
+            return choca
+
+        grupos_bdd = grupos_bdd[en_archivo]
+        inicio_bdd = _a_microsegundos(list(existentes['inicio'][en_archivo]))
+        fin_bdd = _a_microsegundos(list(existentes['fin'][en_archivo]))
+
+        orden = np.lexsort((inicio_bdd, grupos_bdd))
+        desplazamiento = grupos_bdd[orden] * self._ESCALA_GRUPO
+        inicio_codificado = desplazamiento + inicio_bdd[orden]
+        # Como los grupos están ordenados, el máximo acumulado no cruza de un grupo a otro
+        fin_max_codificado = np.maximum.accumulate(desplazamiento + fin_bdd[orden])
+
+        desplazamiento_archivo = grupos_archivo * self._ESCALA_GRUPO
+        limite = np.searchsorted(inicio_codificado, desplazamiento_archivo + fines, side='left')
+        previo = limite - 1
+        valido = previo >= 0
+        previo = np.where(valido, previo, 0)
+        mismo_grupo = valido & (desplazamiento[previo] == desplazamiento_archivo)
+        choca[mismo_grupo] = (
+            fin_max_codificado[previo[mismo_grupo]] - desplazamiento_archivo[mismo_grupo]
+            > inicios[mismo_grupo]
+        )
+        return choca
+
+    def _barrer_archivo(self, grupos, inicios, fines, aprobable):
+        """Decide cada fila en orden de llegada contra lo ya aprobado de su grupo"""
+        aprobada = np.zeros(len(grupos), dtype=bool)
+        candidatas = np.flatnonzero(aprobable)
+        # Orden estable por grupo: dentro de cada grupo se respeta el orden del archivo
+        candidatas = candidatas[np.argsort(grupos[candidatas], kind='stable')]
+
+        grupo_actual = None
+        for fila in candidatas:
+            grupo = grupos[fila]
+            if grupo != grupo_actual:
+                grupo_actual = grupo
+                aprobados_inicio = []
+                aprobados_fin = []
+                # Intervalos de duración nula o negativa: no mantienen el orden por fin
+                degenerados = []
+            inicio, fin = inicios[fila], fines[fila]
+
+            if any(d_inicio < fin and d_fin > inicio for d_inicio, d_fin in degenerados):
+                continue
+            if fin <= inicio:
+                if any(a_inicio < fin and a_fin > inicio for a_inicio, a_fin in zip(aprobados_inicio, aprobados_fin)):
+                    continue
+                degenerados.append((inicio, fin))
+                aprobada[fila] = True
+                continue
+
+            posicion = bisect_left(aprobados_inicio, fin)
+            # Los aprobados normales son disjuntos y quedan ordenados también
+            # por fin: basta mirar el anterior al límite
+            if posicion > 0 and aprobados_fin[posicion - 1] > inicio:
+                continue
+            insercion = bisect_right(aprobados_inicio, inicio)
+            aprobados_inicio.insert(insercion, inicio)
+            aprobados_fin.insert(insercion, fin)
+            aprobada[fila] = True
+        return aprobada
@@ -0,0 +1,203 @@
+"""
+Tablero de estado de todos los boxes (o de un pasillo) en una sola respuesta
+Última, actual y próxima atención más el estado de ocupación de cada box
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import hashlib
+import json
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from ..models import Agendabox, Medico
+from .cache_referencia import snapshot_boxes
+from .indice_agendas import indice_agendas
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_TABLEROS_EN_CACHE = 32
+
+
+def _formatear(fecha, hora, hoy):
+    """Mismo formato relativo que BoxListView: Hoy, Mañana o dd/mm/YYYY + hora"""
+    if not fecha or not hora:
+        return "N/A"
+    if fecha == hoy:
+        dia = "Hoy"
+    elif fecha == hoy + timedelta(days=1):
+        dia = "Mañana"
+    else:
+        dia = fecha.strftime("%d/%m/%Y")
+    return f"{dia} {hora.strftime('%H:%M')}"
+
+
+def _tipo(es_medica):
+    return 'No Médica' if es_medica == 0 else 'Médica'
+
+
+def _primera_por_box(queryset, orden, box_ids):
+    """Primera agenda de cada box según `orden`, con ROW_NUMBER() en una consulta"""
+    if not box_ids:
+        return {}
+    filas = queryset.filter(idbox__in=box_ids).annotate(
+        n=Window(RowNumber(), partition_by=[F('idbox')], order_by=orden)
+    ).filter(n=1).values_list('idbox_id', 'id', 'fechaagenda', 'horainicioagenda', 'horafinagenda', 'esMedica')
+    return {fila[0]: fila[1:] for fila in filas}
+
+
+def _mas_cercana_por_box(box_ids, hoy, anteriores):
+    """Última agenda anterior a hoy (o primera posterior) de cada box.
+
+    Primero mira sólo los `TABLERO_VENTANA_DIAS` días más cercanos; los boxes
+    sin agendas en esa ventana se buscan después sin límite de fecha.
+    """
+    ventana = timedelta(days=getattr(settings, 'TABLERO_VENTANA_DIAS', 31))
+    if anteriores:
+        orden = [F('fechaagenda').desc(), F('horafinagenda').desc()]
+        cercanas = Agendabox.objects.filter(fechaagenda__lt=hoy, fechaagenda__gte=hoy - ventana)
+        lejanas = Agendabox.objects.filter(fechaagenda__lt=hoy - ventana)
+    else:
+        orden = [F('fechaagenda').asc(), F('horainicioagenda').asc()]
+        cercanas = Agendabox.objects.filter(fechaagenda__gt=hoy, fechaagenda__lte=hoy + ventana)
+        lejanas = Agendabox.objects.filter(fechaagenda__gt=hoy + ventana)
+    encontradas = _primera_por_box(cercanas, orden, box_ids)
+    encontradas.update(_primera_por_box(lejanas, orden, [b for b in box_ids if b not in encontradas]))
+    return encontradas
+
+
+def _vigente_hasta(intervalos_hoy, box_ids, ahora):
+    """Momento en que el tablero calculado a la hora `ahora` deja de ser válido.
+
+    Los estados sólo cambian al pasar por el inicio o el fin de alguna agenda
+    del día: el tablero sirve hasta el próximo de esos bordes (o sólo este
+    minuto si `ahora` cae justo en uno), y como mucho hasta medianoche.
+    """
+    hora = ahora.time()
+    bordes = {
+        borde
+        for box_id in box_ids
+        for intervalo in intervalos_hoy.get(box_id, [])
+        for borde in (intervalo.inicio, intervalo.fin)
+    }
+    if hora in bordes:
+        return ahora + timedelta(minutes=1)
+    siguiente = min((borde for borde in bordes if borde > hora), default=None)
+    if siguiente is None:
+        return datetime.combine(ahora.date() + timedelta(days=1), datetime.min.time())
+    return datetime.combine(ahora.date(), siguiente)
+
+
+def _calcular_tablero(boxes, ahora):
+    hoy, hora = ahora.date(), ahora.time()
+    box_ids = [box['idbox'] for box in boxes]
+    intervalos_hoy = indice_agendas.intervalos_dia(hoy)
+
+    ultimas, proximas, actuales, estados = {}, {}, {}, {}
+    for box_id in box_ids:
+        ultima = proxima = actual = None
+        ocupantes = 0
+        for intervalo in intervalos_hoy.get(box_id, []):
+            if intervalo.fin < hora and (ultima is None or intervalo.fin > ultima.fin):
+                ultima = intervalo
+            if intervalo.inicio >= hora and proxima is None:
+                proxima = intervalo
+            if intervalo.inicio < hora and intervalo.fin >= hora and actual is None:
+                actual = intervalo
+            if intervalo.inicio < hora < intervalo.fin:
+                ocupantes += 1
+        if ultima:
+            ultimas[box_id] = (ultima.id, hoy, ultima.inicio, ultima.fin, ultima.esMedica)
+        if proxima:
+            proximas[box_id] = (proxima.id, hoy, proxima.inicio, proxima.fin, proxima.esMedica)
+        if actual:
+            actuales[box_id] = actual
+        estados[box_id] = ocupantes
+
+    # Sólo los boxes sin última/próxima hoy necesitan mirar otros días
+    ultimas.update(_mas_cercana_por_box([b for b in box_ids if b not in ultimas], hoy, anteriores=True))
+    proximas.update(_mas_cercana_por_box([b for b in box_ids if b not in proximas], hoy, anteriores=False))
+
+    medicos = Medico.objects.in_bulk({a.idmedico for a in actuales.values() if a.idmedico})
+
+    filas = []
+    for box in boxes:
+        box_id = box['idbox']
+        ultima = ultimas.get(box_id)
+        proxima = proximas.get(box_id)
+        actual = actuales.get(box_id)
+        medico = medicos.get(actual.idmedico) if actual else None
+        ocupantes = estados[box_id]
+
+        filas.append({
+            'idbox': box_id,
+            'pasillobox': box['pasillobox'],
+            'estadobox': box['estadobox'],
+            'especialidad_principal': box['especialidad_principal'],
+            'estado': 'Disponible' if ocupantes == 0 else 'Ocupado' if ocupantes == 1 else 'Tope',
+            'ult': f"{_formatear(ultima[1], ultima[3], hoy)} ({_tipo(ultima[4])})" if ultima else "N/A",
+            'prox': f"{_formatear(proxima[1], proxima[2], hoy)} ({_tipo(proxima[4])})" if proxima else "N/A",
+            'med': f"Dr. {medico.nombre} ({_tipo(actual.esMedica)})" if medico else "N/A",
+            'ultima_id': ultima[0] if ultima else None,
+            'actual_id': actual.id if actual else None,
+            'proxima_id': proxima[0] if proxima else None,
+        })
+    return filas, _vigente_hasta(intervalos_hoy, box_ids, ahora)
+
+
+class TableroBoxes:
+    """Arma el tablero y lo cachea por (pasillo, día, versiones de índice y snapshot).
+
+    Cada tablero cacheado, con su ETag, sirve hasta el próximo inicio o fin
+    de agenda del día, así los minutos sin cambios no lo recalculan. El
+    índice recarga el día cada `INDICE_AGENDAS_TTL` segundos y eso cambia su
+    versión, lo que acota también las escrituras hechas por otros procesos.
+    El ETag se calcula sobre el contenido, así un tablero que no cambió
+    conserva su ETag aunque se haya recargado el índice, y el cliente recibe
+    304 sin cuerpo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def obtener(self, pasillo=None, ahora=None):
+        """Devuelve (payload, etag) para el pasillo indicado (o todos)"""
+        ahora = (ahora or datetime.now()).replace(second=0, microsecond=0)
+        hoy = ahora.date()
+
+        boxes, version_boxes = snapshot_boxes.obtener()
+        # Cargar el día antes de tomar la versión: cargarlo puede incrementarla
+        indice_agendas.asegurar_dia(hoy)
+        clave = (pasillo, hoy, indice_agendas.version, version_boxes)
+
+        with self._lock:
+            en_cache = self._cache.get(clave)
+            if en_cache is not None and en_cache[0] <= ahora < en_cache[1]:
+                self._cache.move_to_end(clave)
+                return en_cache[2], en_cache[3]
+
+        if pasillo:
+            boxes = [box for box in boxes if box['pasillobox'] == pasillo]
+        filas, vigente_hasta = _calcular_tablero(boxes, ahora)
+        payload = {
+            'fecha': hoy,
+            'pasillo': pasillo,
+            'boxes': filas,
+        }
+        contenido = json.dumps(payload, cls=DjangoJSONEncoder, sort_keys=True)
+        etag = '"' + hashlib.md5(contenido.encode()).hexdigest() + '"'
+
+        with self._lock:
+            self._cache[clave] = (ahora, vigente_hasta, payload, etag)
+            self._cache.move_to_end(clave)
+            while len(self._cache) > MAX_TABLEROS_EN_CACHE:
+                self._cache.popitem(last=False)
+        return payload, etag
+
+
+tablero_boxes = TableroBoxes()
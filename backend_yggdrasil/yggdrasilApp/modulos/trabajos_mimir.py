@@ -0,0 +1,360 @@
+"""
+Trabajos asíncronos de Mimir (resolución de topes y soluciones alternativas)
+Cada solicitud devuelve un id de trabajo al instante; el cálculo corre en un
+pool acotado y el avance y el resultado se publican en el grupo de Channels
+del trabajo. El estado de los trabajos y los resultados (por firma del
+conflicto) se guardan en el cache compartido
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+import threading
+import time as reloj
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLAVE_GENERACION = 'mimir_generacion'
+
+EN_COLA = 'en_cola'
+EN_PROCESO = 'en_proceso'
+COMPLETADO = 'completado'
+ERROR = 'error'
+
+
+# Firma y resultados guardados
+
+def generacion_actual():
+    """Generación de los datos de agenda; cambia con cada invalidación del dashboard"""
+    return cache.get_or_set(CLAVE_GENERACION, 1, None)
+
+
+def invalidar_resultados(motivo=None):
+    """Descarta los resultados guardados (se llama al cambiar agendas o boxes)"""
+    try:
+        cache.incr(CLAVE_GENERACION)
+    except ValueError:
+        cache.set(CLAVE_GENERACION, 2, None)
+    logger.debug(f"Resultados de Mimir invalidados ({motivo})")
+
+
+def firma(tipo, parametros):
+    """Firma del conflicto: tipo de trabajo, parámetros normalizados y generación de datos"""
+    contenido = json.dumps([tipo, parametros, generacion_actual()], cls=DjangoJSONEncoder, sort_keys=True)
+    return hashlib.sha1(contenido.encode()).hexdigest()
+
+
+def _clave_resultado(firma_trabajo):
+    return f'mimir_resultado_{firma_trabajo}'
+
+
+def _clave_trabajo(trabajo_id):
+    return f'mimir_trabajo_{trabajo_id}'
+
+
+def _clave_en_curso(firma_trabajo):
+    return f'mimir_en_curso_{firma_trabajo}'
+
+
+def grupo_trabajo(trabajo_id):
+    """Grupo de Channels al que se publica el avance de un trabajo"""
+    return f'mimir_{trabajo_id}'
+
+
+def _a_json(datos):
+    # Fechas y decimales a texto, como los serializaría la respuesta HTTP
+    return json.loads(json.dumps(datos, cls=DjangoJSONEncoder))
+
+
+# Cálculos
+
+def detallar_reservas(reservas_ids):
+    """Información básica de cada reserva del conflicto, en el orden pedido"""
+    from ..models import Agendabox
+
+    reservas = Agendabox.objects.select_related('idmedico', 'idbox').in_bulk(reservas_ids)
+    detalladas = []
+    for reserva_id in reservas_ids:
+        reserva = reservas.get(reserva_id)
+        if reserva is None:
+            detalladas.append({'id': reserva_id, 'error': 'Reserva no encontrada'})
+            continue
+        detalladas.append({
+            'id': reserva.id,
+            'fecha': reserva.fechaagenda.strftime('%Y-%m-%d') if reserva.fechaagenda else None,
+            'hora_inicio': str(reserva.horainicioagenda) if reserva.horainicioagenda else None,
+            'hora_fin': str(reserva.horafinagenda) if reserva.horafinagenda else None,
+            'medico': reserva.idmedico.nombre if reserva.idmedico else 'N/A',
+            'medico_id': reserva.idmedico.idmedico if reserva.idmedico else None,
+            'box_actual': reserva.idbox.idbox if reserva.idbox else 'N/A',
+            'box_actual_id': reserva.idbox.idbox if reserva.idbox else None,
+            'pasillo_actual': reserva.idbox.pasillobox if reserva.idbox else 'N/A',
+            # Campos que no existen en el modelo real
+            'paciente': 'N/A',
+            'paciente_id': None,
+            'estado': 'N/A',
+            'observaciones': reserva.observaciones if reserva.observaciones else ''
+        })
+    return detalladas
+
+
+def resolver_tope(parametros, progreso=None):
+    """Recomendaciones para un tope; parametros = {'reservas': [ids]}"""
+    from ..utils.resolutor_agendas import ResolutorConflictosAgenda
+
+    reservas_ids = parametros['reservas']
+    resultado = ResolutorConflictosAgenda().resolver_conflicto_agendas(reservas_ids, progreso=progreso)
+    if 'error' in resultado:
+        return resultado
+    resultado['reservas_detalladas'] = detallar_reservas(reservas_ids)
+    return resultado
+
+
+def soluciones_alternativas(parametros, progreso=None):
+    """Boxes libres en el horario, ordenados por compatibilidad con las especialidades.
+
+    parametros = {'fecha': 'YYYY-MM-DD', 'hora_inicio': 'HH:MM:SS', 'hora_fin':
+    'HH:MM:SS', 'duracion': minutos o None, 'especialidades': [nombres]}
+    """
+    from ..utils.resolutor_agendas import ResolutorConflictosAgenda
+    from .cache_referencia import tipos_boxes
+
+    avisar = progreso or (lambda porcentaje, etapa: None)
+    fecha = datetime.strptime(parametros['fecha'], '%Y-%m-%d').date()
+    hora_inicio = datetime.strptime(parametros['hora_inicio'], '%H:%M:%S').time()
+    hora_fin = datetime.strptime(parametros['hora_fin'], '%H:%M:%S').time()
+    especialidades = parametros['especialidades']
+
+    # Convertir especialidades (nombres) a IDs de Tipobox
+    tipos_requeridos = [
+        tipo_id for tipo_id, tipo in tipos_boxes.obtener()[0]['tipos'].items()
+        if tipo in especialidades
+    ]
+
+    boxes_libres = ResolutorConflictosAgenda().obtener_boxes_libres(
+        fecha, hora_inicio, hora_fin,
+        tipos_requeridos=tipos_requeridos
+    )
+    avisar(50, 'boxes_libres')
+
+    soluciones = []
+    for box in boxes_libres:
+        box_tipos = tipos_boxes.tipos_de_box(box.idbox)
+        tipos_box_ids = {tipo_id for tipo_id, _, _ in box_tipos}
+        compatibilidad = len(set(tipos_requeridos) & tipos_box_ids) if tipos_requeridos else len(tipos_box_ids)
+
+        soluciones.append({
+            'idbox': box.idbox,
+            'nombre': f"Box {box.idbox}",
+            'pasillo': box.pasillobox,
+            'estado': box.estadobox,
+            'tipos': [
+                {'id': tipo_id, 'nombre': tipo, 'principal': principal}
+                for tipo_id, tipo, principal in box_tipos
+            ],
+            'compatibilidad_especialidades': compatibilidad,
+            'porcentaje_compatibilidad': f"{(compatibilidad / len(tipos_requeridos) * 100):.1f}%" if tipos_requeridos else '100%'
+        })
+
+    # Ordenar por compatibilidad
+    soluciones.sort(key=lambda x: x['compatibilidad_especialidades'], reverse=True)
+
+    return {
+        "soluciones_alternativas": soluciones,
+        "total_alternativas": len(soluciones),
+        "parametros_busqueda": {
+            "fecha": str(fecha),
+            "hora_inicio": str(hora_inicio),
+            "hora_fin": str(hora_fin),
+            "duracion_minutos": parametros.get('duracion'),
+            "especialidades_solicitadas": especialidades,
+            "tipos_ids_requeridos": tipos_requeridos
+        }
+    }
+
+
+CALCULOS = {
+    'resolver_tope': resolver_tope,
+    'soluciones_alternativas': soluciones_alternativas,
+}
+
+
+class ColaTrabajosMimir:
+    """Cola de trabajos de Mimir sobre un pool acotado de hilos.
+
+    `encolar` responde enseguida: si la firma del conflicto ya tiene un
+    resultado guardado el trabajo nace completado, y si hay otro trabajo en
+    curso con la misma firma (en cualquier proceso) se devuelve ese. El
+    estado de cada trabajo vive en el cache compartido (Redis) bajo su id,
+    así que cualquier worker de Daphne puede responder por él durante
+    `MIMIR_TRABAJOS_RETENCION` segundos. El avance y el resultado se
+    publican en el grupo 'mimir_<id>' del trabajo.
+    """
+
+    def __init__(self, max_workers=None, retencion=None):
+        self.max_workers = max_workers or getattr(settings, 'MIMIR_TRABAJOS_WORKERS', 2)
+        self.retencion = retencion if retencion is not None else getattr(
+            settings, 'MIMIR_TRABAJOS_RETENCION', 900)
+        self._lock = threading.Lock()
+        self._pool = None
+        # Trabajos de este proceso que todavía no terminan (sólo para estadísticas)
+        self._locales = {}
+        self._stats = {
+            'solicitudes': 0,
+            'desde_cache': 0,
+            'reutilizados': 0,
+            'ejecuciones': 0,
+            'errores': 0,
+        }
+
+    @property
+    def resultados_ttl(self):
+        return getattr(settings, 'MIMIR_RESULTADOS_TTL', 600)
+
+    def _contar(self, estadistica):
+        with self._lock:
+            self._stats[estadistica] += 1
+
+    def encolar(self, tipo, parametros):
+        """Registra un trabajo y devuelve su estado (dict) sin esperar el cálculo"""
+        calculo = CALCULOS[tipo]
+        firma_trabajo = firma(tipo, parametros)
+        guardado = cache.get(_clave_resultado(firma_trabajo))
+        self._contar('solicitudes')
+
+        if guardado is not None:
+            self._contar('desde_cache')
+            trabajo = self._nuevo(tipo, firma_trabajo)
+            trabajo.update(estado=COMPLETADO, progreso=100, etapa='completado',
+                           resultado=guardado, desde_cache=True, terminado_en=reloj.time())
+            return self._guardar(trabajo)
+
+        trabajo = self._nuevo(tipo, firma_trabajo)
+        self._guardar(trabajo)
+        # add es atómico (SET NX): un solo proceso se queda con la firma
+        if not cache.add(_clave_en_curso(firma_trabajo), trabajo['id'], self.retencion):
+            existente = self.obtener(cache.get(_clave_en_curso(firma_trabajo)))
+            if existente is not None and existente['estado'] in (EN_COLA, EN_PROCESO):
+                cache.delete(_clave_trabajo(trabajo['id']))
+                self._contar('reutilizados')
+                return existente
+            # La marca quedó de un trabajo que ya no existe
+            cache.set(_clave_en_curso(firma_trabajo), trabajo['id'], self.retencion)
+
+        with self._lock:
+            self._locales[trabajo['id']] = EN_COLA
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='mimir')
+            self._pool.submit(self._ejecutar, trabajo, calculo, parametros)
+        return self._vista(trabajo)
+
+    def obtener(self, trabajo_id):
+        """Estado del trabajo (dict) o None si no existe o ya se descartó"""
+        if not trabajo_id:
+            return None
+        trabajo = cache.get(_clave_trabajo(trabajo_id))
+        return self._vista(trabajo) if trabajo else None
+
+    def estadisticas(self):
+        with self._lock:
+            estados = list(self._locales.values())
+            return dict(
+                self._stats,
+                en_cola=estados.count(EN_COLA),
+                en_proceso=estados.count(EN_PROCESO),
+                max_workers=self.max_workers,
+            )
+
+    @staticmethod
+    def _nuevo(tipo, firma_trabajo):
+        return {
+            'id': uuid.uuid4().hex,
+            'tipo': tipo,
+            'firma': firma_trabajo,
+            'estado': EN_COLA,
+            'progreso': 0,
+            'etapa': 'en_cola',
+            'resultado': None,
+            'error': None,
+            'desde_cache': False,
+            'creado_en': reloj.time(),
+            'terminado_en': None,
+        }
+
+    def _guardar(self, trabajo):
+        cache.set(_clave_trabajo(trabajo['id']), trabajo, self.retencion)
+        return self._vista(trabajo)
+
+    @staticmethod
+    def _vista(trabajo, con_resultado=True):
+        vista = dict(trabajo)
+        vista['creado_en'] = datetime.fromtimestamp(trabajo['creado_en']).isoformat()
+        if trabajo['terminado_en'] is not None:
+            vista['terminado_en'] = datetime.fromtimestamp(trabajo['terminado_en']).isoformat()
+        if not con_resultado:
+            vista.pop('resultado')
+        return vista
+
+    def _actualizar(self, trabajo, **cambios):
+        # Sólo el hilo que ejecuta el trabajo lo modifica
+        trabajo.update(cambios)
+        with self._lock:
+            if trabajo['id'] in self._locales:
+                self._locales[trabajo['id']] = trabajo['estado']
+        vista = self._guardar(trabajo)
+        if cambios.get('estado') not in (COMPLETADO, ERROR):
+            vista.pop('resultado')
+        return vista
+
+    def _ejecutar(self, trabajo, calculo, parametros):
+        close_old_connections()
+
+        def progreso(porcentaje, etapa):
+            self._publicar('mimir_progreso', self._actualizar(trabajo, progreso=porcentaje, etapa=etapa))
+
+        try:
+            self._publicar('mimir_progreso', self._actualizar(trabajo, estado=EN_PROCESO, etapa='iniciado'))
+            resultado = _a_json(calculo(parametros, progreso))
+            if 'error' in resultado:
+                raise ValueError(resultado['error'])
+
+            cache.set(_clave_resultado(trabajo['firma']), resultado, self.resultados_ttl)
+            vista = self._actualizar(trabajo, estado=COMPLETADO, progreso=100, etapa='completado',
+                                     resultado=resultado, terminado_en=reloj.time())
+            self._contar('ejecuciones')
+        except Exception as e:
+            logger.error(f"Error en trabajo de Mimir {trabajo['id']}: {str(e)}")
+            vista = self._actualizar(trabajo, estado=ERROR, etapa='error', error=str(e),
+                                     terminado_en=reloj.time())
+            self._contar('errores')
+        finally:
+            if cache.get(_clave_en_curso(trabajo['firma'])) == trabajo['id']:
+                cache.delete(_clave_en_curso(trabajo['firma']))
+            with self._lock:
+                self._locales.pop(trabajo['id'], None)
+            close_old_connections()
+
+        self._publicar('mimir_resultado', vista)
+
+    @staticmethod
+    def _publicar(tipo_mensaje, trabajo):
+        """Envía el estado del trabajo a su grupo 'mimir_<id>' (MimirConsumer)"""
+        try:
+            channel_layer = get_channel_layer()
+            async_to_sync(channel_layer.group_send)(
+                grupo_trabajo(trabajo['id']), {'type': tipo_mensaje, 'trabajo': trabajo}
+            )
+        except Exception as e:
+            logger.error(f"Error enviando avance de Mimir por WebSocket: {str(e)}")
+
+
+cola_mimir = ColaTrabajosMimir()
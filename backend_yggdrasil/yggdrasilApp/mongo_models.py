@@ -204,11 +204,23 @@ class MetricasBasicas(Document):
     }
 
 
+# Formato de los documentos de DashboardCache; se incrementa cuando cambia la
+# respuesta guardada, y los documentos de otras versiones se descartan
+VERSION_DASHBOARD_CACHE = 2
+
+
 class DashboardCache(Document):
-    """Cache optimizado para métricas del dashboard - evita consultas complejas en tiempo real"""
+    """Cache optimizado para métricas del dashboard - evita consultas complejas en tiempo real.
+    
+    Hay un solo documento por (periodo, fecha_inicio, version), que se
+    reemplaza con upsert. `expires_at` marca la vigencia (la invalidación lo
+    adelanta) y MongoDB borra el documento al llegar `purga_en`; mientras
+    tanto sirve como última versión buena.
+    """
     periodo = fields.StringField(required=True, choices=['day', 'week', 'month', 'year'])
     fecha_inicio = fields.DateTimeField(required=True)
     fecha_fin = fields.DateTimeField(required=True)
+    version = fields.IntField(required=True, default=VERSION_DASHBOARD_CACHE)
     
     # Métricas pre-calculadas (lo que actualmente calculas en tiempo real)
     total_boxes = fields.IntField(default=0)
@@ -245,12 +257,27 @@ class DashboardCache(Document):
     tiempo_calculo_ms = fields.IntField()  # Para monitorear performance
     created_at = fields.DateTimeField(default=datetime.now)
     expires_at = fields.DateTimeField()  # TTL del cache
+    purga_en = fields.DateTimeField()  # Índice TTL: borrado automático
+    
+    # Respuesta HTTP ya serializada (JSON, comprimida) y su ETag
+    respuesta_json = fields.BinaryField()
+    respuesta_gzip = fields.BinaryField()
+    respuesta_br = fields.BinaryField()
+    etag = fields.StringField()
     
     meta = {
         'collection': 'dashboard_cache',
         'indexes': [
-            ('periodo', 'fecha_inicio'),
-            'expires_at'
+            # Clave del cache (los documentos previos a `version` quedan fuera)
+            {
+                'fields': ['periodo', 'fecha_inicio', 'version'],
+                'unique': True,
+                'partialFilterExpression': {'version': {'$exists': True}}
+            },
+            # Cubre las consultas de vigencia sin leer el documento
+            ('periodo', 'fecha_inicio', 'version', 'expires_at', 'created_at'),
+            'expires_at',
+            {'fields': ['purga_en'], 'expireAfterSeconds': 0}
         ]
     }
 
@@ -280,8 +307,11 @@ class EstadisticasBox(Document):
     
     meta = {
         'collection': 'estadisticas_box',
+        # Los índices los crea unificar_estadisticas() tras quitar duplicados
+        'auto_create_index': False,
         'indexes': [
-            ('box_id', 'anio', 'mes'),
+            # Un documento por box y mes (upsert en estadisticas_mensuales)
+            {'fields': ('box_id', 'anio', 'mes'), 'unique': True},
             'eficiencia_promedio'
         ]
     }
@@ -328,3 +358,57 @@ class AlertasInteligentes(Document):
             'severidad'
         ]
     }
+
+
+class AgregadoBoxDia(Document):
+    """Agregado incremental de agendas por (box, fecha) - base para plegar el dashboard"""
+    box_id = fields.IntField(required=True)
+    fecha = fields.DateTimeField(required=True)
+    
+    # Conteos
+    total_reservas = fields.IntField(default=0)
+    reservas_medicas = fields.IntField(default=0)
+    reservas_no_medicas = fields.IntField(default=0)
+    reservas_am = fields.IntField(default=0)  # Dentro de 08:00-13:00
+    reservas_pm = fields.IntField(default=0)  # Dentro de 13:00-18:00
+    
+    # Ocupación
+    minutos_ocupados = fields.IntField(default=0)
+    reservas_con_duracion = fields.IntField(default=0)  # Para el promedio de duración
+    minutos_muertos = fields.FloatField(default=0.0)  # Huecos entre agendas consecutivas
+    
+    actualizado_en = fields.DateTimeField(default=datetime.now)
+    
+    meta = {
+        'collection': 'agregados_box_dia',
+        'indexes': [
+            {'fields': ('fecha', 'box_id'), 'unique': True},
+        ]
+    }
+
+
+# Cálculo de los buckets de AgregadoBoxDia; al cambiarlo los días marcados con
+# otra versión se vuelven a materializar
+VERSION_AGREGADOS = 2
+
+
+class DiaAgregado(Document):
+    """Marca de días cuyos agregados por box ya están materializados"""
+    fecha = fields.DateTimeField(required=True, unique=True)
+    materializado_en = fields.DateTimeField(default=datetime.now)
+    version = fields.IntField(default=VERSION_AGREGADOS)
+    
+    meta = {
+        'collection': 'agregados_dias'
+    }
+
+
+class MarcaFeedCambios(Document):
+    """Último id de log_atenamb procesado por el feed de cambios (high-water mark)"""
+    nombre = fields.StringField(required=True, unique=True, max_length=50)
+    ultimo_id = fields.IntField(required=True, default=0)
+    actualizado_en = fields.DateTimeField(default=datetime.now)
+    
+    meta = {
+        'collection': 'marcas_feed_cambios'
+    }
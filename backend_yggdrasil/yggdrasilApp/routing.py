@@ -4,4 +4,5 @@ from . import consumers
 websocket_urlpatterns = [
     re_path(r'ws/agendas/$', consumers.AgendaConsumer.as_asgi()),
     re_path(r'ws/boxes/$', consumers.BoxesConsumer.as_asgi()),
+    re_path(r'ws/mimir/(?P<trabajo_id>[0-9a-f]+)/$', consumers.MimirConsumer.as_asgi()),
 ]
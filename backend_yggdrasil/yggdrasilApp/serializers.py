@@ -24,12 +24,22 @@ class BoxSerializer(serializers.ModelSerializer):
         model = Box
         fields = ['idbox', 'estadobox', 'pasillobox', 'comentario', 'especialidades', 'especialidad_principal', 'comentario']
 
+    @staticmethod
+    def queryset_listado():
+        """Boxes con sus tipos precargados: 2 consultas para toda la lista"""
+        return Box.objects.prefetch_related(
+            Prefetch('boxtipobox_set', queryset=BoxTipoBox.objects.select_related('idtipobox'))
+        )
+
     def get_especialidades(self, obj):
-        return [relacion.idtipobox.tipo for relacion in BoxTipoBox.objects.filter(idbox=obj)]
+        # Usa la relación precargada si viene de queryset_listado()
+        return [relacion.idtipobox.tipo for relacion in obj.boxtipobox_set.all()]
 
     def get_especialidad_principal(self, obj):
-        relacion = BoxTipoBox.objects.filter(idbox=obj, tipoprincipal=True).first()
-        return relacion.idtipobox.tipo if relacion else None
+        for relacion in obj.boxtipobox_set.all():
+            if relacion.tipoprincipal:
+                return relacion.idtipobox.tipo
+        return None
 
 
 class MedicoSerializer(serializers.ModelSerializer):
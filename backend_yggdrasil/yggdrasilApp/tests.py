@@ -1,3 +1,1363 @@
-from django.test import TestCase
+from datetime import date, datetime, time, timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.db import IntegrityError, connection
+from django.test import TestCase, override_settings
+
+from .models import Especialidad, Medico, Tipobox, Box, BoxTipoBox, Agendabox
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+# Los modelos son managed=False: la base de pruebas no crea sus tablas
+MODELOS_NO_ADMINISTRADOS = [Especialidad, Medico, Tipobox, Box, BoxTipoBox, Agendabox]
+
+CACHE_LOCAL = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def crear_tablas_no_administradas():
+    existentes = connection.introspection.table_names()
+    with connection.schema_editor() as editor:
+        for modelo in MODELOS_NO_ADMINISTRADOS:
+            if modelo._meta.db_table not in existentes:
+                editor.create_model(modelo)
+
+
+class TablasNoAdministradasTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        crear_tablas_no_administradas()
+        super().setUpClass()
+
+
+@skipUnless(mongomock, 'requiere mongomock')
+class MongoEnMemoriaTestCase(TablasNoAdministradasTestCase):
+    """Reemplaza la conexión MongoEngine por defecto por una base en memoria"""
+
+    @classmethod
+    def setUpClass(cls):
+        import mongoengine
+        from mongoengine.connection import _connection_settings
+        cls._conexion_mongo = dict(_connection_settings.get('default', {}))
+        mongoengine.disconnect()
+        mongoengine.connect('yggdrasil_test', host='mongodb://localhost', mongo_client_class=mongomock.MongoClient)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        import mongoengine
+        super().tearDownClass()
+        mongoengine.disconnect()
+        if cls._conexion_mongo:
+            mongoengine.register_connection('default', **cls._conexion_mongo)
+
+
+class IngestaAgendasTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.box = Box.objects.create(idbox=1, estadobox='Habilitado', pasillobox='A')
+        Box.objects.create(idbox=2, estadobox='Habilitado', pasillobox='A')
+        cls.medico = Medico.objects.create(idmedico=1, nombre='Médico de prueba')
+        Agendabox.objects.create(
+            idbox_id=1, idmedico_id=1, fechaagenda=date(2025, 1, 2), horainicioagenda=time(9),
+            horafinagenda=time(10), habilitada=1, esMedica=1
+        )
+
+    def test_claves_existentes_filtra_por_box_y_fecha(self):
+        from .modulos.actualizador_datos import ActualizadorDatos
+
+        existente = (1, 1, date(2025, 1, 2), time(9), time(10))
+        claves = {
+            existente,
+            (1, 1, date(2025, 1, 3), time(9), time(10)),
+            (1, 2, date(2025, 1, 2), time(9), time(10)),
+        }
+        self.assertEqual(ActualizadorDatos()._claves_existentes(claves), {existente})
+
+    def test_guardar_no_oculta_errores_que_no_son_de_clave_duplicada(self):
+        from .modulos.actualizador_datos import ActualizadorDatos
+
+        sin_es_medica = Agendabox(
+            idbox=self.box, idmedico=self.medico, fechaagenda=date(2025, 1, 3),
+            horainicioagenda=time(9), horafinagenda=time(10), habilitada=1
+        )
+        with self.assertRaises(IntegrityError):
+            ActualizadorDatos()._guardar([sin_es_medica])
+
+    def _nueva(self):
+        return Agendabox(
+            idbox=self.box, idmedico=self.medico, fechaagenda=date(2025, 1, 3),
+            horainicioagenda=time(9), horafinagenda=time(10), habilitada=1, esMedica=1
+        )
+
+    def test_actualizar_propaga_el_error_al_guardar(self):
+        from .modulos.actualizador_datos import ActualizadorDatos, clave_natural
+
+        actualizador = ActualizadorDatos()
+        agenda = self._nueva()
+        with mock.patch.object(actualizador, '_guardar', side_effect=IntegrityError('FK')):
+            with self.assertRaises(IntegrityError):
+                actualizador.actualizar([(agenda, 'INSERT')])
+        # La clave se olvida para reintentarla en el próximo lote
+        self.assertNotIn(clave_natural(agenda), actualizador._agendas_procesadas_cache)
+
+    def test_fallo_al_notificar_no_descarta_lo_guardado(self):
+        from .modulos.actualizador_datos import ActualizadorDatos, clave_natural
+
+        actualizador = ActualizadorDatos()
+        agenda = self._nueva()
+        with mock.patch('yggdrasilApp.modulos.actualizador_datos.CacheSignals') as senales, \
+                mock.patch('yggdrasilApp.modulos.actualizador_datos.get_channel_layer', side_effect=RuntimeError('sin Redis')):
+            actualizador.actualizar([(agenda, 'INSERT')])
+
+        senales.bulk_agendas_creadas.assert_called_once()
+        self.assertTrue(Agendabox.objects.filter(fechaagenda=date(2025, 1, 3)).exists())
+        self.assertIn(clave_natural(agenda), actualizador._agendas_procesadas_cache)
+
+
+@override_settings(CACHES=CACHE_LOCAL)
+class InvalidacionModoPollingTests(TablasNoAdministradasTestCase):
+    """Las agendas del modo polling traen fecha y horas como texto"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Box.objects.create(idbox=1, estadobox='Habilitado', pasillobox='A')
+        Medico.objects.create(idmedico=1, nombre='Médico de prueba')
+
+    def test_actualizar_con_payload_de_polling_invalida_el_dashboard(self):
+        from .modulos.agenda_adapter import AgendaAdapter
+        from .modulos.actualizador_datos import ActualizadorDatos
+
+        datos = [{
+            'id': 1, 'idBox': 1, 'idMedico': 1, 'fecha': '2025-01-02',
+            'horaInicio': '09:00', 'horaFin': '10:00', 'accion': 'INSERT',
+        }]
+        with mock.patch('yggdrasilApp.modulos.actualizador_datos.get_channel_layer'), \
+                mock.patch('yggdrasilApp.modulos.cache_manager.get_channel_layer'), \
+                mock.patch('yggdrasilApp.mongo_models.DashboardCache') as dashboard_cache, \
+                mock.patch('yggdrasilApp.modulos.aggregation_service.ServicioAgregados.refrescar_buckets') as refrescar, \
+                mock.patch('yggdrasilApp.modulos.almacen_columnar.almacen_columnar.invalidar') as invalidar_columnar, \
+                mock.patch('yggdrasilApp.modulos.cache_distribuido.cache_distribuido.invalidar') as invalidar_distribuido, \
+                mock.patch('yggdrasilApp.modulos.cache_manager.CacheManager._programar_regeneracion_cache') as programar:
+            dashboard_cache.objects.return_value.filter.return_value.only.return_value = []
+            ActualizadorDatos().actualizar(AgendaAdapter().adaptar_datos(datos))
+
+        self.assertEqual(Agendabox.objects.count(), 1)
+        refrescar.assert_called_once_with({(1, date(2025, 1, 2))})
+        self.assertEqual(invalidar_columnar.call_args[0][0], [date(2025, 1, 2)])
+        dashboard_cache.objects.return_value.filter.return_value.update.assert_called_once()
+        invalidar_distribuido.assert_called_once()
+        programar.assert_called_once()
+
+
+class PlegadoAgregadosTests(MongoEnMemoriaTestCase):
+    """Los buckets plegados deben coincidir con las consultas por período que reemplazan"""
+
+    DIA = date(2025, 3, 4)
+
+    @classmethod
+    def setUpTestData(cls):
+        Box.objects.create(idbox=1, estadobox='Habilitado', pasillobox='A')
+        Box.objects.create(idbox=2, estadobox='Habilitado', pasillobox='B')
+        Medico.objects.create(idmedico=1, nombre='Médico de prueba')
+        agendas = [
+            (1, 1, time(8, 0), time(9, 0), 1),
+            (1, 1, time(9, 30), time(10, 15), 1),
+            (1, None, time(12, 0), time(14, 0), 0),
+            (1, 1, time(14, 0), time(15, 0), 1),
+            (2, None, time(13, 30), time(17, 0), 0),
+            (2, 1, time(18, 0), time(19, 0), 1),
+        ]
+        for box_id, medico_id, inicio, fin, es_medica in agendas:
+            Agendabox.objects.create(
+                idbox_id=box_id, idmedico_id=medico_id, fechaagenda=cls.DIA, horainicioagenda=inicio,
+                horafinagenda=fin, habilitada=1, esMedica=es_medica
+            )
+        # Fuera del rango plegado
+        Agendabox.objects.create(
+            idbox_id=1, idmedico_id=1, fechaagenda=date(2025, 3, 5), horainicioagenda=time(8),
+            horafinagenda=time(9), habilitada=1, esMedica=1
+        )
+
+    def setUp(self):
+        from .mongo_models import AgregadoBoxDia, DiaAgregado
+        AgregadoBoxDia.drop_collection()
+        DiaAgregado.drop_collection()
+
+    def _totales_por_consulta(self):
+        reservas = Agendabox.objects.filter(fechaagenda__gte=self.DIA, fechaagenda__lte=self.DIA)
+        minutos = [
+            (a.horafinagenda.hour * 60 + a.horafinagenda.minute)
+            - (a.horainicioagenda.hour * 60 + a.horainicioagenda.minute)
+            for a in reservas
+        ]
+        muertos = 0.0
+        anterior = {}
+        for a in reservas.order_by('idbox_id', 'horainicioagenda'):
+            fin_anterior = anterior.get(a.idbox_id)
+            if fin_anterior is not None:
+                hueco = (
+                    datetime.combine(self.DIA, a.horainicioagenda) - datetime.combine(self.DIA, fin_anterior)
+                ).total_seconds() / 60
+                muertos += max(hueco, 0)
+            anterior[a.idbox_id] = a.horafinagenda
+        return {
+            'total_reservas': reservas.count(),
+            'reservas_medicas': reservas.filter(esMedica=True).count(),
+            'reservas_no_medicas': reservas.filter(esMedica=False).count(),
+            'reservas_am': reservas.filter(horainicioagenda__gte=time(8), horafinagenda__lte=time(13)).count(),
+            'reservas_pm': reservas.filter(horainicioagenda__gte=time(13), horafinagenda__lte=time(18)).count(),
+            'minutos_ocupados': sum(minutos),
+            'reservas_con_duracion': len(minutos),
+            'minutos_muertos': muertos,
+        }
+
+    def test_plegar_coincide_con_las_consultas_por_periodo(self):
+        from .modulos.aggregation_service import ServicioAgregados
+
+        plegado = ServicioAgregados.plegar(self.DIA, self.DIA)
+        por_box = {fila['box_id']: fila['total_reservas'] for fila in plegado.pop('por_box')}
+
+        self.assertEqual(plegado, self._totales_por_consulta())
+        self.assertEqual(por_box, {1: 4, 2: 2})
+
+    def test_refrescar_acepta_fechas_como_texto(self):
+        from .modulos.aggregation_service import ServicioAgregados
+
+        ServicioAgregados.plegar(self.DIA, self.DIA)
+        Agendabox.objects.create(
+            idbox_id=2, idmedico_id=1, fechaagenda=self.DIA, horainicioagenda=time(7),
+            horafinagenda=time(8), habilitada=1, esMedica=1
+        )
+        self.assertEqual(ServicioAgregados.refrescar_buckets({(2, self.DIA.isoformat())}), 1)
+        self.assertEqual(ServicioAgregados.plegar(self.DIA, self.DIA), self._totales_por_consulta() | {
+            'por_box': mock.ANY
+        })
+
+
+class IndiceAgendasTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Box.objects.create(idbox=1, estadobox='Habilitado', pasillobox='A')
+        Agendabox.objects.create(
+            idbox_id=1, fechaagenda=date(2025, 1, 2), horainicioagenda=time(9),
+            horafinagenda=time(10), habilitada=1, esMedica=0
+        )
+
+    def test_conserva_como_mucho_max_dias(self):
+        from .modulos.indice_agendas import IndiceAgendas
+
+        indice = IndiceAgendas(ttl_segundos=60, max_dias=2)
+        for dia in (1, 2, 3):
+            indice.intervalos_dia(date(2025, 1, dia))
+        indice.intervalos_dia(date(2025, 1, 2))
+        indice.intervalos_dia(date(2025, 1, 4))
+
+        self.assertEqual(list(indice._dias), [date(2025, 1, 2), date(2025, 1, 4)])
+
+    def test_no_guarda_un_dia_invalidado_durante_su_carga(self):
+        from .modulos.indice_agendas import IndiceAgendas
+
+        indice = IndiceAgendas(ttl_segundos=60)
+        cargar_dia = indice._cargar_dia
+
+        def cargar_con_escritura(fecha):
+            dia = cargar_dia(fecha)
+            indice.invalidar(fecha)
+            return dia
+
+        with mock.patch.object(indice, '_cargar_dia', side_effect=cargar_con_escritura):
+            self.assertTrue(indice.hay_solapamiento(1, '2025-01-02', '09:30', '09:45'))
+        self.assertNotIn(date(2025, 1, 2), indice._dias)
+
+    @override_settings(CACHES=CACHE_LOCAL)
+    def test_crear_reserva_verifica_contra_la_bd(self):
+        from .modulos.indice_agendas import indice_agendas
+
+        datos = {
+            'fecha': '2025-01-02', 'horaInicioReserva': '09:30', 'horaFinReserva': '10:30',
+            'box_id': 1, 'nombreResponsable': 'Responsable',
+        }
+        # El índice del proceso no ve la agenda existente (escrita por otro worker)
+        with mock.patch.object(indice_agendas, 'hay_solapamiento', return_value=False):
+            respuesta = self.client.post('/api/reservar-no-medica/', datos, content_type='application/json')
+
+        self.assertEqual(respuesta.status_code, 400)
+        self.assertEqual(Agendabox.objects.count(), 1)
+
+
+class TableroBoxesTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Box.objects.create(idbox=1, estadobox='Habilitado', pasillobox='A')
+        for fecha, inicio in ((date(2024, 10, 1), 8), (date(2025, 1, 2), 9), (date(2025, 1, 10), 8)):
+            Agendabox.objects.create(
+                idbox_id=1, fechaagenda=fecha, horainicioagenda=time(inicio),
+                horafinagenda=time(inicio + 1), habilitada=1, esMedica=1
+            )
+
+    def test_reutiliza_el_tablero_hasta_el_proximo_borde(self):
+        from .modulos import tablero_boxes as modulo
+        from .modulos.indice_agendas import indice_agendas
+
+        indice_agendas.invalidar()
+        boxes = [{'idbox': 1, 'pasillobox': 'A', 'estadobox': 'Habilitado', 'especialidad_principal': None}]
+        tablero = modulo.TableroBoxes()
+        with mock.patch.object(modulo.snapshot_boxes, 'obtener', return_value=(boxes, 1)), \
+                mock.patch.object(modulo, '_calcular_tablero', wraps=modulo._calcular_tablero) as calcular:
+            payload, etag = tablero.obtener(ahora=datetime(2025, 1, 2, 8, 0))
+            # La última agenda está fuera de la ventana de días: se busca sin límite
+            self.assertEqual(payload['boxes'][0]['ult'], '01/10/2024 09:00 (Médica)')
+            self.assertEqual(payload['boxes'][0]['prox'], 'Hoy 09:00 (Médica)')
+
+            self.assertEqual(tablero.obtener(ahora=datetime(2025, 1, 2, 8, 59)), (payload, etag))
+            self.assertEqual(calcular.call_count, 1)
+
+            payload, _ = tablero.obtener(ahora=datetime(2025, 1, 2, 9, 0))
+            self.assertEqual(calcular.call_count, 2)
+            payload, _ = tablero.obtener(ahora=datetime(2025, 1, 2, 9, 30))
+            self.assertEqual(calcular.call_count, 3)
+            self.assertEqual(payload['boxes'][0]['estado'], 'Ocupado')
+            self.assertEqual(payload['boxes'][0]['prox'], '10/01/2025 08:00 (Médica)')
+
+
+class CacheReferenciaTests(TablasNoAdministradasTestCase):
+
+    def test_dato_referencia_exige_cargar(self):
+        from .modulos.cache_referencia import DatoReferencia
+        with self.assertRaises(TypeError):
+            DatoReferencia()
+
+    def test_invalidacion_durante_la_carga_no_se_pisa(self):
+        from .modulos.cache_referencia import NombresMedicos
+
+        medico = Medico.objects.create(idmedico=1, nombre='Antes')
+        nombres = NombresMedicos(ttl_segundos=300)
+        filtrar = Medico.objects.filter
+
+        def filtrar_con_senal(*args, **kwargs):
+            consulta = list(filtrar(*args, **kwargs).values_list('idmedico', 'nombre'))
+            # El médico cambia (y llega la señal) después de leerlo
+            medico.nombre = 'Después'
+            medico.save()
+            nombres.invalidar(1)
+            return mock.Mock(values_list=mock.Mock(return_value=consulta))
+
+        with mock.patch.object(Medico.objects, 'filter', side_effect=filtrar_con_senal):
+            self.assertEqual(nombres.nombres([1]), {1: 'Antes'})
+        self.assertEqual(nombres.nombres([1]), {1: 'Después'})
+
+
+@override_settings(CACHES=CACHE_LOCAL)
+class TrabajosMimirTests(TestCase):
+    """Cada cola representa un worker distinto: el estado se comparte por el cache"""
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+
+    def test_el_estado_del_trabajo_se_ve_desde_otro_worker(self):
+        import threading
+        from .modulos import trabajos_mimir
+
+        liberar = threading.Event()
+
+        def calculo(parametros, progreso):
+            liberar.wait(5)
+            return {'ok': parametros['n']}
+
+        with mock.patch.dict(trabajos_mimir.CALCULOS, {'prueba': calculo}), \
+                mock.patch('yggdrasilApp.modulos.trabajos_mimir.get_channel_layer') as channel_layer:
+            channel_layer.return_value.group_send = mock.AsyncMock()
+            worker_a = trabajos_mimir.ColaTrabajosMimir(max_workers=1)
+            worker_b = trabajos_mimir.ColaTrabajosMimir(max_workers=1)
+
+            trabajo = worker_a.encolar('prueba', {'n': 1})
+            self.assertEqual(worker_b.encolar('prueba', {'n': 1})['id'], trabajo['id'])
+
+            liberar.set()
+            worker_a._pool.shutdown(wait=True)
+
+            final = worker_b.obtener(trabajo['id'])
+            self.assertEqual(final['estado'], trabajos_mimir.COMPLETADO)
+            self.assertEqual(final['resultado'], {'ok': 1})
+            grupos = {llamada.args[0] for llamada in channel_layer.return_value.group_send.call_args_list}
+            self.assertEqual(grupos, {trabajos_mimir.grupo_trabajo(trabajo['id'])})
+
+
+class AlmacenColumnarTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Box.objects.create(idbox=1, estadobox='Habilitado', pasillobox='A')
+        Agendabox.objects.create(
+            idbox_id=1, fechaagenda=date(2025, 1, 2), horainicioagenda=time(9),
+            horafinagenda=time(10), habilitada=1, esMedica=0
+        )
+
+    def setUp(self):
+        import tempfile
+        from .modulos.almacen_columnar import AlmacenColumnar
+
+        self.directorio = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directorio.cleanup)
+        self.almacen = AlmacenColumnar(directorio=self.directorio.name)
+
+    def _generaciones(self):
+        from pathlib import Path
+        return sorted(p.name for p in Path(self.directorio.name).iterdir() if p.is_dir())
+
+    def test_conserva_la_generacion_reemplazada_hasta_la_siguiente(self):
+        self.almacen.particion(2025, 1)
+        primera = self._generaciones()
+        self.almacen.invalidar([date(2025, 1, 2)])
+        self.almacen.particion(2025, 1)
+        segunda = self._generaciones()
+        self.almacen.invalidar([date(2025, 1, 2)])
+        self.almacen.particion(2025, 1)
+
+        self.assertEqual(len(segunda), 2)
+        self.assertEqual(segunda[0], primera[0])
+        self.assertEqual(len(self._generaciones()), 2)
+        self.assertNotIn(primera[0], self._generaciones())
+
+    def test_una_escritura_durante_la_regeneracion_deja_el_mes_sucio(self):
+        from .modulos import almacen_columnar
+
+        ordenar = almacen_columnar.ordenar
+
+        def ordenar_con_escritura(columnas):
+            # Llega una escritura después de la consulta y antes de publicar el puntero
+            self.almacen.invalidar([date(2025, 1, 2)])
+            return ordenar(columnas)
+
+        self.almacen.particion(2025, 1)
+        self.almacen.invalidar([date(2025, 1, 2)])
+        with mock.patch.object(almacen_columnar, 'ordenar', side_effect=ordenar_con_escritura):
+            self.almacen.particion(2025, 1)
+
+        self.assertTrue(self.almacen._leer_puntero(2025, 1).get('sucia'))
+
+
+class CalculoDashboardEntreProcesosTests(TestCase):
+
+    def test_espera_el_calculo_de_otro_proceso_en_vez_de_repetirlo(self):
+        from .modulos.dashboard_optimizer import DashboardCacheService, DashboardOptimizer
+        from .modulos.cache_distribuido import cache_distribuido
+
+        entrada = {'json': b'{}', 'gzip': b'', 'br': None, 'etag': '"x"'}
+        with mock.patch.object(cache_distribuido, 'adquirir_lock', return_value=None), \
+                mock.patch.object(cache_distribuido, 'lock_tomado', side_effect=[True, False]), \
+                mock.patch.object(cache_distribuido, 'obtener', return_value=entrada), \
+                mock.patch.object(DashboardOptimizer, 'precalcular_dashboard') as precalcular, \
+                mock.patch('yggdrasilApp.modulos.dashboard_optimizer.reloj.sleep'):
+            self.assertEqual(DashboardCacheService.calcular('week', date(2025, 1, 8)), entrada)
+
+        precalcular.assert_not_called()
+
+    def test_libera_el_lock_aunque_el_calculo_falle(self):
+        from .modulos.dashboard_optimizer import DashboardCacheService, DashboardOptimizer
+        from .modulos.cache_distribuido import cache_distribuido
+
+        with mock.patch.object(cache_distribuido, 'adquirir_lock', return_value='token'), \
+                mock.patch.object(cache_distribuido, 'liberar_lock') as liberar, \
+                mock.patch.object(DashboardOptimizer, 'precalcular_dashboard', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                DashboardCacheService.calcular('week', date(2025, 1, 8))
+
+        liberar.assert_called_once_with('dashboard_calculo:week:2025-01-06', 'token')
+
+
+class CalentamientoDashboardTests(TestCase):
+
+    def test_no_arranca_en_comandos_de_manage_py(self):
+        from .apps import es_proceso_servidor
+
+        with mock.patch('sys.argv', ['manage.py', 'generar_estadisticas_mensuales']):
+            self.assertFalse(es_proceso_servidor())
+        with mock.patch('sys.argv', ['manage.py', 'runserver']), \
+                mock.patch.dict('os.environ', {'RUN_MAIN': 'true'}):
+            self.assertTrue(es_proceso_servidor())
+        with mock.patch('sys.argv', ['/usr/bin/daphne', 'yggdrasil_backend.asgi:application']):
+            self.assertTrue(es_proceso_servidor())
+
+    def test_solo_el_lider_calcula_y_depura(self):
+        from .modulos.calentamiento_dashboard import CalentadorDashboard
+        from .modulos.cache_distribuido import cache_distribuido
+
+        lider, otro = CalentadorDashboard(intervalo=60), CalentadorDashboard(intervalo=60)
+        with mock.patch.object(cache_distribuido, 'adquirir_lock', side_effect=['token', None]), \
+                mock.patch.object(cache_distribuido, 'renovar_lock', return_value=True), \
+                mock.patch.object(CalentadorDashboard, '_al_asumir') as al_asumir:
+            self.assertTrue(lider.es_lider())
+            self.assertFalse(otro.es_lider())
+            self.assertTrue(lider.es_lider())
+
+        al_asumir.assert_called_once_with()
+
+
+class HorasMuertasTests(TestCase):
+
+    def test_buckets_usan_la_misma_definicion_que_analisis_huecos(self):
+        import numpy as np
+        from .modulos.aggregation_service import ServicioAgregados
+        from .modulos.analisis_huecos import huecos_por_dia
+        from .modulos.almacen_columnar import ordenar
+
+        dia = date(2025, 1, 2)
+        # La agenda de 8 a 12 cubre a la de 9 a 10: el único hueco es de 12 a 13
+        filas = [
+            (1, dia, time(8), time(12), 1),
+            (1, dia, time(9), time(10), 1),
+            (1, dia, time(13), time(14), 0),
+            (2, dia, time(8), time(9), 1),
+            (2, dia, time(9, 30), time(10), 1),
+        ]
+        buckets = ServicioAgregados.calcular_buckets(filas)
+
+        columnas = ordenar({
+            'box': np.array([f[0] for f in filas]),
+            'dia': np.array([f[1].toordinal() for f in filas]),
+            'inicio': np.array([f[2].hour * 60 + f[2].minute for f in filas], dtype=float),
+            'fin': np.array([f[3].hour * 60 + f[3].minute for f in filas], dtype=float),
+        })
+        box, _, minutos = huecos_por_dia(columnas)
+        esperados = {b: float(minutos[box == b].sum()) for b in (1, 2)}
+
+        self.assertEqual(esperados, {1: 60.0, 2: 30.0})
+        self.assertEqual({b: buckets[(b, dia)]['minutos_muertos'] for b in (1, 2)}, esperados)
+
+    def test_analisis_huecos_limita_el_rango(self):
+        respuesta = self.client.get('/api/dashboard-huecos/', {'fecha_inicio': '2020-01-01', 'fecha_fin': '2025-01-01'})
+        self.assertEqual(respuesta.status_code, 400)
+        respuesta = self.client.get('/api/dashboard-huecos/', {'fecha_inicio': '2025-01-02', 'fecha_fin': '2025-01-01'})
+        self.assertEqual(respuesta.status_code, 400)
+
+
+class EtagDashboardTests(TestCase):
+
+    def _get(self, entrada, **cabeceras):
+        from .modulos.dashboard_optimizer import DashboardCacheService
+        with mock.patch.object(DashboardCacheService, 'obtener_dashboard_serializado', return_value=entrada):
+            return self.client.get('/api/dashboard-optimizado/', **cabeceras)
+
+    def test_etag_distinto_por_codificacion(self):
+        from .modulos import serializacion_dashboard
+        entrada = serializacion_dashboard.serializar({'total': 1})
+
+        plano = self._get(entrada)
+        comprimido = self._get(entrada, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(plano['ETag'], entrada['etag'])
+        self.assertEqual(comprimido['Content-Encoding'], 'gzip')
+        self.assertEqual(comprimido['ETag'], entrada['etag'][:-1] + '-gzip"')
+
+        # Un ETag de cualquier codificación revalida; se responde con el de la negociada
+        revalidado = self._get(entrada, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=plano['ETag'])
+        self.assertEqual(revalidado.status_code, 304)
+        self.assertEqual(revalidado['ETag'], comprimido['ETag'])
+        revalidado = self._get(entrada, HTTP_IF_NONE_MATCH=comprimido['ETag'])
+        self.assertEqual(revalidado.status_code, 304)
+        self.assertEqual(revalidado['ETag'], plano['ETag'])
+        self.assertEqual(self._get(entrada, HTTP_IF_NONE_MATCH='"otro-gzip"').status_code, 200)
+
+
+class EstadisticasMensualesTests(MongoEnMemoriaTestCase):
+
+    def test_restar_meses(self):
+        from .modulos.estadisticas_mensuales import restar_meses
+        self.assertEqual(restar_meses((2025, 3), 2), (2025, 1))
+        self.assertEqual(restar_meses((2025, 2), 2), (2024, 12))
+        self.assertEqual(restar_meses((2025, 1), 13), (2023, 12))
+
+    def test_unificar_deja_un_documento_por_mes(self):
+        from mongoengine.connection import get_db
+        from .mongo_models import EstadisticasBox
+        from .modulos.estadisticas_mensuales import unificar_estadisticas
+
+        coleccion = get_db()[EstadisticasBox._get_collection_name()]
+        coleccion.drop()
+        EstadisticasBox._collection = None
+        coleccion.create_index([('box_id', 1), ('anio', 1), ('mes', 1)])
+        coleccion.insert_many([
+            {'box_id': 1, 'anio': 2025, 'mes': 1, 'total_reservas_mes': 3},
+            {'box_id': 1, 'anio': 2025, 'mes': 1, 'total_reservas_mes': 5},
+            {'box_id': 1, 'anio': 2025, 'mes': 2, 'total_reservas_mes': 7},
+        ])
+        # Leer la colección antes de depurarla no intenta crear el índice único
+        self.assertEqual(EstadisticasBox.objects(box_id=1).count(), 3)
+
+        self.assertEqual(unificar_estadisticas(), 1)
+        self.assertEqual(
+            sorted((e.mes, e.total_reservas_mes) for e in EstadisticasBox.objects(box_id=1)),
+            [(1, 5), (2, 7)]
+        )
+        self.assertTrue(any(
+            indice.get('unique') for indice in EstadisticasBox._get_collection().index_information().values()
+        ))
+
+
+class InventarioImplementosTests(TestCase):
+
+    def test_actualizar_implemento_valida_los_campos(self):
+        from mongoengine.errors import ValidationError
+        from .mongo_models import InventarioBox
+        from .modulos.persistencia_mongo import actualizar_implemento
+
+        coleccion = mock.MagicMock()
+        coleccion.find_one_and_update.return_value = {'implementos': [{'nombre': 'Camilla'}]}
+        with mock.patch.object(InventarioBox, '_get_collection', return_value=coleccion):
+            for cambios in ({'operacional': 'tal vez'}, {'observaciones': 'x' * 501},
+                            {'nombre': None}, {'campo_inventado': 1}):
+                with self.assertRaises(ValidationError):
+                    actualizar_implemento(1, 'Camilla', cambios)
+            coleccion.find_one_and_update.assert_not_called()
+
+            actualizar_implemento(1, 'Camilla', {'operacional': False, 'observaciones': 'rota'})
+        actualizacion = coleccion.find_one_and_update.call_args.args[1]['$set']
+        self.assertIs(actualizacion['implementos.$[impl].operacional'], False)
+        self.assertEqual(actualizacion['implementos.$[impl].observaciones'], 'rota')
+
+
+    def test_put_exige_un_booleano(self):
+        import json
+        from .views import mongo_views
+
+        with mock.patch.object(mongo_views, 'actualizar_implemento') as actualizar:
+            respuesta = self.client.put(
+                '/api/inventario/1/', json.dumps({'nombre': 'Camilla', 'operacional': 'false'}),
+                content_type='application/json'
+            )
+        self.assertEqual(respuesta.status_code, 400)
+        actualizar.assert_not_called()
+
+
+class DatosModificadosTests(TestCase):
+    databases = {'default', 'simulador'}
+
+    @classmethod
+    def setUpClass(cls):
+        from django.db import connections
+        from .models import Atenamb, LogAtenamb
+
+        conexion = connections['simulador']
+        existentes = conexion.introspection.table_names()
+        with conexion.schema_editor() as editor:
+            for modelo in (Atenamb, LogAtenamb):
+                if modelo._meta.db_table not in existentes:
+                    editor.create_model(modelo)
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        from .models import Atenamb, LogAtenamb
+
+        for atenamb_id in (1, 2):
+            Atenamb.objects.using('simulador').create(
+                id=atenamb_id, idMedico=1, idBox=str(atenamb_id), fecha=date(2025, 1, 2),
+                horaInicio=time(9), horaFin=time(10)
+            )
+        for log_id, atenamb_id, hora, accion in (
+            (1, 1, 8, 'INSERT'),
+            (2, 2, 9, 'INSERT'),
+            (3, 1, 10, 'UPDATE'),
+            # El atenamb 3 ya no existe: no genera fila
+            (4, 3, 10, 'DELETE'),
+            # Registrado después pero con fecha_hora anterior al log 2
+            (5, 2, 8, 'UPDATE'),
+        ):
+            LogAtenamb.objects.using('simulador').create(
+                id=log_id, atenamb_id=atenamb_id, fecha_hora=datetime(2025, 1, 2, hora), accion=accion
+            )
+
+    def test_ultima_accion_por_atenamb(self):
+        from .models import LogAtenamb
+        from .modulos.feed_cambios import ultimas_acciones
+
+        logs = LogAtenamb.objects.using('simulador').all()
+        with self.assertNumQueries(1, using='simulador'):
+            self.assertEqual(ultimas_acciones(logs), {1: 'UPDATE', 2: 'UPDATE', 3: 'DELETE'})
+        self.assertEqual(ultimas_acciones(logs, por_fecha=True), {1: 'UPDATE', 2: 'INSERT', 3: 'DELETE'})
+
+    def test_lista_completa_desde_una_fecha(self):
+        respuesta = self.client.get('/api/modificados/', {'desde': '2025-01-02T08:30:00'})
+        self.assertEqual(
+            sorted((fila['id'], fila['accion']) for fila in respuesta.json()),
+            [(1, 'UPDATE'), (2, 'INSERT')]
+        )
+
+    def test_pagina_por_cursor(self):
+        primera = self.client.get('/api/modificados/', {'limite': 2}).json()
+        self.assertEqual(sorted((f['id'], f['accion']) for f in primera['resultados']), [(1, 'INSERT'), (2, 'INSERT')])
+        self.assertEqual((primera['next_cursor'], primera['hay_mas']), (2, True))
+
+        segunda = self.client.get('/api/modificados/', {'cursor': 2, 'limite': 2}).json()
+        self.assertEqual([(f['id'], f['accion']) for f in segunda['resultados']], [(1, 'UPDATE')])
+        self.assertEqual(segunda['next_cursor'], 4)
+
+        tercera = self.client.get('/api/modificados/', {'cursor': 4, 'limite': 2}).json()
+        self.assertEqual(tercera, {
+            'resultados': [dict(id=2, idMedico=1, idBox='2', fecha='2025-01-02', horaInicio='09:00:00',
+                                horaFin='10:00:00', accion='UPDATE')],
+            'next_cursor': 5,
+            'hay_mas': False,
+        })
+
+    def test_pagina_vacia_conserva_el_cursor(self):
+        with mock.patch('yggdrasilApp.views.agenda_views.leer_pagina_cambios', return_value=([], None, 0)):
+            respuesta = self.client.get('/api/modificados/', {'cursor': 120, 'limite': 50})
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta.json(), {'resultados': [], 'next_cursor': 120, 'hay_mas': False})
+
+
+@override_settings(CACHES=CACHE_LOCAL)
+class RegeneracionDashboardTests(MongoEnMemoriaTestCase):
+
+    def test_invalidacion_durante_la_regeneracion_vuelve_a_calcular(self):
+        from .modulos.cache_manager import PlanificadorRegeneracion
+        from .modulos.dashboard_optimizer import DashboardCacheService, DashboardOptimizer
+        from .mongo_models import DashboardCache
+
+        DashboardCache.objects.delete()
+        planificador = PlanificadorRegeneracion(debounce=0, max_workers=1)
+        clave = planificador._clave('week', date(2025, 1, 2))
+        invalidaciones = []
+        turnos = DashboardOptimizer._calcular_ocupacion_turnos
+
+        def turnos_con_invalidacion(agregados):
+            # Llega un cambio con los datos ya leídos: se encola otra regeneración
+            if not invalidaciones:
+                invalidaciones.append(datetime.now())
+            return turnos(agregados)
+
+        with mock.patch.object(DashboardOptimizer, '_calcular_ocupacion_turnos', side_effect=turnos_con_invalidacion), \
+                mock.patch.object(DashboardCacheService, 'calcular', wraps=DashboardCacheService.calcular) as calcular:
+            planificador._ejecutar(clave, datetime.now())
+            planificador._ejecutar(clave, invalidaciones[0])
+
+        self.assertEqual(calcular.call_count, 2)
+        self.assertEqual(planificador.estadisticas()['ejecuciones'], 2)
+        self.assertGreaterEqual(DashboardCache.objects.get().created_at, invalidaciones[0])
+
+
+class FeedCambiosTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Box.objects.create(idbox=1, estadobox='Habilitado', pasillobox='A')
+        Medico.objects.create(idmedico=1, nombre='Médico de prueba')
+
+    def test_fallo_al_guardar_no_avanza_la_marca(self):
+        from .modulos import feed_cambios
+        from .modulos.actualizador_datos import ActualizadorDatos
+        from .modulos.agenda_adapter import AgendaAdapter
+
+        actualizador = ActualizadorDatos()
+        feed = feed_cambios.FeedCambios(
+            lambda datos: actualizador.actualizar(AgendaAdapter().adaptar_datos(datos)), lote=10
+        )
+        feed.ultimo_id = 40
+        datos = [{
+            'id': 7, 'idBox': 1, 'idMedico': 1, 'fecha': '2025-01-02',
+            'horaInicio': '09:00', 'horaFin': '10:00', 'accion': 'INSERT',
+        }]
+        with mock.patch.object(feed_cambios, 'leer_cambios_desde_id', return_value=(datos, 45, 5)), \
+                mock.patch.object(feed, 'guardar_marca') as guardar_marca, \
+                mock.patch.object(actualizador, '_guardar', side_effect=IntegrityError('FK')):
+            with self.assertRaises(IntegrityError):
+                feed.procesar_siguiente_lote()
+
+        guardar_marca.assert_not_called()
+        self.assertEqual(feed.ultimo_id, 40)
+
+
+class DepurarAgendasDuplicadasTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Box.objects.create(idbox=1, estadobox='Habilitado', pasillobox='A')
+        for _ in range(3):
+            # Reserva no médica sin hora de fin: los NULL también cuentan como iguales
+            Agendabox.objects.create(
+                idbox_id=1, fechaagenda=date(2025, 1, 2), horainicioagenda=time(9),
+                habilitada=1, esMedica=0
+            )
+        Agendabox.objects.create(
+            idbox_id=1, fechaagenda=date(2025, 1, 2), horainicioagenda=time(9),
+            horafinagenda=time(0), habilitada=1, esMedica=0
+        )
+
+    def test_solo_lista_sin_eliminar(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        call_command('depurar_agendas_duplicadas', stdout=StringIO())
+        self.assertEqual(Agendabox.objects.count(), 4)
+
+    def test_eliminar_conserva_la_de_menor_id(self):
+        from io import StringIO
+        from django.core.management import call_command
+
+        primera = Agendabox.objects.order_by('id').first().id
+        call_command('depurar_agendas_duplicadas', '--eliminar', stdout=StringIO())
+        self.assertEqual(
+            sorted(Agendabox.objects.values_list('id', 'horafinagenda')),
+            [(primera, None), (primera + 3, time(0))]
+        )
+
+    def test_migracion_falla_si_hay_duplicados(self):
+        import importlib
+        migracion = importlib.import_module('yggdrasilApp.migrations.0004_agendabox_clave_natural_unica')
+
+        editor = mock.Mock(connection=connection)
+        with self.assertRaisesRegex(RuntimeError, 'depurar_agendas_duplicadas'):
+            migracion.crear_indice(None, editor)
+        editor.execute.assert_not_called()
+        self.assertEqual(Agendabox.objects.count(), 4)
+
+
+class PersistenciaMongoTests(MongoEnMemoriaTestCase):
+
+    def test_upsert_reemplaza_el_documento_completo(self):
+        from .mongo_models import DashboardCache
+        from .modulos.persistencia_mongo import upsert_documentos
+
+        DashboardCache.objects.delete()
+        clave = {'periodo': 'week', 'fecha_inicio': datetime(2025, 1, 6), 'version': 1}
+        upsert_documentos(DashboardCache, [dict(clave, etag='"a"', respuesta_br=b'viejo')], tuple(clave))
+        # Sin brotli la nueva versión no trae respuesta_br: no debe quedar la anterior
+        upsert_documentos(DashboardCache, [dict(clave, etag='"b"')], tuple(clave))
+
+        documentos = list(DashboardCache._get_collection().find({}, {'_id': 0}))
+        self.assertEqual(documentos, [dict(clave, etag='"b"')])
+
+        upsert_documentos(DashboardCache, [dict(clave, etag='"c"')], tuple(clave), solo_insertar=True)
+        self.assertEqual(DashboardCache._get_collection().find_one()['etag'], '"b"')
+
+
+class CacheDistribuidoSinRedisTests(TestCase):
+
+    def test_pausa_redis_tras_un_error_de_conexion(self):
+        import redis
+        from .modulos.cache_distribuido import CacheDistribuido
+
+        cache = CacheDistribuido()
+        cache._cliente = mock.Mock()
+        cache._cliente.get.side_effect = redis.ConnectionError('sin Redis')
+        with mock.patch.object(cache, '_asegurar_suscripcion'):
+            cache.guardar('dashboard', 'semana', {'total': 1}, ttl=60)
+            llamadas = cache._cliente.get.call_count
+            # Se sigue sirviendo desde el nivel 1 sin volver a esperar a Redis
+            self.assertEqual(cache.obtener('dashboard', 'semana'), {'total': 1})
+            self.assertIsNone(cache.obtener('dashboard', 'otra'))
+            self.assertEqual(cache._cliente.get.call_count, llamadas)
+            self.assertEqual(cache.estadisticas()['errores_redis'], 1)
+
+            # Vencida la pausa se vuelve a intentar
+            cache._sin_redis_hasta = 0.0
+            cache.obtener('dashboard', 'semana')
+            self.assertEqual(cache._cliente.get.call_count, llamadas + 1)
+
+
+class ScoresLoteMimirTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.fecha = date.today()
+        Tipobox.objects.create(idtipobox=1, tipo='Consulta')
+        Tipobox.objects.create(idtipobox=2, tipo='Procedimiento')
+        for idbox, pasillo, estado, tipo, principal in (
+            (1, 'A', 'Habilitado', 1, True),
+            (2, 'A', 'Habilitado', 1, True),
+            (3, 'B', 'Inhabilitado', 2, False),
+            (4, 'B', 'Habilitado', 2, True),
+        ):
+            box = Box.objects.create(idbox=idbox, estadobox=estado, pasillobox=pasillo)
+            BoxTipoBox.objects.create(idbox=box, idtipobox_id=tipo, tipoprincipal=principal)
+        Medico.objects.create(idmedico=1, nombre='Médico de prueba')
+
+        def agenda(idbox, inicio, fin, fecha=None, medico=None):
+            return Agendabox.objects.create(
+                idbox_id=idbox, idmedico_id=medico, fechaagenda=fecha or cls.fecha,
+                horainicioagenda=time(*inicio), horafinagenda=time(*fin), habilitada=1, esMedica=1
+            )
+
+        cls.conflicto = [agenda(1, (10,), (11,), medico=1), agenda(1, (10, 30), (11, 30))]
+        # Box 2: una agenda cercana (resta disponibilidad continua) e historial del médico
+        agenda(2, (8,), (9,), medico=1)
+        agenda(2, (9,), (9, 30), fecha=cls.fecha - timedelta(days=60), medico=1)
+        # Box 4 está ocupado en el horario del conflicto
+        agenda(4, (11,), (12,))
+
+    def setUp(self):
+        from .modulos.cache_referencia import tipos_boxes
+        from .modulos.indice_agendas import indice_agendas
+        tipos_boxes.invalidar()
+        indice_agendas.invalidar()
+
+    def test_lote_coincide_con_el_calculo_por_box(self):
+        from .utils.resolutor_agendas import ResolutorConflictosAgenda
+
+        resolutor = ResolutorConflictosAgenda()
+        reservas = list(Agendabox.objects.filter(id__in=[a.id for a in self.conflicto]).select_related('idbox', 'idmedico'))
+        boxes = list(Box.objects.order_by('idbox'))
+
+        por_box = [resolutor.calcular_score_box(box, reservas, self.fecha, [1], [2]) for box in boxes]
+        lote = resolutor.calcular_scores_lote(boxes, reservas, self.fecha, [1], [2])
+
+        self.assertEqual(lote, por_box)
+        self.assertEqual([r['box_info']['disponible'] for r in lote], [True, True, True, False])
+
+    def test_lote_usa_tres_consultas(self):
+        from .modulos.cache_referencia import tipos_boxes
+        from .utils.resolutor_agendas import ResolutorConflictosAgenda
+
+        reservas = list(Agendabox.objects.filter(id__in=[a.id for a in self.conflicto]).select_related('idbox', 'idmedico'))
+        boxes = list(Box.objects.all())
+        tipos_boxes.obtener()
+        with self.assertNumQueries(3):
+            ResolutorConflictosAgenda().calcular_scores_lote(boxes, reservas, self.fecha, [1], [2])
+
+
+class DetectorTopesTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for idbox in (1, 2):
+            Box.objects.create(idbox=idbox, estadobox='Habilitado', pasillobox='A')
+
+        def agenda(idbox, dia, inicio, fin):
+            return Agendabox.objects.create(
+                idbox_id=idbox, fechaagenda=date(2025, 1, dia), horainicioagenda=time(*inicio),
+                horafinagenda=time(*fin), habilitada=1, esMedica=1
+            ).id
+
+        # Una agenda larga que pisa a dos posteriores que no se pisan entre sí
+        cls.larga = agenda(1, 2, (8,), (12,))
+        cls.corta_1 = agenda(1, 2, (9,), (10,))
+        cls.corta_2 = agenda(1, 2, (10,), (11,))
+        # Contiguas: no hay tope
+        agenda(1, 2, (12,), (13,))
+        agenda(1, 3, (9,), (10,))
+        # El mismo horario en otro box o en otro día no es tope
+        agenda(2, 2, (9,), (10,))
+        cls.otro_dia = (agenda(1, 4, (9,), (10, 30)), agenda(1, 4, (10,), (11,)))
+
+    def test_detecta_todos_los_pares_aunque_cruce_lotes(self):
+        from .modulos.detector_topes import detectar_topes
+
+        for tamano_lote in (1, 2, 2000):
+            grupos = list(detectar_topes(date(2025, 1, 1), date(2025, 1, 31), tamano_lote=tamano_lote))
+            self.assertEqual(
+                [(g['idbox'], g['fechaagenda'], sorted(g['pares'])) for g in grupos],
+                [
+                    (1, date(2025, 1, 2), sorted([(self.larga, self.corta_1), (self.larga, self.corta_2)])),
+                    (1, date(2025, 1, 4), [self.otro_dia]),
+                ],
+                tamano_lote
+            )
+        self.assertEqual((grupos[0]['inicio'], grupos[0]['fin']), (time(8), time(12)))
+
+    def test_vista_pagina_los_grupos(self):
+        respuesta = self.client.get('/api/agendas-con-tope/', {'desde': '2025-01-01', 'hasta': '2025-01-31'})
+        self.assertEqual(
+            sorted(a['id'] for a in respuesta.json()),
+            sorted([self.larga, self.corta_1, self.corta_2, *self.otro_dia])
+        )
+
+        respuesta = self.client.get(
+            '/api/agendas-con-tope/', {'desde': '2025-01-01', 'hasta': '2025-01-31', 'pagina': 1, 'tamano': 1}
+        )
+        self.assertTrue(respuesta.json()['hay_mas'])
+        self.assertEqual(respuesta.json()['resultados'][0]['fechaagenda'], '2025-01-02')
+
+    def test_mascara_vectorizada_coincide_con_el_barrido(self):
+        import numpy as np
+        from .modulos.detector_topes import mascara_topes
+
+        agendas = list(Agendabox.objects.order_by('idbox', 'fechaagenda', 'horainicioagenda', 'id'))
+
+        def minutos(hora):
+            return hora.hour * 60 + hora.minute
+
+        columnas = {
+            'box': np.array([a.idbox_id for a in agendas]),
+            'dia': np.array([a.fechaagenda.toordinal() for a in agendas]),
+            'inicio': np.array([minutos(a.horainicioagenda) for a in agendas]),
+            'fin': np.array([minutos(a.horafinagenda) for a in agendas]),
+        }
+        en_tope = {a.id for a, marcada in zip(agendas, mascara_topes(columnas)) if marcada}
+        self.assertEqual(en_tope, {self.larga, self.corta_1, self.corta_2, *self.otro_dia})
+
+
+class AdaptadoresAgendaTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Box.objects.create(idbox=1, estadobox='Habilitado', pasillobox='A')
+        Box.objects.create(idbox=2, estadobox='Habilitado', pasillobox='A')
+        Medico.objects.create(idmedico=1, nombre='Médico de prueba')
+
+    def test_api_resuelve_ids_en_bloque_y_omite_los_desconocidos(self):
+        from .modulos.agenda_adapter import AgendaAdapter
+
+        datos = [
+            {'id': 10, 'idBox': 1, 'idMedico': 1, 'fecha': '2025-01-02', 'horaInicio': '09:00', 'horaFin': '10:00', 'accion': 'INSERT'},
+            {'id': 11, 'idBox': 99, 'idMedico': 1, 'fecha': '2025-01-02', 'horaInicio': '09:00', 'horaFin': '10:00', 'accion': 'INSERT'},
+            {'id': 12, 'idBox': '2', 'idMedico': 'x', 'fecha': '2025-01-02', 'horaInicio': '09:00', 'horaFin': '10:00', 'accion': 'UPDATE'},
+        ]
+        adaptador = AgendaAdapter()
+        with self.assertNumQueries(2):
+            agendas = adaptador.adaptar_datos(datos)
+
+        self.assertEqual([(a.idbox_id, a.idmedico_id, accion) for a, accion in agendas], [(1, 1, 'INSERT')])
+        self.assertEqual(adaptador.errores, [
+            {'fila': 1, 'id': 11, 'errores': ['idBox 99 no existe']},
+            {'fila': 2, 'id': 12, 'errores': ['idMedico x no existe']},
+        ])
+
+    def test_simulador_convierte_columnas_y_reporta_filas_invalidas(self):
+        import pandas as pd
+        from .modulos.agenda_adapter import SimuladorAdapter
+
+        df = pd.DataFrame({
+            'idBox': [1, 2, 3, 1],
+            'idMedico': [1, 1, 1, 1],
+            'fecha': ['2025-01-02', '2025-01-03', '2025-01-03', 'no es fecha'],
+            'horaInicio': ['09:00', '09:30:15', '09:00', '09:00'],
+            'horaFin': ['10:00', '10:00', '10:00', '25:00'],
+        })
+        adaptador = SimuladorAdapter()
+        with self.assertNumQueries(2):
+            agendas = adaptador.adaptar_datos(df)
+
+        self.assertEqual(
+            [(a.idbox_id, a.fechaagenda, a.horainicioagenda, a.horafinagenda) for a in agendas],
+            [(1, date(2025, 1, 2), time(9), time(10)), (2, date(2025, 1, 3), time(9, 30, 15), time(10))]
+        )
+        # Número de fila como en la planilla (la fila 1 es el encabezado)
+        self.assertEqual(adaptador.errores, [
+            {'fila': 4, 'errores': ['idBox 3 no existe']},
+            {'fila': 5, 'errores': ['fecha inválida: no es fecha', 'horaFin inválida: 25:00']},
+        ])
+
+    def test_simulador_exige_las_columnas(self):
+        import pandas as pd
+        from .modulos.agenda_adapter import SimuladorAdapter
+
+        with self.assertRaises(ValueError):
+            SimuladorAdapter().adaptar_datos(pd.DataFrame({'idBox': [1]}))
+
+
+class SimuladorAgendaLoteTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for idbox in (1, 2):
+            Box.objects.create(idbox=idbox, estadobox='Habilitado', pasillobox='A')
+        for idbox, dia, inicio, fin in ((1, 2, (9,), (10,)), (1, 2, (12,), (12, 30)), (2, 3, (8,), (18,))):
+            Agendabox.objects.create(
+                idbox_id=idbox, fechaagenda=date(2025, 1, dia), horainicioagenda=time(*inicio),
+                horafinagenda=time(*fin), habilitada=1, esMedica=1
+            )
+
+    def setUp(self):
+        from .modulos.indice_agendas import indice_agendas
+        indice_agendas.invalidar()
+
+    def _archivo(self, semilla, filas):
+        import random
+        azar = random.Random(semilla)
+        boxes = {box.idbox: box for box in Box.objects.all()}
+        agendas = []
+        for _ in range(filas):
+            inicio = azar.randrange(8 * 4, 18 * 4)
+            # Incluye intervalos de duración nula o negativa
+            fin = min(max(inicio + azar.randrange(-2, 9), 0), 24 * 4 - 1)
+            agendas.append(Agendabox(
+                idbox=boxes[azar.choice((1, 2))], fechaagenda=date(2025, 1, azar.choice((2, 3, 4))),
+                horainicioagenda=time(inicio // 4, inicio % 4 * 15), horafinagenda=time(fin // 4, fin % 4 * 15),
+                habilitada=1, esMedica=1
+            ))
+        return agendas
+
+    def test_coincide_con_el_simulador_fila_a_fila(self):
+        from .modulos.simulador_agenda import SimuladorAgenda, SimuladorAgendaLote
+
+        for semilla in range(5):
+            datos = self._archivo(semilla, 150)
+            aprobadas, desaprobadas = SimuladorAgenda().simular(datos)
+            aprobadas_lote, desaprobadas_lote = SimuladorAgendaLote().simular(datos)
+            self.assertEqual([id(a) for a in aprobadas_lote], [id(a) for a in aprobadas], semilla)
+            self.assertEqual([id(a) for a in desaprobadas_lote], [id(a) for a in desaprobadas], semilla)
+
+    def test_una_sola_consulta_para_todo_el_archivo(self):
+        from .modulos.simulador_agenda import SimuladorAgendaLote
+
+        datos = self._archivo(0, 500)
+        with self.assertNumQueries(1):
+            SimuladorAgendaLote().simular(datos)
+
+
+class ListadoBoxesTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Tipobox.objects.create(idtipobox=1, tipo='Consulta')
+        Tipobox.objects.create(idtipobox=2, tipo='Procedimiento')
+        for idbox, tipo, principal in ((1, 1, True), (2, 2, False), (3, None, False)):
+            box = Box.objects.create(idbox=idbox, estadobox='Habilitado', pasillobox='A')
+            if tipo:
+                BoxTipoBox.objects.create(idbox=box, idtipobox_id=tipo, tipoprincipal=principal)
+
+    def setUp(self):
+        from .modulos.cache_referencia import snapshot_boxes
+        snapshot_boxes.invalidar()
+
+    def test_serializa_la_lista_en_dos_consultas(self):
+        from .serializers import BoxSerializer
+
+        with self.assertNumQueries(2):
+            datos = BoxSerializer(BoxSerializer.queryset_listado().order_by('idbox'), many=True).data
+        self.assertEqual(
+            [(d['idbox'], d['especialidades'], d['especialidad_principal']) for d in datos],
+            [(1, ['Consulta'], 'Consulta'), (2, ['Procedimiento'], None), (3, [], None)]
+        )
+
+    def test_listado_se_sirve_del_snapshot_hasta_que_cambia_un_box(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(len(self.client.get('/api/boxes/').json()), 3)
+        with self.assertNumQueries(0):
+            self.client.get('/api/boxes/')
+
+        box = Box.objects.get(idbox=3)
+        box.estadobox = 'Inhabilitado'
+        box.save()
+        estados = {b['idbox']: b['estadobox'] for b in self.client.get('/api/boxes/').json()}
+        self.assertEqual(estados[3], 'Inhabilitado')
+
+
+class DashboardStatsTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Tipobox.objects.create(idtipobox=1, tipo='Consulta')
+        Tipobox.objects.create(idtipobox=2, tipo='Procedimiento')
+        for idbox in (1, 2, 3):
+            Box.objects.create(idbox=idbox, estadobox='Habilitado', pasillobox='A')
+        BoxTipoBox.objects.create(idbox_id=1, idtipobox_id=1, tipoprincipal=True)
+        BoxTipoBox.objects.create(idbox_id=2, idtipobox_id=2, tipoprincipal=False)
+        for idbox, dia, inicio, fin, es_medica in (
+            (1, 8, (8,), (9,), 1),
+            (1, 8, (10,), (11, 30), 1),
+            (1, 8, (14,), (15,), 0),
+            (2, 8, (9,), (10,), 1),
+            # Fuera del rango pedido
+            (3, 9, (9,), (10,), 1),
+        ):
+            Agendabox.objects.create(
+                idbox_id=idbox, fechaagenda=date(2025, 1, dia), horainicioagenda=time(*inicio),
+                horafinagenda=time(*fin), habilitada=1, esMedica=es_medica
+            )
+
+    def setUp(self):
+        import tempfile
+        from .modulos.almacen_columnar import AlmacenColumnar
+
+        directorio = tempfile.TemporaryDirectory()
+        self.addCleanup(directorio.cleanup)
+        almacen = mock.patch('yggdrasilApp.views.dashboard_views.almacen_columnar', AlmacenColumnar(directorio=directorio.name))
+        # Miércoles 8 de enero de 2025
+        ahora = mock.patch('django.utils.timezone.now', return_value=datetime(2025, 1, 8, 12, 0))
+        for parche in (almacen, ahora):
+            parche.start()
+            self.addCleanup(parche.stop)
+
+    def test_metricas_del_dia_en_una_pasada(self):
+        datos = self.client.get('/api/dashboard-stats/', {'range': 'day'}).json()
+        datos.pop('tiempos_ms')
+
+        self.assertEqual(datos, {
+            'total_boxes': 3,
+            'total_reservas': 4,
+            'reservas_medicas': 3,
+            'reservas_no_medicas': 1,
+            'tiempo_promedio_ocupacion': 67.5,
+            'porcentaje_ocupacion': 15.0,
+            # Huecos de 60 y 150 minutos en el box 1
+            'horas_muertas': 3.5,
+            'box_mas_utilizado': {'idbox': 1, 'total': 3},
+            'box_menos_utilizado': {'idbox': 2, 'total': 1},
+            'ocupacion_am': 3,
+            'ocupacion_pm': 1,
+            'especialidades_stats': [
+                {'nombre': 'Consulta', 'total_reservas': 3, 'boxes': 1, 'es_principal': True},
+                {'nombre': 'Procedimiento', 'total_reservas': 1, 'boxes': 1, 'es_principal': False},
+            ],
+            'tipo_reservas': [{'name': 'Médicas', 'value': 3}, {'name': 'No Médicas', 'value': 1}],
+            'tiempo_medico': 70.0,
+            'tiempo_no_medico': 60.0,
+            # Numeración de ExtractWeekDay: 1 = domingo, 4 = miércoles
+            'evolucion_semana': [{'dia_semana': 4, 'total': 4}],
+        })
+
+    def test_rango_sin_reservas(self):
+        with mock.patch('django.utils.timezone.now', return_value=datetime(2025, 3, 5, 12, 0)):
+            datos = self.client.get('/api/dashboard-stats/', {'range': 'week'}).json()
+
+        self.assertEqual(datos['total_reservas'], 0)
+        self.assertEqual(datos['porcentaje_ocupacion'], 0)
+        self.assertIsNone(datos['box_mas_utilizado'])
+        self.assertEqual(datos['evolucion_semana'], [])
+
+
+@override_settings(EXPORTACION_AGENDAS_PAGINA=2)
+class ExportacionAgendasTests(TablasNoAdministradasTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for idbox in (1, 2, 3):
+            Box.objects.create(idbox=idbox, estadobox='Habilitado', pasillobox='A')
+        Medico.objects.create(idmedico=1, nombre='Médico de prueba')
+        # Varias agendas a la misma hora: la página siguiente desempata por id
+        for idbox, dia, inicio, medico in ((1, 3, 9, 1), (1, 2, 9, None), (2, 2, 9, 1), (3, 2, 9, None), (2, 2, 8, None)):
+            Agendabox.objects.create(
+                idbox_id=idbox, idmedico_id=medico, fechaagenda=date(2025, 1, dia),
+                horainicioagenda=time(inicio), horafinagenda=time(inicio + 1), habilitada=1,
+                esMedica=int(medico is not None), nombre_responsable=None if medico else 'Responsable'
+            )
+        Agendabox.objects.create(
+            idbox_id=1, fechaagenda=date(2025, 2, 1), horainicioagenda=time(9),
+            horafinagenda=None, habilitada=1, esMedica=0
+        )
+
+    def _rango(self, **parametros):
+        return self.client.get('/api/todas-las-agendas/', dict({'desde': '2025-01-01', 'hasta': '2025-01-31'}, **parametros))
+
+    def _texto(self, respuesta):
+        self.assertTrue(respuesta.streaming)
+        return b''.join(respuesta.streaming_content).decode()
+
+    def test_csv_en_streaming_coincide_con_el_listado(self):
+        import csv
+        import io
+
+        esperado = self._rango().json()
+        respuesta = self._rango(export='csv')
+
+        self.assertEqual(respuesta['Content-Disposition'], 'attachment; filename="todas_agendas.csv"')
+        filas = list(csv.DictReader(io.StringIO(self._texto(respuesta))))
+        self.assertEqual(len(filas), 5)
+        self.assertEqual(filas, [{k: str(v) for k, v in agenda.items()} for agenda in esperado])
+        self.assertEqual(filas[0]['responsable'], 'Responsable')
+        self.assertEqual(filas[-1]['responsable'], 'Médico de prueba')
+
+    def test_ndjson_un_objeto_por_linea(self):
+        import json
+
+        lineas = self._texto(self._rango(export='ndjson')).splitlines()
+        self.assertEqual([json.loads(linea) for linea in lineas], self._rango().json())
+
+    def test_rango_vacio_exporta_solo_el_encabezado(self):
+        respuesta = self.client.get('/api/todas-las-agendas/', {'desde': '2024-01-01', 'hasta': '2024-01-31', 'export': 'csv'})
+        self.assertEqual(self._texto(respuesta).strip(), 'id,box_id,fecha,hora_inicio,hora_fin,tipo,responsable,observaciones')
+
+    def test_parquet_sin_pyarrow_responde_501(self):
+        with mock.patch('yggdrasilApp.views.agenda_views.parquet_disponible', return_value=False):
+            self.assertEqual(self._rango(export='parquet').status_code, 501)
+
+    def test_parquet_un_row_group_por_pagina(self):
+        from .modulos.exportacion_agendas import parquet_disponible
+        if not parquet_disponible():
+            self.skipTest('requiere pyarrow')
+        import io
+        import pyarrow.parquet as pq
+
+        respuesta = self._rango(export='parquet')
+        archivo = pq.ParquetFile(io.BytesIO(b''.join(respuesta.streaming_content)))
+        self.assertEqual(archivo.metadata.num_row_groups, 3)
+        self.assertEqual(archivo.read().to_pylist(), self._rango().json())
+
+
+class DashboardObsoletoTests(TestCase):
+
+    def setUp(self):
+        from .modulos import serializacion_dashboard
+        from .modulos.cache_distribuido import cache_distribuido
+        from .modulos.cache_manager import planificador_regeneracion
+        from .modulos.calentamiento_dashboard import calentador_dashboard
+        from .modulos.dashboard_optimizer import DashboardCacheService
+
+        self.ultima = serializacion_dashboard.serializar({'cache_info': {}, 'total': 1})
+        vigentes = {DashboardCacheService.ESPACIO_OBSOLETO: self.ultima}
+        self.addCleanup(mock.patch.stopall)
+        # Sólo queda la última versión buena: el cache vigente venció
+        mock.patch.object(cache_distribuido, 'obtener', side_effect=lambda espacio, clave: vigentes.get(espacio)).start()
+        mock.patch.object(DashboardCacheService, '_entrada_mongo', return_value=None).start()
+        mock.patch.object(calentador_dashboard, 'registrar_lectura').start()
+        self.programar = mock.patch.object(planificador_regeneracion, 'programar').start()
+        self.calcular = mock.patch.object(DashboardCacheService, 'calcular', return_value={'etag': '"nuevo"'}).start()
+
+    def test_vencido_responde_la_ultima_version_y_programa_la_regeneracion(self):
+        respuesta = self.client.get('/api/dashboard-optimizado/', {'range': 'week', 'fecha_referencia': '2025-01-08'})
+
+        self.assertEqual(respuesta.status_code, 200)
+        self.assertEqual(respuesta['X-Dashboard-Stale'], 'true')
+        self.assertTrue(respuesta.json()['data']['cache_info']['obsoleto'])
+        self.programar.assert_called_once_with('week', date(2025, 1, 6), inmediato=True)
+        self.calcular.assert_not_called()
+
+    @override_settings(DASHBOARD_SERVIR_OBSOLETO=False)
+    def test_sin_modo_obsoleto_calcula_en_la_peticion(self):
+        from .modulos.dashboard_optimizer import DashboardCacheService
+
+        entrada = DashboardCacheService.obtener_dashboard_serializado('week', fecha_referencia=date(2025, 1, 8))
+
+        self.assertEqual(entrada, {'etag': '"nuevo"'})
+        self.calcular.assert_called_once_with('week', date(2025, 1, 6))
+        self.programar.assert_not_called()
+
+
+@override_settings(CACHES=CACHE_LOCAL)
+class CacheDashboardVersionadoTests(MongoEnMemoriaTestCase):
+
+    def setUp(self):
+        from .mongo_models import DashboardCache, VERSION_DASHBOARD_CACHE
+
+        DashboardCache.objects.delete()
+        vence = datetime(2025, 1, 8, 18, 0)
+        DashboardCache._get_collection().insert_many([
+            # Documento anterior al campo version
+            {'periodo': 'week', 'fecha_inicio': datetime(2025, 1, 6), 'expires_at': vence, 'etag': '"sin-version"'},
+            {'periodo': 'week', 'fecha_inicio': datetime(2025, 1, 6), 'version': VERSION_DASHBOARD_CACHE - 1,
+             'expires_at': vence, 'etag': '"anterior"'},
+            {'periodo': 'week', 'fecha_inicio': datetime(2024, 12, 30), 'version': VERSION_DASHBOARD_CACHE,
+             'expires_at': vence, 'etag': '"otra-semana"'},
+            {'periodo': 'week', 'fecha_inicio': datetime(2025, 1, 6), 'version': VERSION_DASHBOARD_CACHE,
+             'expires_at': vence, 'etag': '"vigente"'},
+        ])
+
+    def test_lee_solo_la_ventana_y_version_actuales(self):
+        from .modulos.cache_manager import CacheManager
+
+        with mock.patch('django.utils.timezone.now', return_value=datetime(2025, 1, 8, 12, 0)), \
+                mock.patch('yggdrasilApp.modulos.cache_manager.datetime') as reloj_cache:
+            reloj_cache.now.return_value = datetime(2025, 1, 8, 12, 0)
+            self.assertEqual(CacheManager.obtener_cache_valido('week').etag, '"vigente"')
+            reloj_cache.now.return_value = datetime(2025, 1, 8, 19, 0)
+            self.assertIsNone(CacheManager.obtener_cache_valido('week'))
+
+    def test_depura_los_documentos_de_otras_versiones(self):
+        from .mongo_models import DashboardCache
+        from .modulos.dashboard_optimizer import DashboardCacheService
+
+        self.assertEqual(DashboardCacheService.depurar_versiones_anteriores(), 2)
+        self.assertEqual(
+            sorted(d['etag'] for d in DashboardCache._get_collection().find()),
+            ['"otra-semana"', '"vigente"']
+        )
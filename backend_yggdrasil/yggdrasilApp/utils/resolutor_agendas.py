@@ -1,9 +1,17 @@
-from django.db.models import Q, Count, Subquery, OuterRef, Case, When, Value, IntegerField, Prefetch
+from django.db.models import Q, Count, Subquery, OuterRef, Case, When, Value, IntegerField
+from django.db import transaction
 from django.utils import timezone
 from django.core.cache import cache
-from ..models import Box, Agendabox, Tipobox, BoxTipoBox
+from collections import defaultdict
+import numpy as np
+from ..models import Box, Agendabox
+from ..modulos.indice_agendas import indice_agendas, solapamiento_en_bd
+from ..modulos.cache_manager import CacheSignals
+from ..modulos.almacen_columnar import almacen_columnar
+from ..modulos.detector_topes import mascara_topes
+from ..modulos.cache_referencia import tipos_boxes
 import logging
-from datetime import datetime, timedelta, time
+from datetime import date, datetime, timedelta, time
 
 logger = logging.getLogger(__name__)
 
@@ -70,12 +78,9 @@ class ResolutorConflictosAgenda:
             hora_inicio, hora_fin, fecha
         )
         
-        conflictos = Agendabox.objects.filter(
-            idbox=box_id,
-            fechaagenda=fecha,
-            horainicioagenda__lt=fin_dt.time(),
-            horafinagenda__gt=inicio_dt.time()
-        ).exclude(id__in=excluir_ids).exists()
+        conflictos = indice_agendas.hay_solapamiento(
+            box_id, fecha, inicio_dt.time(), fin_dt.time(), excluir_ids=excluir_ids
+        )
         
         return not conflictos
     
@@ -108,10 +113,6 @@ class ResolutorConflictosAgenda:
                 boxtipobox__idtipobox__in=tipos_requeridos
             ).distinct()
         
-        boxes_libres = boxes_libres.prefetch_related(
-            Prefetch('boxtipobox_set', queryset=BoxTipoBox.objects.select_related('idtipobox'))
-        )
-        
         logger.info(f"Boxes libres encontrados para {fecha} {hora_inicio_norm}-{hora_fin_norm}: {boxes_libres.count()}")
         
         return boxes_libres
@@ -121,10 +122,9 @@ class ResolutorConflictosAgenda:
         tipos_requeridos = set()
         
         for reserva in reservas_conflicto:
-            if reserva.idbox:
-                box_tipos = BoxTipoBox.objects.filter(idbox=reserva.idbox.idbox)
-                for box_tipo in box_tipos:
-                    tipos_requeridos.add((box_tipo.idtipobox.idtipobox, box_tipo.tipoprincipal))
+            if reserva.idbox_id:
+                for tipo_id, _, principal in tipos_boxes.tipos_de_box(reserva.idbox_id):
+                    tipos_requeridos.add((tipo_id, principal))
 
         tipos_principales = [tipo_id for tipo_id, es_principal in tipos_requeridos if es_principal]
         tipos_secundarios = [tipo_id for tipo_id, es_principal in tipos_requeridos if not es_principal]
@@ -176,9 +176,9 @@ class ResolutorConflictosAgenda:
     
     def calcular_compatibilidad_tipos(self, box, tipos_principales, tipos_secundarios):
         """Calcula la compatibilidad de tipos entre el box y los requeridos"""
-        box_tipos = BoxTipoBox.objects.filter(idbox=box.idbox)
-        box_tipos_principales = [bt.idtipobox.idtipobox for bt in box_tipos if bt.tipoprincipal]
-        box_tipos_secundarios = [bt.idtipobox.idtipobox for bt in box_tipos if not bt.tipoprincipal]
+        box_tipos = tipos_boxes.tipos_de_box(box.idbox)
+        box_tipos_principales = [tipo_id for tipo_id, _, principal in box_tipos if principal]
+        box_tipos_secundarios = [tipo_id for tipo_id, _, principal in box_tipos if not principal]
         
         coincidencias_principales = len(set(tipos_principales) & set(box_tipos_principales))
         coincidencias_secundarias = len(set(tipos_secundarios) & set(box_tipos_secundarios))
@@ -212,8 +212,8 @@ class ResolutorConflictosAgenda:
                     'nombre': f"Box {box.idbox}",
                     'pasillo': box.pasillobox,
                     'estado': box.estadobox,
-                    'tipos': [{'tipo': bt.idtipobox.tipo, 'principal': bt.tipoprincipal} 
-                            for bt in BoxTipoBox.objects.filter(idbox=box.idbox).select_related('idtipobox')],
+                    'tipos': [{'tipo': tipo, 'principal': principal}
+                            for _, tipo, principal in tipos_boxes.tipos_de_box(box.idbox)],
                     'habilitado': False,  
                     'ocupado': True,
                     'disponible': False
@@ -319,16 +319,236 @@ class ResolutorConflictosAgenda:
                 'nombre': f"Box {box.idbox}",
                 'pasillo': box.pasillobox,
                 'estado': box.estadobox,
-                'tipos': [{'tipo': bt.idtipobox.tipo, 'principal': bt.tipoprincipal} 
-                        for bt in BoxTipoBox.objects.filter(idbox=box.idbox).select_related('idtipobox')],
+                'tipos': [{'tipo': tipo, 'principal': principal}
+                        for _, tipo, principal in tipos_boxes.tipos_de_box(box.idbox)],
                 'habilitado': not (box.estadobox and 'inhabilitado' in box.estadobox.lower()),
                 'ocupado': False,
                 'disponible': True
             }
         }
     
-    def resolver_conflicto_agendas(self, reservas_ids):
-        """Resuelve conflicto entre múltiples agendas con verificación robusta"""
+    def calcular_scores_lote(self, boxes, reservas_conflicto, fecha, tipos_principales, tipos_secundarios):
+        """Calcula el score de todos los boxes candidatos de una sola vez.
+
+        Devuelve lo mismo que llamar a calcular_score_box por cada box, pero carga
+        una vez las agendas del día y el historial de los médicos (3 consultas en
+        total; los tipos salen del cache de referencia) y suma los puntajes con NumPy.
+        """
+        boxes = list(boxes)
+        if not boxes:
+            return []
+        
+        box_ids = [box.idbox for box in boxes]
+        hora_inicio_conflicto = min(r.horainicioagenda for r in reservas_conflicto)
+        hora_fin_conflicto = max(r.horafinagenda for r in reservas_conflicto)
+        excluir_ids = {r.id for r in reservas_conflicto}
+        
+        # Agendas del día de los candidatos: disponibilidad, carga diaria y disponibilidad continua
+        agendas_dia = defaultdict(list)
+        for box_id, agenda_id, inicio, fin in Agendabox.objects.filter(
+            idbox__in=box_ids,
+            fechaagenda=fecha
+        ).values_list('idbox', 'id', 'horainicioagenda', 'horafinagenda'):
+            agendas_dia[box_id].append((agenda_id, inicio, fin))
+        
+        # Mapa de tipos de cada box candidato: [(idtipobox, tipo, tipoprincipal), ...]
+        tipos_por_box = tipos_boxes.obtener()[0]['por_box']
+        
+        # Historial de uso de los médicos involucrados (total y últimos 30 días)
+        medicos_ids = [r.idmedico.idmedico for r in reservas_conflicto if r.idmedico]
+        uso_historico = {}
+        uso_reciente = {}
+        if medicos_ids:
+            historial = Agendabox.objects.filter(
+                idbox__in=box_ids,
+                idmedico__idmedico__in=medicos_ids
+            )
+            uso_historico = dict(
+                historial.values('idbox').annotate(total=Count('id')).values_list('idbox', 'total')
+            )
+            fecha_limite = timezone.now().date() - timedelta(days=30)
+            uso_reciente = dict(
+                historial.filter(fechaagenda__gte=fecha_limite)
+                .values('idbox').annotate(total=Count('id')).values_list('idbox', 'total')
+            )
+        
+        # Ventana de +-2 horas usada por calcular_disponibilidad_continua
+        ventana_antes = max(
+            datetime.combine(fecha, hora_inicio_conflicto) - timedelta(hours=2),
+            datetime.combine(fecha, time.min)
+        ).time()
+        ventana_despues = min(
+            datetime.combine(fecha, hora_fin_conflicto) + timedelta(hours=2),
+            datetime.combine(fecha, time.max)
+        ).time()
+        
+        box_original = reservas_conflicto[0].idbox if reservas_conflicto[0].idbox else None
+        set_principales = set(tipos_principales)
+        set_secundarios = set(tipos_secundarios)
+        
+        disponible = []
+        inhabilitado = []
+        carga = []
+        mismo_pasillo = []
+        historico = []
+        preferencia = []
+        coincidencias_p = []
+        coincidencias_s = []
+        continua = []
+        for box in boxes:
+            agendas = agendas_dia.get(box.idbox, [])
+            con_horario = [(a_id, ini, fin) for a_id, ini, fin in agendas if ini is not None and fin is not None]
+            disponible.append(not any(
+                ini < hora_fin_conflicto and fin > hora_inicio_conflicto and a_id not in excluir_ids
+                for a_id, ini, fin in con_horario
+            ))
+            inhabilitado.append(bool(box.estadobox and 'inhabilitado' in box.estadobox.lower()))
+            carga.append(len(agendas))
+            mismo_pasillo.append(bool(box_original and box.pasillobox == box_original.pasillobox))
+            historico.append(uso_historico.get(box.idbox, 0))
+            preferencia.append(min(uso_reciente.get(box.idbox, 0), 10))
+            box_tipos = tipos_por_box.get(box.idbox, [])
+            coincidencias_p.append(len(set_principales & {tipo_id for tipo_id, _, principal in box_tipos if principal}))
+            coincidencias_s.append(len(set_secundarios & {tipo_id for tipo_id, _, principal in box_tipos if not principal}))
+            continua.append(max(0, 5 - sum(
+                1 for _, ini, fin in con_horario if ini < ventana_despues and fin > ventana_antes
+            )))
+        
+        inhabilitado = np.array(inhabilitado)
+        carga = np.array(carga, dtype=np.int64)
+        mismo_pasillo = np.array(mismo_pasillo)
+        historico = np.array(historico, dtype=np.int64)
+        preferencia = np.array(preferencia, dtype=np.int64)
+        coincidencias_p = np.array(coincidencias_p, dtype=np.int64)
+        coincidencias_s = np.array(coincidencias_s, dtype=np.int64)
+        continua = np.array(continua, dtype=np.int64)
+        
+        # Puntos por criterio, sumados en el mismo orden que calcular_score_box
+        # para que el redondeo de punto flotante sea idéntico
+        puntos_carga = (10 - np.minimum(carga, 10)) * self.criterios_peso['carga_diaria']
+        puntos_historico = np.minimum(historico, 10) * self.criterios_peso['uso_historico']
+        puntos_preferencia = preferencia * self.criterios_peso['preferencia_medico'] / 10
+        puntos_tipo_principal = coincidencias_p * self.criterios_peso['tipo_principal_coincide']
+        puntos_tipo_secundario = coincidencias_s * self.criterios_peso['tipo_secundario_coincide']
+        puntos_disponibilidad = continua * self.criterios_peso['disponibilidad_continua'] / 5
+        
+        scores = np.zeros(len(boxes))
+        scores -= np.where(inhabilitado, 100, 0)
+        scores += puntos_carga
+        scores += np.where(mismo_pasillo, self.criterios_peso['mismo_pasillo'], 0)
+        if medicos_ids:
+            scores += puntos_historico
+            scores += puntos_preferencia
+        scores += puntos_tipo_principal
+        scores += puntos_tipo_secundario
+        scores += puntos_disponibilidad
+        
+        resultados = []
+        for i, box in enumerate(boxes):
+            tipos_box = [{'tipo': tipo, 'principal': principal}
+                         for _, tipo, principal in tipos_por_box.get(box.idbox, [])]
+            
+            if not disponible[i]:
+                resultados.append({
+                    'score_total': -1000,
+                    'criterios': [{
+                        'criterio': 'BOX OCUPADO',
+                        'puntos': -1000,
+                        'detalle': f'Box no disponible en el horario exacto del conflicto ({hora_inicio_conflicto} - {hora_fin_conflicto})',
+                        'tipo': 'penalizacion'
+                    }],
+                    'box_info': {
+                        'idbox': box.idbox,
+                        'nombre': f"Box {box.idbox}",
+                        'pasillo': box.pasillobox,
+                        'estado': box.estadobox,
+                        'tipos': tipos_box,
+                        'habilitado': False,
+                        'ocupado': True,
+                        'disponible': False
+                    }
+                })
+                continue
+            
+            criterios = []
+            if inhabilitado[i]:
+                criterios.append({
+                    'criterio': 'Box inhabilitado',
+                    'puntos': -100,
+                    'detalle': f"Estado: {box.estadobox}",
+                    'tipo': 'penalizacion'
+                })
+            criterios.append({
+                'criterio': 'Carga diaria',
+                'puntos': int(puntos_carga[i]),
+                'detalle': f"{int(carga[i])} reservas este día",
+                'tipo': 'eficiencia'
+            })
+            if mismo_pasillo[i]:
+                criterios.append({
+                    'criterio': 'Mismo pasillo',
+                    'puntos': self.criterios_peso['mismo_pasillo'],
+                    'detalle': f"Pasillo {box.pasillobox}",
+                    'tipo': 'ubicacion'
+                })
+            if medicos_ids:
+                criterios.append({
+                    'criterio': 'Uso histórico',
+                    'puntos': int(puntos_historico[i]),
+                    'detalle': f"{int(historico[i])} usos previos por los médicos",
+                    'tipo': 'preferencia'
+                })
+                criterios.append({
+                    'criterio': 'Preferencia médico (30 días)',
+                    'puntos': float(puntos_preferencia[i]),
+                    'detalle': f"{int(preferencia[i])} usos recientes",
+                    'tipo': 'preferencia'
+                })
+            if coincidencias_p[i] > 0:
+                criterios.append({
+                    'criterio': 'Tipo principal coincide',
+                    'puntos': int(puntos_tipo_principal[i]),
+                    'detalle': f"{int(coincidencias_p[i])} tipo(s) principal(es) compatible(s)",
+                    'tipo': 'compatibilidad'
+                })
+            if coincidencias_s[i] > 0:
+                criterios.append({
+                    'criterio': 'Tipo secundario coincide',
+                    'puntos': int(puntos_tipo_secundario[i]),
+                    'detalle': f"{int(coincidencias_s[i])} tipo(s) secundario(s) compatible(s)",
+                    'tipo': 'compatibilidad'
+                })
+            criterios.append({
+                'criterio': 'Disponibilidad continua',
+                'puntos': float(puntos_disponibilidad[i]),
+                'detalle': f"Flexibilidad de horario: {int(continua[i])}/5",
+                'tipo': 'eficiencia'
+            })
+            
+            resultados.append({
+                'score_total': round(float(scores[i]), 1),
+                'criterios': criterios,
+                'box_info': {
+                    'idbox': box.idbox,
+                    'nombre': f"Box {box.idbox}",
+                    'pasillo': box.pasillobox,
+                    'estado': box.estadobox,
+                    'tipos': tipos_box,
+                    'habilitado': not bool(inhabilitado[i]),
+                    'ocupado': False,
+                    'disponible': True
+                }
+            })
+        
+        return resultados
+    
+    def resolver_conflicto_agendas(self, reservas_ids, modo_lote=True, progreso=None):
+        """Resuelve conflicto entre múltiples agendas con verificación robusta.
+
+        `progreso(porcentaje, etapa)` se llama al terminar cada etapa (lo usan
+        los trabajos asíncronos de Mimir para informar el avance).
+        """
+        avisar = progreso or (lambda porcentaje, etapa: None)
         try:
             reservas = Agendabox.objects.filter(
                 id__in=reservas_ids
@@ -342,17 +562,29 @@ class ResolutorConflictosAgenda:
             hora_fin = max(r.horafinagenda for r in reservas)
             
             tipos_principales, tipos_secundarios = self.obtener_tipos_requeridos(reservas)
+            avisar(10, 'tipos_requeridos')
             
             boxes_libres = self.obtener_boxes_libres(
                 fecha, hora_inicio, hora_fin, 
                 excluir_ids=reservas_ids,
                 tipos_requeridos=tipos_principales + tipos_secundarios
             )
+            avisar(30, 'boxes_libres')
+            
+            if modo_lote:
+                resultados = self.calcular_scores_lote(
+                    boxes_libres, reservas, fecha, tipos_principales, tipos_secundarios
+                )
+            else:
+                resultados = [
+                    self.calcular_score_box(box, reservas, fecha, tipos_principales, tipos_secundarios)
+                    for box in boxes_libres
+                ]
+            
+            avisar(80, 'puntajes')
             
             boxes_con_score = []
-            for box in boxes_libres:
-                resultado = self.calcular_score_box(box, reservas, fecha, tipos_principales, tipos_secundarios)
-                
+            for resultado in resultados:
                 if resultado['score_total'] > -500 and resultado['box_info'].get('disponible', False):
                     boxes_con_score.append(resultado)
             
@@ -373,13 +605,13 @@ class ResolutorConflictosAgenda:
                         'nombre': r.idmedico.nombre
                     })
                 if r.idbox:
-                    box_tipos = BoxTipoBox.objects.filter(idbox=r.idbox.idbox)
+                    box_tipos = tipos_boxes.tipos_de_box(r.idbox.idbox)
                     boxes_involucrados.append({
                         'id': r.idbox.idbox,
                         'nombre': f"Box {r.idbox.idbox}",
                         'pasillo': r.idbox.pasillobox,
                         'estado': r.idbox.estadobox,
-                        'tipos': [{'tipo': bt.idtipobox.tipo, 'principal': bt.tipoprincipal} for bt in box_tipos]
+                        'tipos': [{'tipo': tipo, 'principal': principal} for _, tipo, principal in box_tipos]
                     })
 
             def calcular_duracion_conflicto(inicio, fin, fecha):
@@ -413,8 +645,8 @@ class ResolutorConflictosAgenda:
                     'boxes_involucrados': boxes_involucrados,
                     'medicos_involucrados': medicos_data,
                     'tipos_requeridos': {
-                        'principales': [Tipobox.objects.get(idtipobox=t).tipo for t in tipos_principales],
-                        'secundarios': [Tipobox.objects.get(idtipobox=t).tipo for t in tipos_secundarios]
+                        'principales': [tipos_boxes.nombre_tipo(t) for t in tipos_principales],
+                        'secundarios': [tipos_boxes.nombre_tipo(t) for t in tipos_secundarios]
                     }
                 },
                 'recomendaciones': boxes_con_score,
@@ -440,33 +672,44 @@ class ResolutorConflictosAgenda:
             reserva = Agendabox.objects.get(id=reserva_id)
             box_destino = Box.objects.get(idbox=box_destino_id)
             
-            disponible = self.verificar_disponibilidad_box(
-                box_destino_id, 
-                reserva.fechaagenda, 
-                reserva.horainicioagenda, 
-                reserva.horafinagenda,
-                excluir_ids=[reserva_id]
-            )
+            with transaction.atomic():
+                Box.objects.select_for_update().filter(idbox=box_destino_id).first()
+                # Ruta de escritura: se decide contra la BD, no contra el índice del proceso
+                ocupado = solapamiento_en_bd(
+                    box_destino_id,
+                    reserva.fechaagenda,
+                    reserva.horainicioagenda,
+                    reserva.horafinagenda,
+                    excluir_ids=[reserva_id]
+                )
             
-            if not disponible:
-                return {'error': 'El box destino no está disponible en el horario exacto'}
+                if ocupado:
+                    return {'error': 'El box destino no está disponible en el horario exacto'}
             
-            box_original = reserva.idbox
-            reserva.idbox = box_destino
+                box_original = reserva.idbox
+                box_anterior_id = reserva.idbox_id
+                reserva.idbox = box_destino
             
-            cambio = f"\n\n--- CAMBIO DE BOX POR CONFLICTO ---\n"
-            cambio += f"Fecha cambio: {timezone.now().strftime('%Y-%m-%d %H:%M')}\n"
-            cambio += f"Usuario: {usuario}\n"
-            cambio += f"Box anterior: {box_original.idbox if box_original else 'N/A'}\n"
-            cambio += f"Box nuevo: {box_destino.idbox}\n"
-            cambio += f"Horario: {reserva.horainicioagenda} - {reserva.horafinagenda}\n"
-            cambio += f"Comentario: {comentario}\n"
-            cambio += f"--- FIN CAMBIO ---\n"
+                cambio = f"\n\n--- CAMBIO DE BOX POR CONFLICTO ---\n"
+                cambio += f"Fecha cambio: {timezone.now().strftime('%Y-%m-%d %H:%M')}\n"
+                cambio += f"Usuario: {usuario}\n"
+                cambio += f"Box anterior: {box_original.idbox if box_original else 'N/A'}\n"
+                cambio += f"Box nuevo: {box_destino.idbox}\n"
+                cambio += f"Horario: {reserva.horainicioagenda} - {reserva.horafinagenda}\n"
+                cambio += f"Comentario: {comentario}\n"
+                cambio += f"--- FIN CAMBIO ---\n"
             
-            reserva.observaciones = (reserva.observaciones or "") + cambio
-            reserva.save()
+                reserva.observaciones = (reserva.observaciones or "") + cambio
+                reserva.save()
+            indice_agendas.actualizar(reserva, box_anterior_id, reserva.fechaagenda)
             
             self._invalidar_cache_agenda(reserva.fechaagenda)
+            CacheSignals.agenda_modificada(
+                reserva,
+                box_anterior=box_anterior_id,
+                fecha_anterior=reserva.fechaagenda,
+                cambios={'idbox': box_destino.idbox}
+            )
             
             logger.info(f"Cambio aplicado: Reserva {reserva_id} -> Box {box_destino_id} por {usuario}")
             
@@ -512,11 +755,21 @@ class ResolutorConflictosAgenda:
             conflictos=Count('id', filter=Q(observaciones__icontains='conflicto') | Q(observaciones__icontains='CONFLICTO'))
         ).order_by('fechaagenda')
         
+        # Topes reales (agendas solapadas) desde el almacén columnar
+        columnas = almacen_columnar.columnas(fecha_inicio, fecha_fin)
+        dias, agendas_en_tope = np.unique(columnas['dia'][mascara_topes(columnas)], return_counts=True)
+        topes_por_dia = [
+            {'fechaagenda': date.fromordinal(int(dia)), 'agendas_en_tope': int(total)}
+            for dia, total in zip(dias, agendas_en_tope)
+        ]
+        
         return {
             'periodo': f"{fecha_inicio} a {fecha_fin}",
             'conflictos_por_dia': list(conflictos_por_dia),
             'total_dias': conflictos_por_dia.count(),
-            'total_conflictos': sum(item['conflictos'] for item in conflictos_por_dia)
+            'total_conflictos': sum(item['conflictos'] for item in conflictos_por_dia),
+            'topes_por_dia': topes_por_dia,
+            'total_agendas_en_tope': int(agendas_en_tope.sum())
         }
 
 
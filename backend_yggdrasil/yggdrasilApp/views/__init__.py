@@ -8,6 +8,7 @@ from .box_views import (
     InfoBoxView,
     BoxesRecomendadosView,
     ToggleEstadoBoxView,
+    TableroBoxesView,
     registrar_cambio_box
 )
 
@@ -47,7 +48,8 @@ from .reserva_views import (
 
 # Dashboard views
 from .dashboard_views import (
-    DashboardStatsView
+    DashboardStatsView,
+    AnalisisHuecosView
 )
 
 # Auth views
@@ -69,7 +71,8 @@ from .mimir_views import (
     AplicarSolucionView,
     SolucionesAlternativasView,
     EstadisticasConflictosView,
-    ListarEspecialidadesView
+    ListarEspecialidadesView,
+    TrabajoMimirView
 )
 
 # Simulador views
@@ -93,6 +96,7 @@ __all__ = [
     'InfoBoxView',
     'BoxesRecomendadosView',
     'ToggleEstadoBoxView',
+    'TableroBoxesView',
     'registrar_cambio_box',
     
     # Agenda views
@@ -124,6 +128,7 @@ __all__ = [
     
     # Dashboard views
     'DashboardStatsView',
+    'AnalisisHuecosView',
     
     # Auth views
     'login_view',
@@ -137,6 +142,7 @@ __all__ = [
     # Mimir views
     'ResolverTopeView',
     'AplicarSolucionView',
+    'TrabajoMimirView',
     
     # Simulador views
     'upload_file',
@@ -2,17 +2,24 @@
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from ..models import Box, Agendabox, Medico, Atenamb, LogAtenamb
+from ..models import Box, Agendabox, LogAtenamb
 from ..serializers import AgendaboxSerializer
 from rest_framework import status
 from rest_framework.exceptions import ValidationError
-from django.db.models import Q, OuterRef, Subquery
 from datetime import datetime, time, timedelta
 from django.utils.dateparse import parse_datetime
 from ..modulos.event_listener import VistaActualizableDisp
+from ..modulos.indice_agendas import indice_agendas
+from ..modulos.detector_topes import detectar_topes, agendas_con_tope, paginar
+from ..modulos.feed_cambios import ultimas_acciones, datos_con_accion, leer_pagina_cambios
+from ..modulos.cache_referencia import nombres_medicos
+from ..modulos.exportacion_agendas import FORMATOS as FORMATOS_EXPORTACION, exportar, parquet_disponible
 from rest_framework import serializers
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+import json
 import csv
+from django.conf import settings
 from .utils import parse_date_param
 
 
@@ -28,38 +35,34 @@ class AgendasConTopeView(APIView):
         except ValueError:
             raise ValidationError("Los parámetros 'desde' y 'hasta' deben estar en formato YYYY-MM-DD")
         
-        # Obtenemos todas las agendas en el rango de fechas incluyendo el ID
-        agendas = Agendabox.objects.filter(
-            fechaagenda__gte=desde,
-            fechaagenda__lte=hasta
-        ).values('id', 'idbox', 'fechaagenda', 'horainicioagenda', 'horafinagenda').order_by('idbox', 'fechaagenda', 'horainicioagenda')
-        
-        agendas_con_tope = []
-        agendas_dict = {}
-        
-        # Agrupamos por box y fecha
-        for agenda in agendas:
-            key = (agenda['idbox'], agenda['fechaagenda'])
-            if key not in agendas_dict:
-                agendas_dict[key] = []
-            agendas_dict[key].append(agenda)
-        
-        # Verificamos topes para cada grupo
-        for key, ags in agendas_dict.items():
-            if len(ags) > 1:  # Solo puede haber tope si hay más de una agenda
-                # Ordenamos las agendas por hora de inicio
-                ags_ordenadas = sorted(ags, key=lambda x: x['horainicioagenda'])
-                
-                # Verificamos conflictos entre agendas consecutivas
-                for i in range(len(ags_ordenadas) - 1):
-                    agenda_actual = ags_ordenadas[i]
-                    agenda_siguiente = ags_ordenadas[i + 1]
-                    
-                    # Si la hora fin de una agenda es mayor que la hora inicio de la siguiente
-                    if agenda_actual['horafinagenda'] > agenda_siguiente['horainicioagenda']:
-                        agendas_con_tope.extend([agenda_actual, agenda_siguiente])
-        
-        return Response(agendas_con_tope, status=status.HTTP_200_OK)
+        box_ids = request.query_params.getlist('idbox') or None
+        grupos = detectar_topes(desde, hasta, box_ids=box_ids)
+
+        # NDJSON: un grupo de topes por línea, sin armar la respuesta completa
+        if request.query_params.get('formato') == 'ndjson':
+            lineas = (json.dumps(grupo, cls=DjangoJSONEncoder) + '\n' for grupo in grupos)
+            return StreamingHttpResponse(lineas, content_type='application/x-ndjson')
+
+        pagina = request.query_params.get('pagina')
+        if pagina is None:
+            # Lista plana de agendas en tope, formato que consume el frontend
+            return Response(list(agendas_con_tope(grupos)), status=status.HTTP_200_OK)
+
+        try:
+            pagina = int(pagina)
+            tamano = int(request.query_params.get('tamano', 100))
+        except ValueError:
+            raise ValidationError("Los parámetros 'pagina' y 'tamano' deben ser enteros")
+        if pagina < 1 or not 1 <= tamano <= 1000:
+            raise ValidationError("'pagina' debe ser >= 1 y 'tamano' estar entre 1 y 1000")
+
+        resultados, hay_mas = paginar(grupos, pagina, tamano)
+        return Response({
+            'pagina': pagina,
+            'tamano': tamano,
+            'hay_mas': hay_mas,
+            'resultados': resultados,
+        }, status=status.HTTP_200_OK)
 
 
 class TodasAgendasView(APIView):
@@ -80,7 +83,22 @@ class TodasAgendasView(APIView):
         agendas = Agendabox.objects.filter(
             fechaagenda__gte=desde,
             fechaagenda__lte=hasta
-        ).order_by('fechaagenda', 'horainicioagenda')
+        )
+
+        # Exportación en streaming: páginas por clave con el médico en el mismo JOIN
+        if export in FORMATOS_EXPORTACION:
+            if export == 'parquet' and not parquet_disponible():
+                return Response(
+                    {"error": "La exportación parquet requiere pyarrow instalado en el servidor"},
+                    status=status.HTTP_501_NOT_IMPLEMENTED
+                )
+            content_type, extension = FORMATOS_EXPORTACION[export]
+            response = StreamingHttpResponse(exportar(agendas, export), content_type=content_type)
+            response['Content-Disposition'] = f'attachment; filename="todas_agendas.{extension}"'
+            return response
+
+        agendas = list(agendas.order_by('fechaagenda', 'horainicioagenda'))
+        medicos = nombres_medicos.nombres(ag.idmedico_id for ag in agendas)
 
         data = [
             {
@@ -90,19 +108,11 @@ class TodasAgendasView(APIView):
                 "hora_inicio": ag.horainicioagenda.strftime("%H:%M") if ag.horainicioagenda else None,
                 "hora_fin": ag.horafinagenda.strftime("%H:%M") if ag.horafinagenda else None,
                 "tipo": "Médica" if ag.esMedica else "No Médica",
-                "responsable": f"{ag.idmedico.nombre}" if ag.idmedico else (ag.nombre_responsable or "No asignado"),
+                "responsable": f"{medicos[ag.idmedico_id]}" if ag.idmedico_id in medicos else (ag.nombre_responsable or "No asignado"),
                 "observaciones": ag.observaciones or ""
             } for ag in agendas
         ]
 
-        if export == "csv" and data:
-            response = HttpResponse(content_type='text/csv')
-            response['Content-Disposition'] = 'attachment; filename="todas_agendas.csv"'
-            writer = csv.DictWriter(response, fieldnames=data[0].keys())
-            writer.writeheader()
-            writer.writerows(data)
-            return response
-
         return Response(data, status=status.HTTP_200_OK)
 
 
@@ -117,17 +127,16 @@ class CheckDisponibilidadView(APIView):
         if not all([idbox, fecha, hora_inicio, hora_fin]):
             return Response({"error": "Faltan parámetros"}, status=status.HTTP_400_BAD_REQUEST)
 
-        conflict = Agendabox.objects.filter(
-            Q(idbox=idbox),
-            Q(fechaagenda=fecha),
-            Q(horainicioagenda__lt=hora_fin),
-            Q(horafinagenda__gt=hora_inicio)
-        )
-        if id_agenda:
-            conflict = conflict.exclude(id=id_agenda)
+        try:
+            conflictos = indice_agendas.solapamientos(
+                idbox, fecha, hora_inicio, hora_fin,
+                excluir_ids=[id_agenda] if id_agenda else ()
+            )
+        except ValueError:
+            return Response({"error": "Formato de fecha u hora inválido"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if conflict.exists():
-            return Response({"disponible": False, "conflicto_id": conflict.first().id})
+        if conflictos:
+            return Response({"disponible": False, "conflicto_id": conflictos[0].id})
         return Response({"disponible": True})
 
 
@@ -146,7 +155,8 @@ class AgendaBox(APIView):
             hasta = parse_date_param(hasta_str, 'hasta')
             agenda_box = agenda_box.filter(fechaagenda__lte=hasta)
 
-        agenda_box = agenda_box.order_by('fechaagenda', 'horainicioagenda')
+        agenda_box = list(agenda_box.order_by('fechaagenda', 'horainicioagenda'))
+        medicos = nombres_medicos.nombres(ag.idmedico_id for ag in agenda_box)
 
         eventos = []
         for ag in agenda_box:
@@ -156,7 +166,7 @@ class AgendaBox(APIView):
 
             eventos.append({
                 "id": ag.id,
-                "medico": f"{ag.idmedico.nombre}" if ag.idmedico else "Reserva no médica",
+                "medico": f"{medicos[ag.idmedico_id]}" if ag.idmedico_id in medicos else "Reserva no médica",
                 "start": f"{fecha}T{hora_inicio}",
                 "end": f"{fecha}T{hora_fin}" if hora_fin else None,
                 "esMedica": ag.esMedica,
@@ -197,6 +207,8 @@ class AgendasPorPasilloView(APIView):
             fechaagenda__gte=desde,
             fechaagenda__lte=hasta
         ).order_by('fechaagenda', 'horainicioagenda')
+        agendas = list(agendas)
+        medicos = nombres_medicos.nombres(ag.idmedico_id for ag in agendas)
 
         data = [
             {
@@ -206,7 +218,7 @@ class AgendasPorPasilloView(APIView):
                 "hora_inicio": ag.horainicioagenda.strftime("%H:%M") if ag.horainicioagenda else None,
                 "hora_fin": ag.horafinagenda.strftime("%H:%M") if ag.horafinagenda else None,
                 "tipo": "Médica" if ag.esMedica else "No Médica",
-                "responsable": f"{ag.idmedico.nombre}" if ag.idmedico else "No asignado",
+                "responsable": f"{medicos[ag.idmedico_id]}" if ag.idmedico_id in medicos else "No asignado",
                 "observaciones": ag.observaciones or ""
             } for ag in agendas
         ]
@@ -245,13 +257,14 @@ class AgendasPorMedicoView(APIView):
             hasta = parse_date_param(hasta_str, 'hasta')
             agendas = agendas.filter(fechaagenda__lte=hasta)
 
-        agendas = agendas.order_by('fechaagenda', 'horainicioagenda')
+        agendas = list(agendas.order_by('fechaagenda', 'horainicioagenda'))
+        medicos = nombres_medicos.nombres(ag.idmedico_id for ag in agendas)
 
         data = [
             {
                 "id": ag.id,
                 "box_id": ag.idbox_id,
-                "medico": ag.idmedico.nombre if ag.idmedico else "No asignado",
+                "medico": medicos.get(ag.idmedico_id, "No asignado"),
                 "fecha": ag.fechaagenda.strftime("%Y-%m-%d"),
                 "hora_inicio": ag.horainicioagenda.strftime("%H:%M") if ag.horainicioagenda else None,
                 "hora_fin": ag.horafinagenda.strftime("%H:%M") if ag.horafinagenda else None,
@@ -272,42 +285,49 @@ class AgendasPorMedicoView(APIView):
 
 
 class DatosModificadosAPIView(APIView):
-    def get(self, request, fecha_hora_str):
-        try:
+    """Cambios de Atenamb registrados en log_atenamb.
+
+    Sin `cursor` ni `limite` responde la lista completa desde la fecha
+    (formato original). Con alguno de ellos pagina por id de log y responde
+    {'resultados', 'next_cursor', 'hay_mas'}; `next_cursor` se envía como
+    `cursor` en la siguiente llamada (en una página vacía es el mismo cursor
+    recibido, para seguir consultando desde ahí).
+    """
+    def get(self, request, fecha_hora_str=None):
+        fecha_hora_str = fecha_hora_str or request.query_params.get('desde')
+        fecha_hora = None
+        if fecha_hora_str:
             #Parsear la fecha y hora desde la URL
             fecha_hora = parse_datetime(fecha_hora_str)
             if fecha_hora is None:
-                raise ValueError("Formato inválido")
+                return Response({"error": "Formato de fecha/hora inválido. Usa YYYY-MM-DDTHH:MM:SS"}, status=status.HTTP_400_BAD_REQUEST)
+
+        cursor = request.query_params.get('cursor')
+        limite = request.query_params.get('limite')
+
+        if cursor is None and limite is None:
+            if fecha_hora is None:
+                return Response({"error": "Se requiere 'desde' o un 'cursor'"}, status=status.HTTP_400_BAD_REQUEST)
+            # Acción más reciente por atenamb en una sola consulta con ventana
+            logs = LogAtenamb.objects.using('simulador').filter(fecha_hora__gt=fecha_hora)
+            datos = datos_con_accion(ultimas_acciones(logs, por_fecha=True))
+            return Response(datos, status=status.HTTP_200_OK)
+
+        limite_max = getattr(settings, 'DATOS_MODIFICADOS_LIMITE_MAX', 5000)
+        try:
+            cursor = int(cursor or 0)
+            limite = int(limite or 500)
         except ValueError:
-            return Response({"error": "Formato de fecha/hora inválido. Usa YYYY-MM-DDTHH:MM:SS"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # Obtener todos los logs modificados desde la fecha indicada
-        logs = LogAtenamb.objects.using('simulador')\
-            .filter(fecha_hora__gt=fecha_hora)\
-            .order_by('-fecha_hora', '-id')
-
-        # Deduplicar por atenamb_id, quedándonos con el log más reciente de cada uno
-        vistos = set()
-        ids_unicos = []
-        for log in logs:
-            if log.atenamb_id not in vistos:
-                vistos.add(log.atenamb_id)
-                ids_unicos.append(log.atenamb_id)
-
-        log_subquery = LogAtenamb.objects.using('simulador')\
-            .filter(atenamb_id=OuterRef('pk'), fecha_hora__gt=fecha_hora)\
-            .order_by('-fecha_hora')\
-            .values('accion')[:1]
-
-        # Obtener los datos de Atenamb con el tipo de acción incluido, solo para ids únicos
-        datos = list(
-            Atenamb.objects.using('simulador')
-            .filter(id__in=ids_unicos)
-            .annotate(accion=Subquery(log_subquery))
-            .values()
-        )
+            return Response({"error": "'cursor' y 'limite' deben ser enteros"}, status=status.HTTP_400_BAD_REQUEST)
+        if cursor < 0 or not 1 <= limite <= limite_max:
+            return Response({"error": f"'limite' debe estar entre 1 y {limite_max}"}, status=status.HTTP_400_BAD_REQUEST)
 
-        return Response(datos, status=status.HTTP_200_OK)
+        datos, ultimo_id, cantidad = leer_pagina_cambios(cursor, limite, fecha_hora)
+        return Response({
+            'resultados': datos,
+            'next_cursor': ultimo_id if cantidad else cursor,
+            'hay_mas': cantidad == limite,
+        }, status=status.HTTP_200_OK)
 
 
 class VistaActualizableDispSerializer(serializers.Serializer):
@@ -359,13 +379,9 @@ class AgendaDetalleExtendidoView(APIView):
             agenda_extendida = AgendaExtendida.objects(agenda_id=agenda_id).first()
             
             if agenda_extendida:
-                # Obtener nombres de todos los médicos de una sola consulta
+                # Nombres de todos los médicos desde el cache de referencia
                 medicos_ids = [m.medico_id for m in agenda_extendida.medicos if m.medico_id]
-                medicos_dict = {}
-                
-                if medicos_ids:
-                    medicos_queryset = Medico.objects.filter(idmedico__in=medicos_ids).values('idmedico', 'nombre')
-                    medicos_dict = {m['idmedico']: m['nombre'] for m in medicos_queryset}
+                medicos_dict = nombres_medicos.nombres(medicos_ids)
                 
                 # Agregar información de MongoDB con nombres de médicos
                 agenda_data['datos_mongo'] = {
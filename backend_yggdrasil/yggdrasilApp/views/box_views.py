@@ -18,6 +18,9 @@ from rest_framework.permissions import AllowAny
 from .utils import get_client_ip
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from ..modulos.indice_agendas import indice_agendas
+from ..modulos.cache_referencia import snapshot_boxes
+from ..modulos.tablero_boxes import tablero_boxes
 
 
 
@@ -57,7 +60,7 @@ class BoxListView(APIView):
 
         if box_id:
             try:
-                idbox = Box.objects.get(idbox=box_id)
+                idbox = BoxSerializer.queryset_listado().get(idbox=box_id)
                 serializer = BoxSerializer(idbox)
 
                 # Última atención finalizada (puede ser hoy o días anteriores)
@@ -113,9 +116,23 @@ class BoxListView(APIView):
                 return Response({'error': 'Box no encontrado'}, status=status.HTTP_404_NOT_FOUND)
 
         else:
-            boxes = Box.objects.all()
-            serializer = BoxSerializer(boxes, many=True)
-            return Response(serializer.data, status=status.HTTP_200_OK)
+            boxes, _ = snapshot_boxes.obtener()
+            return Response(boxes, status=status.HTTP_200_OK)
+
+
+class TableroBoxesView(APIView):
+    """Última, actual y próxima atención y estado de todos los boxes (o de un pasillo).
+
+    Responde 304 si el ETag enviado en If-None-Match coincide con el tablero actual.
+    """
+
+    def get(self, request):
+        pasillo = request.query_params.get('pasillo') or None
+        payload, etag = tablero_boxes.obtener(pasillo)
+
+        if etag in [valor.strip() for valor in request.headers.get('If-None-Match', '').split(',')]:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(payload, status=status.HTTP_200_OK, headers={'ETag': etag})
 
 
 class EstadoBoxView(APIView):
@@ -137,12 +154,10 @@ class EstadoBoxView(APIView):
         if not idbox or not fecha or not hora:
             raise ValidationError("Faltan parámetros: idbox, fecha y hora son requeridos.")
 
-        estado = Agendabox.objects.filter(
-            Q(idbox=idbox),
-            Q(fechaagenda=fecha),
-            Q(horainicioagenda__lt=hora),
-            Q(horafinagenda__gt=hora)
-        ).count()
+        try:
+            estado = len(indice_agendas.ocupantes(idbox, fecha, hora))
+        except ValueError:
+            raise ValidationError("Formato de fecha u hora inválido.")
 
         if estado == 1:
             estBox = 'Ocupado'
@@ -246,6 +261,7 @@ class ToggleEstadoBoxView(APIView):
             box.estadobox = nuevo_estado
             box.comentario = razon
             box.save()
+            snapshot_boxes.invalidar(motivo='toggle_estado')
             
             registrar_cambio_box(
                 box_id=box_id,
@@ -2,12 +2,49 @@
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from ..models import Box, Agendabox, BoxTipoBox
+from ..models import Box, BoxTipoBox
+from ..modulos.almacen_columnar import almacen_columnar
+from ..modulos.analisis_huecos import analizar_huecos, huecos_por_dia
+from ..modulos.dashboard_optimizer import DashboardOptimizer
 from rest_framework import status
-from django.db.models import Q, Count, Avg, ExpressionWrapper, DurationField, F, Sum
-from django.db.models.functions import ExtractWeekDay
-from datetime import datetime, time, timedelta
+from datetime import datetime, timedelta
+from django.conf import settings
 from django.utils import timezone
+import numpy as np
+import time as reloj
+
+
+INICIO_AM, FIN_AM = 8 * 60, 13 * 60
+INICIO_PM, FIN_PM = 13 * 60, 18 * 60
+
+
+def escanear_reservas(start_date, end_date):
+    """Columnas (box, dia, es_medica, inicio, fin, n) del rango desde el almacén columnar.
+
+    Vienen ordenadas por (box, fecha, inicio, fin); `n` es la cantidad de
+    reservas que representa cada fila (siempre 1 desde el almacén).
+    """
+    c = almacen_columnar.columnas(start_date, end_date)
+    if not len(c['id']):
+        return None
+    return {
+        'box': c['box'].astype(np.int64),
+        'dia': c['dia'].astype(np.int64),
+        'es_medica': c['es_medica'].astype(np.int64),
+        'inicio': c['inicio'].astype(float),
+        'fin': c['fin'].astype(float),
+        'n': np.ones(len(c['id']), dtype=np.int64),
+    }
+
+
+def _promedio_minutos(duracion, pesos):
+    """Promedio ponderado como Avg() de SQL, None si no hay datos (o da 0)"""
+    validas = ~np.isnan(duracion)
+    total = pesos[validas].sum()
+    if not total:
+        return None
+    promedio = float((duracion[validas] * pesos[validas]).sum() / total)
+    return promedio or None
 
 
 class DashboardStatsView(APIView):
@@ -37,33 +74,71 @@ class DashboardStatsView(APIView):
             end_date = start_date + timedelta(days=6)
             days = 7
 
-        #filtrar reservas por el rango de fechas
-        reservas_query = Agendabox.objects.filter(
-            fechaagenda__gte=start_date,
-            fechaagenda__lte=end_date
-        ).order_by('idbox', 'fechaagenda', 'horainicioagenda')
+        tiempos = {}
+        t0 = reloj.perf_counter()
 
-        #métricas generales generales
         total_boxes = Box.objects.count()
-        total_reservas = reservas_query.count()
-        reservas_medicas = reservas_query.filter(esMedica=True).count()
-        reservas_no_medicas = reservas_query.filter(esMedica=False).count()
+        c = escanear_reservas(start_date, end_date)
+        tiempos['consulta'] = reloj.perf_counter() - t0
+
+        #métricas generales en una pasada sobre las columnas
+        t1 = reloj.perf_counter()
+        reservas_por_box = {}
+        if c is None:
+            total_reservas = reservas_medicas = reservas_no_medicas = 0
+            minutos_ocupados = 0
+            ocupacion_am = ocupacion_pm = 0
+            horas_muertas = 0
+            tiempo_medico = tiempo_no_medico = None
+            box_mas_utilizado = box_menos_utilizado = None
+            evolucion_semana = []
+        else:
+            n = c['n']
+            medicas = c['es_medica'] == 1
+            no_medicas = c['es_medica'] == 0
+            total_reservas = int(n.sum())
+            reservas_medicas = int(n[medicas].sum())
+            reservas_no_medicas = int(n[no_medicas].sum())
+
+            duracion = c['fin'] - c['inicio']
+            con_duracion = ~np.isnan(duracion)
+            minutos_ocupados = float((duracion[con_duracion] * n[con_duracion]).sum())
+
+            #ocupación por turnos (AM/PM); NaN nunca cumple la comparación, como NULL en SQL
+            with np.errstate(invalid='ignore'):
+                ocupacion_am = int(n[(c['inicio'] >= INICIO_AM) & (c['fin'] <= FIN_AM)].sum())
+                ocupacion_pm = int(n[(c['inicio'] >= INICIO_PM) & (c['fin'] <= FIN_PM)].sum())
+
+            #horas muertas: huecos entre agendas del mismo box dentro de cada día
+            horas_muertas = round(float(huecos_por_dia(c)[2].sum()) / 60, 2)
+
+            #tiempo promedio de atención médica vs no médica
+            tiempo_medico = _promedio_minutos(duracion[medicas], n[medicas])
+            tiempo_no_medico = _promedio_minutos(duracion[no_medicas], n[no_medicas])
+
+            #box más y menos utilizado
+            boxes, posicion = np.unique(c['box'], return_inverse=True)
+            totales_box = np.bincount(posicion, weights=n).astype(np.int64)
+            reservas_por_box = dict(zip(boxes.tolist(), totales_box.tolist()))
+            orden = np.argsort(-totales_box, kind='stable')
+            box_mas_utilizado = {'idbox': int(boxes[orden[0]]), 'total': int(totales_box[orden[0]])}
+            box_menos_utilizado = {'idbox': int(boxes[orden[-1]]), 'total': int(totales_box[orden[-1]])}
+
+            #evolución semanal con la numeración de ExtractWeekDay (1 = domingo)
+            dia_semana = (c['dia'] - 1) % 7
+            dia_semana = (dia_semana + 1) % 7 + 1
+            por_dia = np.bincount(dia_semana, weights=n, minlength=8).astype(np.int64)
+            evolucion_semana = [
+                {'dia_semana': dia, 'total': int(por_dia[dia])}
+                for dia in range(1, 8) if por_dia[dia]
+            ]
+        tiempos['metricas'] = reloj.perf_counter() - t1
 
         #calcular horas disponibles totales
         horas_por_dia = 10
         minutos_por_dia = horas_por_dia * 60
         total_minutos_disponibles = total_boxes * days * minutos_por_dia
 
-        #calcular minutos ocupados
-        minutos_ocupados = reservas_query.annotate(
-            duracion=ExpressionWrapper(
-                F('horafinagenda') - F('horainicioagenda'),
-                output_field=DurationField()
-            )
-        ).aggregate(
-            total_minutos=Sum('duracion')
-        )['total_minutos'].total_seconds() / 60 if reservas_query.exists() else 0
-
         #porcentaje de ocupación
         porcentaje_ocupacion = round(
             (minutos_ocupados / total_minutos_disponibles) * 100, 
@@ -76,68 +151,11 @@ class DashboardStatsView(APIView):
             2
         ) if total_reservas > 0 else 0
 
-        #Cálculo de horas muertas 
-        horas_muertas = 0
-        if total_reservas > 1:
-            #obtenemos todas las reservas ordenadas por box y fecha
-            reservas_ordenadas = reservas_query.values(
-                'idbox',
-                'fechaagenda',
-                'horainicioagenda',
-                'horafinagenda'
-            ).order_by('idbox', 'fechaagenda', 'horainicioagenda')
-
-            reservas_list = list(reservas_ordenadas)
-            
-            # calculamos tiempo entre reservas para cada box
-            tiempo_muerto_total = 0
-            box_actual = None
-            reserva_anterior = None
-            
-            for reserva in reservas_list:
-                if reserva['idbox'] != box_actual:
-                    box_actual = reserva['idbox']
-                    reserva_anterior = None
-                
-                if reserva_anterior:
-                    tiempo_entre_reservas = (
-                        datetime.combine(reserva['fechaagenda'], reserva['horainicioagenda']) -
-                        datetime.combine(reserva_anterior['fechaagenda'], reserva_anterior['horafinagenda'])
-                    ).total_seconds() / 60
-                    
-                    if tiempo_entre_reservas > 0:
-                        tiempo_muerto_total += tiempo_entre_reservas
-                
-                reserva_anterior = reserva
-            
-            horas_muertas = round(tiempo_muerto_total / 60, 2)
-
-        #Box más utilizado y menos utilizado
-        boxes_periodo = reservas_query.values('idbox').annotate(
-            total=Count('idbox')
-        ).order_by('-total')
-        box_mas_utilizado = boxes_periodo.first()
-        box_menos_utilizado = boxes_periodo.last()
-
-        #ocupación por turnos (AM/PM)
-        ocupacion_am = reservas_query.filter(
-            horainicioagenda__gte=time(8, 0),
-            horafinagenda__lte=time(13, 0)
-        ).count()
-        
-        ocupacion_pm = reservas_query.filter(
-            horainicioagenda__gte=time(13, 0),
-            horafinagenda__lte=time(18, 0)
-        ).count()
-
-        #estadísticas por especialidad
-        especialidades_stats = []
-        relaciones_box_tipo = BoxTipoBox.objects.select_related('idtipobox').all()
+        #estadísticas por especialidad: boxes por tipo y reservas de esos boxes
+        t2 = reloj.perf_counter()
         especialidades_dict = {}
-        
-        #primero contamos boxes por especialidad
-        for relacion in relaciones_box_tipo:
-            nombre_especialidad = relacion.idtipobox.tipo
+        relaciones_box_tipo = BoxTipoBox.objects.values_list('idbox_id', 'idtipobox__tipo', 'tipoprincipal')
+        for box_id, nombre_especialidad, es_principal in relaciones_box_tipo:
             if nombre_especialidad not in especialidades_dict:
                 especialidades_dict[nombre_especialidad] = {
                     'nombre': nombre_especialidad,
@@ -145,24 +163,18 @@ class DashboardStatsView(APIView):
                     'boxes': 0,
                     'es_principal': False
                 }
-            especialidades_dict[nombre_especialidad]['boxes'] += 1
-            
-            if relacion.tipoprincipal:
-                especialidades_dict[nombre_especialidad]['es_principal'] = True
-        
-        #lueego contamos reservas por especialidad
-        for box in Box.objects.all():
-            reservas_box = reservas_query.filter(idbox=box)
-            relaciones_box = BoxTipoBox.objects.filter(idbox=box)
-            
-            for relacion in relaciones_box:
-                nombre_especialidad = relacion.idtipobox.tipo
-                especialidades_dict[nombre_especialidad]['total_reservas'] += reservas_box.count()
-        
+            especialidad = especialidades_dict[nombre_especialidad]
+            especialidad['boxes'] += 1
+            especialidad['total_reservas'] += reservas_por_box.get(box_id, 0)
+            if es_principal:
+                especialidad['es_principal'] = True
+
         especialidades_stats = sorted(
             especialidades_dict.values(),
             key=lambda x: (-x['es_principal'], -x['total_reservas'])
         )
+        tiempos['especialidades'] = reloj.perf_counter() - t2
+        tiempos['total'] = reloj.perf_counter() - t0
 
         #yipo de reservas (médicas vs no médicas)
         tipo_reservas = [
@@ -170,28 +182,6 @@ class DashboardStatsView(APIView):
             {"name": "No Médicas", "value": reservas_no_medicas},
         ]
 
-        #tiempo promedio de atención médica vs no médica
-        tiempo_medico = reservas_query.filter(esMedica=True).annotate(
-            duracion=ExpressionWrapper(
-                F('horafinagenda') - F('horainicioagenda'),
-                output_field=DurationField()
-            )
-        ).aggregate(promedio=Avg('duracion'))['promedio']
-        
-        tiempo_no_medico = reservas_query.filter(esMedica=False).annotate(
-            duracion=ExpressionWrapper(
-                F('horafinagenda') - F('horainicioagenda'),
-                output_field=DurationField()
-            )
-        ).aggregate(promedio=Avg('duracion'))['promedio']
-
-        #evolución semanal de ocupación
-        evolucion_semana = reservas_query.annotate(
-            dia_semana=ExtractWeekDay('fechaagenda')
-        ).values('dia_semana').annotate(
-            total=Count('id')
-        ).order_by('dia_semana')
-
         response_data = {
             "total_boxes": total_boxes,
             "total_reservas": total_reservas,
@@ -206,9 +196,47 @@ class DashboardStatsView(APIView):
             "ocupacion_pm": ocupacion_pm,
             "especialidades_stats": especialidades_stats,
             "tipo_reservas": tipo_reservas,
-            "tiempo_medico": tiempo_medico.total_seconds() / 60 if tiempo_medico else None,
-            "tiempo_no_medico": tiempo_no_medico.total_seconds() / 60 if tiempo_no_medico else None,
-            "evolucion_semana": list(evolucion_semana),
+            "tiempo_medico": tiempo_medico,
+            "tiempo_no_medico": tiempo_no_medico,
+            "evolucion_semana": evolucion_semana,
+            "tiempos_ms": {etapa: round(segundos * 1000, 2) for etapa, segundos in tiempos.items()},
         }
 
         return Response(response_data, status=status.HTTP_200_OK)
+
+
+class AnalisisHuecosView(APIView):
+    """Distribución de horas muertas (total, media y p90 de los huecos) por box y por pasillo.
+
+    Acepta `range` (day/week/month/year) como DashboardStatsView, o un rango
+    explícito con `fecha_inicio` y `fecha_fin` (YYYY-MM-DD), y `pasillo` opcional.
+    """
+
+    def get(self, request):
+        fecha_inicio = request.query_params.get('fecha_inicio')
+        fecha_fin = request.query_params.get('fecha_fin', fecha_inicio)
+        try:
+            if fecha_inicio:
+                start_date = datetime.strptime(fecha_inicio, '%Y-%m-%d').date()
+                end_date = datetime.strptime(fecha_fin, '%Y-%m-%d').date()
+            else:
+                start_date, end_date, _ = DashboardOptimizer._calcular_rango_fechas(
+                    request.query_params.get('range', 'week'), timezone.now().date()
+                )
+        except ValueError:
+            return Response(
+                {"error": "Formato de fecha inválido. Use YYYY-MM-DD"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        max_dias = getattr(settings, 'ANALISIS_HUECOS_MAX_DIAS', 366)
+        if end_date < start_date or (end_date - start_date).days + 1 > max_dias:
+            return Response(
+                {"error": f"El rango debe ir de fecha_inicio a fecha_fin y cubrir como mucho {max_dias} días"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        inicio = reloj.perf_counter()
+        resultado = analizar_huecos(start_date, end_date, request.query_params.get('pasillo') or None)
+        resultado['tiempo_ms'] = round((reloj.perf_counter() - inicio) * 1000, 2)
+        return Response(resultado, status=status.HTTP_200_OK)
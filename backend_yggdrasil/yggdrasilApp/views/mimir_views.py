@@ -7,6 +7,15 @@ from django.utils import timezone
 from datetime import datetime
 from ..utils.resolutor_agendas import ResolutorConflictosAgenda
 from ..models import Tipobox, Agendabox
+from ..modulos.trabajos_mimir import (
+    EN_COLA, EN_PROCESO, cola_mimir, resolver_tope, soluciones_alternativas
+)
+
+def _respuesta_trabajo(trabajo):
+    """202 mientras el trabajo corre; 200 si ya terminó (p. ej. resultado guardado)"""
+    en_curso = trabajo['estado'] in (EN_COLA, EN_PROCESO)
+    return Response(trabajo, status=status.HTTP_202_ACCEPTED if en_curso else status.HTTP_200_OK)
+
 
 class ResolverTopeView(APIView):
     def post(self, request):
@@ -17,52 +26,26 @@ class ResolverTopeView(APIView):
                     {"error": "Se requieren al menos 2 reservas en conflicto"},
                     status=status.HTTP_400_BAD_REQUEST
                 )
-            
-            resolutor = ResolutorConflictosAgenda()
-            resultado = resolutor.resolver_conflicto_agendas(reservas_ids)
-            
-            if 'error' in resultado:
+            try:
+                parametros = {'reservas': sorted({int(reserva_id) for reserva_id in reservas_ids})}
+            except (TypeError, ValueError):
                 return Response(
-                    {"error": resultado['error']},
+                    {"error": "Los ids de reservas deben ser enteros"},
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            # Obtener información básica de cada reserva (adaptado al modelo real)
-            reservas_detalladas = []
-            for reserva_id in reservas_ids:
-                try:
-                    reserva = Agendabox.objects.get(id=reserva_id)
-                    reservas_detalladas.append({
-                        'id': reserva.id,
-                        'fecha': reserva.fechaagenda.strftime('%Y-%m-%d') if reserva.fechaagenda else None,
-                        'hora_inicio': str(reserva.horainicioagenda) if reserva.horainicioagenda else None,
-                        'hora_fin': str(reserva.horafinagenda) if reserva.horafinagenda else None,
-                        'medico': reserva.idmedico.nombre if reserva.idmedico else 'N/A',
-                        'medico_id': reserva.idmedico.idmedico if reserva.idmedico else None,
-                        'box_actual': reserva.idbox.idbox if reserva.idbox else 'N/A',
-                        'box_actual_id': reserva.idbox.idbox if reserva.idbox else None,
-                        'pasillo_actual': reserva.idbox.pasillobox if reserva.idbox else 'N/A',
-                        # Campos que no existen en el modelo real - los omitimos o manejamos diferente
-                        'paciente': 'N/A',  # No existe idpaciente en el modelo
-                        'paciente_id': None,
-                        'estado': 'N/A',    # No existe estadoagenda
-                        'observaciones': reserva.observaciones if reserva.observaciones else ''
-                    })
-                except Agendabox.DoesNotExist:
-                    reservas_detalladas.append({
-                        'id': reserva_id,
-                        'error': 'Reserva no encontrada'
-                    })
-                except Exception as e:
-                    reservas_detalladas.append({
-                        'id': reserva_id,
-                        'error': str(e)
-                    })
-            
-            # Agregar la información detallada al resultado
-            resultado['reservas_detalladas'] = reservas_detalladas
+            # Modo síncrono para clientes que esperan el resultado en la misma respuesta
+            if request.data.get("sincrono"):
+                resultado = resolver_tope(parametros)
+                if 'error' in resultado:
+                    return Response(
+                        {"error": resultado['error']},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                return Response(resultado)
             
-            return Response(resultado)
+            # El avance y el resultado llegan por ws/mimir/ o por /api/mimir/trabajos/<id>/
+            return _respuesta_trabajo(cola_mimir.encolar('resolver_tope', parametros))
             
         except Exception as e:
             traceback.print_exc()
@@ -135,74 +118,28 @@ class SolucionesAlternativasView(APIView):
                     {"error": "fecha, hora_inicio y hora_fin son requeridos"},
                     status=status.HTTP_400_BAD_REQUEST
                 )
-            
-            # Convertir especialidades (nombres) a IDs de Tipobox
-            tipos_requeridos = []
-            if especialidades:
-                tipos_requeridos = list(
-                    Tipobox.objects.filter(tipo__in=especialidades)
-                    .values_list('idtipobox', flat=True)
+            try:
+                datetime.strptime(fecha, '%Y-%m-%d')
+                datetime.strptime(hora_inicio, '%H:%M:%S')
+                datetime.strptime(hora_fin, '%H:%M:%S')
+            except (TypeError, ValueError):
+                return Response(
+                    {"error": "Formato inválido: fecha YYYY-MM-DD, horas HH:MM:SS"},
+                    status=status.HTTP_400_BAD_REQUEST
                 )
             
-            resolutor = ResolutorConflictosAgenda()
-            
-            # Convertir strings a objetos datetime si es necesario
-            if isinstance(fecha, str):
-                fecha = datetime.strptime(fecha, '%Y-%m-%d').date()
-            if isinstance(hora_inicio, str):
-                hora_inicio = datetime.strptime(hora_inicio, '%H:%M:%S').time()
-            if isinstance(hora_fin, str):
-                hora_fin = datetime.strptime(hora_fin, '%H:%M:%S').time()
-            
-            # Obtener boxes libres con filtrado por especialidades
-            boxes_libres = resolutor.obtener_boxes_libres(
-                fecha, hora_inicio, hora_fin, 
-                tipos_requeridos=tipos_requeridos
-            )
+            parametros = {
+                'fecha': fecha,
+                'hora_inicio': hora_inicio,
+                'hora_fin': hora_fin,
+                'duracion': duracion,
+                'especialidades': sorted(especialidades),
+            }
             
-            # Preparar respuesta con información detallada
-            soluciones = []
-            for box in boxes_libres:
-                # Obtener tipos del box con indicador de principal
-                box_tipos = BoxTipoBox.objects.filter(idbox=box.idbox)
-                
-                tipos_box = []
-                for bt in box_tipos:
-                    tipos_box.append({
-                        'id': bt.idtipobox.idtipobox,
-                        'nombre': bt.idtipobox.tipo,
-                        'principal': bt.tipoprincipal
-                    })
-                
-                # Calcular compatibilidad real
-                tipos_box_ids = {bt.idtipobox.idtipobox for bt in box_tipos}
-                compatibilidad = len(set(tipos_requeridos) & tipos_box_ids) if tipos_requeridos else len(tipos_box_ids)
-                
-                soluciones.append({
-                    'idbox': box.idbox,
-                    'nombre': f"Box {box.idbox}",
-                    'pasillo': box.pasillobox,
-                    'estado': box.estadobox,
-                    'tipos': tipos_box,
-                    'compatibilidad_especialidades': compatibilidad,
-                    'porcentaje_compatibilidad': f"{(compatibilidad / len(tipos_requeridos) * 100):.1f}%" if tipos_requeridos else '100%'
-                })
+            if request.data.get("sincrono"):
+                return Response(soluciones_alternativas(parametros))
             
-            # Ordenar por compatibilidad
-            soluciones.sort(key=lambda x: x['compatibilidad_especialidades'], reverse=True)
-            
-            return Response({
-                "soluciones_alternativas": soluciones,
-                "total_alternativas": len(soluciones),
-                "parametros_busqueda": {
-                    "fecha": str(fecha),
-                    "hora_inicio": str(hora_inicio),
-                    "hora_fin": str(hora_fin),
-                    "duracion_minutos": duracion,
-                    "especialidades_solicitadas": especialidades,
-                    "tipos_ids_requeridos": tipos_requeridos
-                }
-            })
+            return _respuesta_trabajo(cola_mimir.encolar('soluciones_alternativas', parametros))
             
         except Exception as e:
             traceback.print_exc()
@@ -211,6 +148,19 @@ class SolucionesAlternativasView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+
+class TrabajoMimirView(APIView):
+    """Estado, avance y resultado de un trabajo de Mimir"""
+    
+    def get(self, request, trabajo_id):
+        trabajo = cola_mimir.obtener(trabajo_id)
+        if trabajo is None:
+            return Response(
+                {"error": f"Trabajo {trabajo_id} no encontrado o vencido"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(trabajo)
+
 class ListarEspecialidadesView(APIView):
     """Vista para listar todas las especialidades disponibles"""
     def get(self, request):
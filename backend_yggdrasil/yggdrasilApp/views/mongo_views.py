@@ -8,11 +8,14 @@ from rest_framework.permissions import AllowAny
 from datetime import datetime
 from ..mongo_models import InventarioBox, AgendaExtendida, Implemento, MedicoEnAgenda
 from ..models import Box, Agendabox
+from ..modulos.persistencia_mongo import agregar_implemento, actualizar_implemento
 import json
 from bson import ObjectId
+from mongoengine.errors import ValidationError
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags
 from django.views import View
 
 
@@ -112,11 +115,6 @@ class InventarioBoxView(View):
                     'error': f'Box {box_id} no existe'
                 }, status=404)
             
-            # Obtener o crear inventario
-            inventario = InventarioBox.objects(box_id=box_id).first()
-            if not inventario:
-                inventario = InventarioBox(box_id=box_id)
-            
             # Datos del implemento
             data = request.data
             nombre = data.get('nombre')
@@ -126,8 +124,7 @@ class InventarioBoxView(View):
                     'error': 'El nombre del implemento es requerido'
                 }, status=400)
             
-            # Agregar implemento
-            implemento = inventario.agregar_implemento(
+            implemento = Implemento(
                 nombre=nombre,
                 descripcion=data.get('descripcion'),
                 marca=data.get('marca'),
@@ -144,8 +141,8 @@ class InventarioBoxView(View):
             if data.get('fecha_proximo_mantenimiento'):
                 implemento.fecha_proximo_mantenimiento = datetime.fromisoformat(data['fecha_proximo_mantenimiento'].replace('Z', '+00:00'))
             
-            inventario.updated_by = 'sistema'
-            inventario.save()
+            # $push sobre el inventario (se crea si no existe)
+            agregar_implemento(box_id, implemento, usuario='sistema')
             
             return JsonResponse({
                 'success': True,
@@ -170,13 +167,6 @@ class InventarioBoxView(View):
             import json
             data = json.loads(request.body)
             
-            inventario = InventarioBox.objects(box_id=box_id).first()
-            if not inventario:
-                return JsonResponse({
-                    'success': False,
-                    'error': f'No hay inventario para el box {box_id}'
-                }, status=404)
-            
             nombre_implemento = data.get('nombre')
             nuevo_estado = data.get('operacional')
             observaciones = data.get('observaciones')
@@ -187,30 +177,42 @@ class InventarioBoxView(View):
                     'error': 'Se requiere nombre del implemento y nuevo estado operacional'
                 }, status=400)
             
-            # Buscar el implemento
-            implemento_encontrado = next((impl for impl in inventario.implementos if impl.nombre == nombre_implemento), None)
-            
-            if not implemento_encontrado:
+            if not isinstance(nuevo_estado, bool):
                 return JsonResponse({
                     'success': False,
-                    'error': f'Implemento "{nombre_implemento}" no encontrado'
-                }, status=404)
+                    'error': "'operacional' debe ser true o false"
+                }, status=400)
             
-            # Actualizar estado y observaciones
-            implemento_encontrado.operacional = nuevo_estado
+            # Actualizar estado y observaciones con un $set puntual
+            cambios = {'operacional': nuevo_estado}
             if observaciones is not None:
-                implemento_encontrado.observaciones = observaciones
+                cambios['observaciones'] = observaciones
+            try:
+                implemento = actualizar_implemento(box_id, nombre_implemento, cambios, usuario='sistema')
+            except ValidationError as e:
+                return JsonResponse({
+                    'success': False,
+                    'error': str(e)
+                }, status=400)
             
-            inventario.updated_by = 'sistema'
-            inventario.save()
+            if implemento is None:
+                if not InventarioBox.objects(box_id=box_id).count():
+                    return JsonResponse({
+                        'success': False,
+                        'error': f'No hay inventario para el box {box_id}'
+                    }, status=404)
+                return JsonResponse({
+                    'success': False,
+                    'error': f'Implemento "{nombre_implemento}" no encontrado'
+                }, status=404)
             
             return JsonResponse({
                 'success': True,
                 'message': f'Estado del implemento "{nombre_implemento}" actualizado',
                 'implemento': {
-                    'nombre': implemento_encontrado.nombre,
-                    'operacional': implemento_encontrado.operacional,
-                    'observaciones': implemento_encontrado.observaciones
+                    'nombre': implemento['nombre'],
+                    'operacional': implemento['operacional'],
+                    'observaciones': implemento.get('observaciones')
                 }
             })
             
@@ -431,25 +433,66 @@ class DashboardOptimizadoView(APIView):
     permission_classes = [AllowAny]
     
     def get(self, request):
-        """Obtener métricas del dashboard desde cache optimizado"""
+        """Obtener métricas del dashboard desde cache optimizado.
+        
+        La respuesta habitual son los bytes ya serializados (y comprimidos si
+        el cliente lo acepta) con su ETag; si coincide con If-None-Match se
+        responde 304 sin cuerpo. `fecha_referencia` (YYYY-MM-DD) elige la
+        ventana que la contiene; por defecto la actual.
+        """
+        fecha_referencia = request.GET.get('fecha_referencia')
+        if fecha_referencia:
+            try:
+                fecha_referencia = datetime.strptime(fecha_referencia, '%Y-%m-%d').date()
+            except ValueError:
+                return Response({
+                    'success': False,
+                    'error': 'Formato de fecha_referencia inválido. Use YYYY-MM-DD'
+                }, status=status.HTTP_400_BAD_REQUEST)
+        
         try:
             from ..modulos.dashboard_optimizer import DashboardCacheService
+            from ..modulos import serializacion_dashboard
             
             periodo = request.GET.get('range', 'week')
             forzar_refresh = request.GET.get('refresh', 'false').lower() == 'true'
             
             # Obtener datos desde cache optimizado
-            dashboard_data = DashboardCacheService.obtener_dashboard_optimizado(
+            entrada = DashboardCacheService.obtener_dashboard_serializado(
                 periodo=periodo, 
-                forzar_refresh=forzar_refresh
+                forzar_refresh=forzar_refresh,
+                fecha_referencia=fecha_referencia or None
             )
             
-            return Response({
-                'success': True,
-                'data': dashboard_data,
-                'optimizado': True,
-                'mensaje': 'Datos obtenidos desde cache optimizado' if not forzar_refresh else 'Cache regenerado'
-            })
+            if forzar_refresh or entrada.get('obsoleto'):
+                dashboard_data = serializacion_dashboard.datos(entrada)
+                respuesta = Response(serializacion_dashboard.envolver(
+                    dashboard_data,
+                    'Cache regenerado' if forzar_refresh else serializacion_dashboard.MENSAJE
+                ))
+                if entrada.get('obsoleto'):
+                    # Datos anteriores al último cambio; la regeneración ya está programada
+                    dashboard_data['cache_info']['obsoleto'] = True
+                    respuesta['X-Dashboard-Stale'] = 'true'
+                    respuesta['Warning'] = '110 - "Response is Stale"'
+                return respuesta
+            
+            cuerpo, codificacion = serializacion_dashboard.elegir_codificacion(
+                entrada, request.META.get('HTTP_ACCEPT_ENCODING')
+            )
+            etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+            if serializacion_dashboard.etag_coincide(entrada['etag'], etags):
+                respuesta = HttpResponseNotModified()
+            else:
+                respuesta = HttpResponse(cuerpo, content_type='application/json')
+                if codificacion:
+                    respuesta['Content-Encoding'] = codificacion
+            # ETag distinto por codificación: los bytes de cada una son distintos
+            respuesta['ETag'] = serializacion_dashboard.etag_codificado(entrada['etag'], codificacion)
+            respuesta['Vary'] = 'Accept-Encoding'
+            # El navegador puede guardarla, pero revalida siempre con el ETag
+            respuesta['Cache-Control'] = 'no-cache'
+            return respuesta
             
         except Exception as e:
             return Response({
@@ -467,7 +510,11 @@ class CacheStatusView(APIView):
     def get(self, request):
         """Obtener estado actual del cache"""
         try:
-            from ..modulos.cache_manager import CacheManager
+            from ..modulos.cache_manager import CacheManager, planificador_regeneracion
+            from ..modulos.cache_referencia import estadisticas as estadisticas_referencia
+            from ..modulos.cache_distribuido import cache_distribuido
+            from ..modulos.dashboard_optimizer import DashboardCacheService
+            from ..modulos.calentamiento_dashboard import calentador_dashboard
             from ..mongo_models import DashboardCache
             
             # Obtener estado de todos los períodos
@@ -511,6 +558,11 @@ class CacheStatusView(APIView):
                         'caches_total_periodos': len(periodos),
                         'porcentaje_cobertura': round((caches_validos / len(periodos)) * 100, 2)
                     },
+                    'planificador_regeneracion': planificador_regeneracion.estadisticas(),
+                    'cache_referencia': estadisticas_referencia(),
+                    'cache_distribuido': cache_distribuido.estadisticas(),
+                    'servicio_dashboard': DashboardCacheService.estadisticas(),
+                    'calentamiento': calentador_dashboard.estadisticas(),
                     'timestamp': datetime.now().isoformat()
                 }
             })
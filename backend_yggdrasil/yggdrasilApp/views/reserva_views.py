@@ -6,10 +6,11 @@ from ..models import Box, Agendabox
 from ..serializers import AgendaboxSerializer
 from rest_framework import status
 from datetime import datetime, time, timedelta
-from django.utils import timezone
+from django.db import transaction
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from ..models import Medico  
+from ..modulos.indice_agendas import indice_agendas, solapamiento_en_bd
 
 
 def notificar_cambio_box_agenda(box_id, tipo_evento="agenda_modificada"):
@@ -114,28 +115,25 @@ class CrearReservaNoMedicaView(APIView):
         if not box_id or not nombre:
             return Response({'error': 'Faltan campos requeridos'}, status=400)
 
-        conflicto = Agendabox.objects.filter(
-            idbox=box_id,
-            fechaagenda=fecha,
-            horainicioagenda__lt=hora_fin,
-            horafinagenda__gt=hora_inicio
-        ).exists()
-
-        if conflicto:
-            return Response({'error': 'Ya existe una agenda en ese bloque'}, status=400)
-
         try:
-            nueva_agenda = Agendabox.objects.create(
-                fechaagenda=fecha,
-                horainicioagenda=hora_inicio,
-                horafinagenda=hora_fin,
-                idbox_id=box_id,
-                habilitada=0,
-                esMedica=0,
-                idmedico=None,
-                nombre_responsable=nombre,
-                observaciones=observaciones  
-            )
+            with transaction.atomic():
+                # Bloquea el box: dos reservas simultáneas sobre él se serializan
+                Box.objects.select_for_update().filter(idbox=box_id).first()
+                if solapamiento_en_bd(box_id, fecha, hora_inicio, hora_fin):
+                    return Response({'error': 'Ya existe una agenda en ese bloque'}, status=400)
+
+                nueva_agenda = Agendabox.objects.create(
+                    fechaagenda=fecha,
+                    horainicioagenda=hora_inicio,
+                    horafinagenda=hora_fin,
+                    idbox_id=box_id,
+                    habilitada=0,
+                    esMedica=0,
+                    idmedico=None,
+                    nombre_responsable=nombre,
+                    observaciones=observaciones
+                )
+            indice_agendas.registrar(nueva_agenda)
 
             # ⭐ NUEVO: Invalidar cache automáticamente
             from ..modulos.cache_manager import CacheSignals
@@ -180,28 +178,25 @@ class CrearReservaMedicaView(APIView):
         if not box_id or not nombre:
             return Response({'error': 'Faltan campos requeridos'}, status=400)
 
-        conflicto = Agendabox.objects.filter(
-            idbox=box_id,
-            fechaagenda=fecha,
-            horainicioagenda__lt=hora_fin,
-            horafinagenda__gt=hora_inicio
-        ).exists()
-
-        if conflicto:
-            return Response({'error': 'Ya existe una agenda en ese bloque'}, status=400)
-
         try:
-            nueva_agenda = Agendabox.objects.create(
-                fechaagenda=fecha,
-                horainicioagenda=hora_inicio,
-                horafinagenda=hora_fin,
-                idbox_id=box_id,
-                habilitada=0,
-                esMedica=1,  #acá se diferencia de la no médica
-                idmedico_id=id_medico,
-                nombre_responsable=nombre,
-                observaciones=observaciones
-            )
+            with transaction.atomic():
+                # Bloquea el box: dos reservas simultáneas sobre él se serializan
+                Box.objects.select_for_update().filter(idbox=box_id).first()
+                if solapamiento_en_bd(box_id, fecha, hora_inicio, hora_fin):
+                    return Response({'error': 'Ya existe una agenda en ese bloque'}, status=400)
+
+                nueva_agenda = Agendabox.objects.create(
+                    fechaagenda=fecha,
+                    horainicioagenda=hora_inicio,
+                    horafinagenda=hora_fin,
+                    idbox_id=box_id,
+                    habilitada=0,
+                    esMedica=1,  #acá se diferencia de la no médica
+                    idmedico_id=id_medico,
+                    nombre_responsable=nombre,
+                    observaciones=observaciones
+                )
+            indice_agendas.registrar(nueva_agenda)
 
             # ⭐ NUEVO: Invalidar cache automáticamente
             from ..modulos.cache_manager import CacheSignals
@@ -297,7 +292,13 @@ class LiberarReservaView(APIView):
         try:
             reserva = Agendabox.objects.get(id=reserva_id)
             box_id = reserva.idbox_id
+            fecha = reserva.fechaagenda
             reserva.delete()
+            indice_agendas.quitar(reserva_id, box_id, fecha)
+
+            # Actualizar agregados y cache del dashboard
+            from ..modulos.cache_manager import CacheSignals
+            CacheSignals.agenda_eliminada(reserva_id, box_id, fecha=fecha)
             
             # ⭐ AGREGAR TRY-CATCH para la notificación
             try:
@@ -319,6 +320,8 @@ class UpdateReservaView(APIView):
         except Agendabox.DoesNotExist:
             return Response({'error': 'Reserva no encontrada'}, status=status.HTTP_404_NOT_FOUND)
 
+        box_anterior = reserva.idbox_id
+        fecha_anterior = reserva.fechaagenda
         data = request.data.copy()
 
         # Manejar idmedico: convertir a integer o None
@@ -338,6 +341,16 @@ class UpdateReservaView(APIView):
 
         if serializer.is_valid():
             reserva_actualizada = serializer.save()
+            indice_agendas.actualizar(reserva_actualizada, box_anterior, fecha_anterior)
+
+            # Actualizar agregados y cache del dashboard
+            from ..modulos.cache_manager import CacheSignals
+            CacheSignals.agenda_modificada(
+                reserva_actualizada,
+                box_anterior=box_anterior,
+                fecha_anterior=fecha_anterior,
+                cambios=list(request.data.keys())
+            )
 
             # Notificación WebSocket
             try:
@@ -361,38 +374,16 @@ class BloquesLibresView(APIView):
             return Response({'error': 'Se requiere parámetro fecha'}, status=400)
         
         try:
-            agendas = Agendabox.objects.filter(
-                idbox=box_id,
-                fechaagenda=fecha
-            ).order_by('horainicioagenda')
-            
-            bloques_libres = []
-            hora_actual = timezone.datetime.strptime(f"{fecha} 08:00", "%Y-%m-%d %H:%M")
-            hora_fin_dia = timezone.datetime.strptime(f"{fecha} 18:00", "%Y-%m-%d %H:%M")
-            
-            for agenda in agendas:
-                hora_inicio_agenda = timezone.datetime.strptime(f"{fecha} {agenda.horainicioagenda}", "%Y-%m-%d %H:%M:%S")
-                hora_fin_agenda = timezone.datetime.strptime(f"{fecha} {agenda.horafinagenda}", "%Y-%m-%d %H:%M:%S")
-                
-                if hora_actual < hora_inicio_agenda:
-                    diferencia = (hora_inicio_agenda - hora_actual).total_seconds() / 60
-                    if diferencia >= duracion_min:
-                        bloques_libres.append({
-                            'hora_inicio': hora_actual.strftime('%H:%M'),
-                            'hora_fin': hora_inicio_agenda.strftime('%H:%M'),
-                            'duracion_minutos': int(diferencia)
-                        })
-                
-                hora_actual = max(hora_actual, hora_fin_agenda)
-            
-            if hora_actual < hora_fin_dia:
-                diferencia = (hora_fin_dia - hora_actual).total_seconds() / 60
-                if diferencia >= duracion_min:
-                    bloques_libres.append({
-                        'hora_inicio': hora_actual.strftime('%H:%M'),
-                        'hora_fin': hora_fin_dia.strftime('%H:%M'),
-                        'duracion_minutos': int(diferencia)
-                    })
+            bloques_libres = [
+                {
+                    'hora_inicio': inicio.strftime('%H:%M'),
+                    'hora_fin': fin.strftime('%H:%M'),
+                    'duracion_minutos': minutos
+                }
+                for inicio, fin, minutos in indice_agendas.bloques_libres(
+                    box_id, fecha, duracion_min=duracion_min
+                )
+            ]
             
             return Response({'bloques_libres': bloques_libres})
             
@@ -8,7 +8,9 @@ from rest_framework import status
 from ..models import Agendabox
 from ..serializers import AgendaboxSerializer
 from ..modulos.agenda_adapter import SimuladorAdapter
-from ..modulos.simulador_agenda import SimuladorAgenda
+from ..modulos.simulador_agenda import SimuladorAgendaLote
+from ..modulos.indice_agendas import indice_agendas
+from ..modulos.cache_manager import CacheSignals
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 
@@ -51,7 +53,7 @@ def upload_file(request):
             return JsonResponse({'error': 'Formato de archivo no soportado'}, status=400)
 
         sAdapter = SimuladorAdapter()
-        simulador = SimuladorAgenda()
+        simulador = SimuladorAgendaLote()
 
         datos = sAdapter.adaptar_datos(df)
         aprobados, desaprobados = simulador.simular(datos)
@@ -65,6 +67,7 @@ def upload_file(request):
             'mensaje': 'Archivo recibido correctamente',
             'aprobados': serializer_aprobados.data,
             'desaprobados': serializer_desaprobados.data,
+            'errores': sAdapter.errores,
         })
 
     except Exception as e:
@@ -81,6 +84,12 @@ def confirmar_guardado_agendas(request):
         
         # Guardar las agendas
         Agendabox.objects.bulk_create(agendas)
+        indice_agendas.invalidar_agendas(agendas)
+        CacheSignals.bulk_agendas_creadas(
+            cantidad_agendas=len(agendas),
+            agendas=agendas,
+            fuente='simulador'
+        )
         
         # ⭐ NUEVO: Recopilar boxes afectados y notificar cambios
         boxes_afectados = set()
@@ -14,6 +14,16 @@ CHANNEL_LAYERS = {
         },
     }
 }
+# Cache de Django compartido por todos los workers (el mismo Redis de channels, otra base)
+REDIS_URL = "redis://localhost:6379/1"
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REDIS_URL,
+        "KEY_PREFIX": "yggdrasil",
+        "TIMEOUT": 300,
+    }
+}
 # WebSocket configuration for Cloudflare Tunnel
 USE_TLS = True  # Para usar WSS en lugar de WS
 
@@ -94,6 +104,13 @@ CORS_ALLOW_HEADERS = [
     'connection',
 ]
 
+# Cabeceras de respuesta legibles desde el frontend
+CORS_EXPOSE_HEADERS = [
+    'x-dashboard-stale',
+    'warning',
+    'etag',
+]
+
 # WebSocket specific settings
 CORS_ALLOW_WEBSOCKETS = True
 
@@ -236,4 +253,65 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',  
     ],
-}
\ No newline at end of file
+}
+# Segundos que un día cargado en el índice de agendas en memoria se considera vigente
+INDICE_AGENDAS_TTL = 60
+# Máximo de días que conserva cada proceso en el índice de agendas en memoria
+INDICE_AGENDAS_MAX_DIAS = 62
+# Horas tras las que un día de agregados del dashboard se vuelve a materializar desde MySQL
+AGREGADOS_VIGENCIA_HORAS = 24
+# Planificador de regeneración del cache del dashboard (segundos / hilos)
+CACHE_REGENERACION_DEBOUNCE = 2.0
+CACHE_REGENERACION_MAX_ESPERA = 10.0
+CACHE_REGENERACION_WORKERS = 2
+# Flujo de actualización de agendas: 'feed' (log_atenamb por id) o 'polling' (API por timestamp)
+FLUJO_ACTUALIZACION_MODO = 'feed'
+FEED_CAMBIOS_LOTE = 500
+FEED_CAMBIOS_ESPERA_MIN = 0.5
+FEED_CAMBIOS_ESPERA_MAX = 10.0
+# Tamaño máximo de página de /api/modificados/ (paginación por id de log)
+DATOS_MODIFICADOS_LIMITE_MAX = 5000
+# Segundos de vigencia de los datos de referencia en memoria (lista de boxes y tipos)
+CACHE_REFERENCIA_TTL = 300
+# Cantidad máxima de nombres de médicos en el LRU de referencia
+CACHE_REFERENCIA_MEDICOS_MAX = 5000
+# Días hacia atrás y hacia adelante en que el tablero de boxes busca la última y
+# la próxima agenda antes de consultar sin límite de fecha
+TABLERO_VENTANA_DIAS = 31
+# Filas por página (y por trozo enviado) en las exportaciones en streaming de agendas
+EXPORTACION_AGENDAS_PAGINA = 5000
+# Trabajos asíncronos de Mimir: hilos del pool, segundos que se conservan los
+# trabajos terminados y segundos de vigencia de los resultados por firma
+MIMIR_TRABAJOS_WORKERS = 2
+MIMIR_TRABAJOS_RETENCION = 900
+MIMIR_RESULTADOS_TTL = 600
+# Almacén columnar de agendas (particiones mensuales .npy) y segundos de vigencia de cada partición
+ALMACEN_COLUMNAR_DIR = BASE_DIR / 'almacen_columnar'
+ALMACEN_COLUMNAR_VIGENCIA_ABIERTO = 300
+ALMACEN_COLUMNAR_VIGENCIA_CERRADO = 86400
+# Días como máximo que cubre una consulta de /api/dashboard-huecos/
+ANALISIS_HUECOS_MAX_DIAS = 366
+# Cache de dos niveles del dashboard: Redis compartido y LRU en proceso (entradas / segundos)
+CACHE_DISTRIBUIDO_URL = REDIS_URL
+CACHE_DISTRIBUIDO_L1_MAX = 256
+CACHE_DISTRIBUIDO_L1_TTL = 30
+# Segundos sin consultar Redis tras un error de conexión (se sirve desde el nivel 1 / MongoDB)
+CACHE_DISTRIBUIDO_PAUSA_REDIS = 10
+# Responder el último dashboard bueno mientras se regenera en segundo plano, y
+# segundos que se conserva esa última versión
+DASHBOARD_SERVIR_OBSOLETO = True
+DASHBOARD_OBSOLETO_MAX_SEGUNDOS = 86400
+# Vencimiento del lock en Redis que evita calcular el mismo dashboard en varios procesos a la vez
+DASHBOARD_CALCULO_LOCK_SEGUNDOS = 120
+# Compresión de la respuesta serializada del dashboard (brotli sólo si está instalado)
+DASHBOARD_GZIP_NIVEL = 6
+DASHBOARD_BROTLI = True
+# Precalentamiento del dashboard: segundos entre ciclos, segundos de anticipación
+# (ventanas que empiezan o caches que vencen dentro de ese plazo) y ventanas
+# consultadas recientemente que se mantienen calientes (cantidad / horas).
+# Sólo corre en los procesos servidores y, entre ellos, en el líder
+CALENTAMIENTO_ACTIVO = True
+CALENTAMIENTO_INTERVALO = 60
+CALENTAMIENTO_ANTICIPACION = 900
+CALENTAMIENTO_RECIENTES_MAX = 32
+CALENTAMIENTO_RECIENTES_HORAS = 24
@@ -23,7 +23,7 @@ from django.urls import path
 from yggdrasilApp.views import (
     # Box views
     BoxListView, EstadoBoxView, InfoBoxView, BoxesRecomendadosView, 
-    BoxesInhabilitadosView, ToggleEstadoBoxView,
+    BoxesInhabilitadosView, ToggleEstadoBoxView, TableroBoxesView,
     
     # Agenda views
     AgendaBox, DatosModificadosAPIView, VistaActualizableDispView,
@@ -39,7 +39,7 @@ from yggdrasilApp.views import (
     LiberarReservaView, UpdateReservaView, BloquesLibresView,
     
     # Dashboard views
-    DashboardStatsView,
+    DashboardStatsView, AnalisisHuecosView,
     
     # Auth views
     login_view, logout_view, user_info,
@@ -48,7 +48,7 @@ from yggdrasilApp.views import (
     HistorialModificacionesBoxView, RegistrarModificacionBoxView,
     
     # Mimir views
-    ResolverTopeView, AplicarSolucionView, SolucionesAlternativasView,EstadisticasConflictosView,ListarEspecialidadesView,
+    ResolverTopeView, AplicarSolucionView, SolucionesAlternativasView,EstadisticasConflictosView,ListarEspecialidadesView, TrabajoMimirView,
     
     # Simulador views
     upload_file, confirmar_guardado_agendas
@@ -68,6 +68,7 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/boxes/', BoxListView.as_view(), name='box-list'),
     path('api/boxes/<int:id>/', BoxListView.as_view(), name='box-detail'),
+    path('api/boxes/tablero/', TableroBoxesView.as_view(), name='boxes-tablero'),
     path('api/estado_box/', EstadoBoxView.as_view(), name='estado_box'),
     path('api/info_box/', InfoBoxView.as_view(), name='info_box'),
     path('api/box/<int:id>/', AgendaBox.as_view(), name='agenda_box'),
@@ -75,6 +76,7 @@ urlpatterns = [
     path('api/medico/', AgendasPorMedicoView.as_view(), name='agendas-por-medico'),
     path('api/medico/sugerencias/', SugerenciasMedicoView.as_view(), name='sugerencias-medico'),
     path('api/modificados-desde/<str:fecha_hora_str>/', DatosModificadosAPIView.as_view(), name='datos_modificados'),
+    path('api/modificados/', DatosModificadosAPIView.as_view(), name='datos_modificados_cursor'),
     path('api/verificar_actualizacion/', VistaActualizableDispView.as_view(), name='vista_flag'),
     path('api/agendas-no-medicas/<int:id>/', AgendasNoMedicasView.as_view()),
     path('api/bloques-no-medicos/<int:id>/', BloquesNoMedicosDisponiblesView.as_view()),
@@ -88,10 +90,12 @@ urlpatterns = [
     path('api/reservas/<int:reserva_id>/liberar/', LiberarReservaView.as_view(), name='liberar-reserva'),
     path('api/reservas/<int:reserva_id>/modificar/', UpdateReservaView.as_view(), name='modificar-reserva'),
     path('api/dashboard-stats/', DashboardStatsView.as_view(), name='dashboard-stats'),
+    path('api/dashboard-huecos/', AnalisisHuecosView.as_view(), name='dashboard-huecos'),
     path('api/check_disponibilidad/', CheckDisponibilidadView.as_view(), name='check-disponibilidad'),
     path('api/resolver-tope/', ResolverTopeView.as_view(), name='resolver-tope'),
     path('api/aplicar-solucion/', AplicarSolucionView.as_view(), name='aplicar-solucion'),
     path('api/soluciones-alternativas/', SolucionesAlternativasView.as_view(), name='soluciones-alternativas'),
+    path('api/mimir/trabajos/<str:trabajo_id>/', TrabajoMimirView.as_view(), name='mimir-trabajo'),
     path('especialidades/', ListarEspecialidadesView.as_view(), name='listar-especialidades'),
     path('estadisticas-conflictos/', EstadisticasConflictosView.as_view(), name='estadisticas-conflictos'),
     path('api/boxes-inhabilitados/', BoxesInhabilitadosView.as_view(), name='boxes-inhabilitados'), 
@@ -1,5 +1,5 @@
 // components/MimirResolver.jsx
-import React, { useState, useEffect, useCallback } from "react";
+import React, { useState, useEffect, useCallback, useRef } from "react";
 import { motion, AnimatePresence } from "framer-motion";
 import {
   Sparkles,
@@ -13,7 +13,7 @@ import {
   ChevronRight,
   Calendar,
 } from "lucide-react";
-import { buildApiUrl } from "../config/api";
+import { buildApiUrl, buildWsUrl } from "../config/api";
 
 /**
  * MimirResolver - Componente mejorado con soporte para dark mode
@@ -32,6 +32,11 @@ const parseJsonSafe = async (response) => {
   return null;
 };
 
+const ESTADOS_FINALES = ["completado", "error"];
+const INTERVALO_CONSULTA_MS = 3000;
+// Dos minutos de consultas como máximo por trabajo
+const MAX_CONSULTAS = 40;
+
 const MimirResolver = ({ conflictos = [], onResolver = () => {} }) => {
   const [mostrarModal, setMostrarModal] = useState(false);
   const [conflictoSeleccionado, setConflictoSeleccionado] = useState(null);
@@ -41,8 +46,86 @@ const MimirResolver = ({ conflictos = [], onResolver = () => {} }) => {
   const [globalLoading, setGlobalLoading] = useState(false);
   const [currentIndex, setCurrentIndex] = useState(0);
   const [applyingAll, setApplyingAll] = useState(false);
+  const [progresoMap, setProgresoMap] = useState({});
+  // trabajo_id -> { resolver, socket, intervalo } de los trabajos de Mimir en curso
+  const esperasRef = useRef(new Map());
   const total = conflictos.length;
 
+  const terminarEspera = (trabajo) => {
+    const espera = esperasRef.current.get(trabajo.id);
+    if (!espera) return;
+    esperasRef.current.delete(trabajo.id);
+    clearInterval(espera.intervalo);
+    espera.socket.close();
+    espera.resolver(trabajo);
+  };
+
+  // Al desmontar se cortan las consultas y los sockets de los trabajos pendientes
+  useEffect(() => {
+    const esperas = esperasRef.current;
+    return () => {
+      esperas.forEach((espera) => {
+        clearInterval(espera.intervalo);
+        espera.socket.close();
+      });
+      esperas.clear();
+    };
+  }, []);
+
+  // Espera el fin de un trabajo: por el WebSocket de su grupo o, si el mensaje
+  // no llega, consultando su estado (como mucho MAX_CONSULTAS veces)
+  const esperarTrabajo = (trabajo, conflictoId) => {
+    if (ESTADOS_FINALES.includes(trabajo.estado)) return Promise.resolve(trabajo);
+
+    return new Promise((resolve) => {
+      const socket = new window.WebSocket(buildWsUrl(`/ws/mimir/${trabajo.id}/`));
+      socket.onmessage = (event) => {
+        try {
+          const data = JSON.parse(event.data);
+          if (!data.trabajo) return;
+          if (data.type === "mimir_progreso") {
+            setProgresoMap((prev) => ({
+              ...prev,
+              [conflictoId]: { progreso: data.trabajo.progreso, etapa: data.trabajo.etapa },
+            }));
+          } else if (data.type === "mimir_resultado") {
+            terminarEspera(data.trabajo);
+          }
+        } catch (e) {
+          console.error("Error procesando mensaje WebSocket de Mimir:", e);
+        }
+      };
+      socket.onerror = (err) => {
+        console.error("WebSocket de Mimir error:", err);
+      };
+
+      let consultas = 0;
+      const intervalo = setInterval(async () => {
+        consultas += 1;
+        if (consultas > MAX_CONSULTAS) {
+          terminarEspera({ ...trabajo, estado: "error", error: "Tiempo de espera agotado" });
+          return;
+        }
+        try {
+          const response = await fetch(
+            buildApiUrl(`/api/mimir/trabajos/${trabajo.id}/`),
+            { credentials: "include" }
+          );
+          const estado = await parseJsonSafe(response);
+          if (!response.ok) {
+            terminarEspera({ ...trabajo, estado: "error", error: estado?.error });
+          } else if (estado && ESTADOS_FINALES.includes(estado.estado)) {
+            terminarEspera(estado);
+          }
+        } catch (err) {
+          console.error("Error consultando trabajo de Mimir:", err);
+        }
+      }, INTERVALO_CONSULTA_MS);
+
+      esperasRef.current.set(trabajo.id, { resolver: resolve, socket, intervalo });
+    });
+  };
+
   useEffect(() => {
     if (!mostrarModal) {
       setConflictoSeleccionado(null);
@@ -76,14 +159,21 @@ const MimirResolver = ({ conflictos = [], onResolver = () => {} }) => {
           }),
         });
 
-        if (!response.ok && response.status !== 204) {
+        if (!response.ok) {
           const txt = await parseJsonSafe(response);
           console.error("API resolver-tope error", response.status, txt);
           setLoadingFor(id, false);
           return null;
         }
 
-        const data = await parseJsonSafe(response);
+        // La API responde con un trabajo; el resultado llega al terminar
+        const trabajo = await esperarTrabajo(await parseJsonSafe(response), id);
+        if (trabajo.estado !== "completado") {
+          console.error("Trabajo de Mimir con error", trabajo.error);
+          return null;
+        }
+
+        const data = trabajo.resultado;
         setRecomendacionesMap((prev) => ({ ...prev, [id]: data }));
         setConflictoSeleccionado(conflicto);
         setRecomendaciones(data);
@@ -93,6 +183,7 @@ const MimirResolver = ({ conflictos = [], onResolver = () => {} }) => {
         return null;
       } finally {
         setLoadingFor(id, false);
+        setProgresoMap((prev) => ({ ...prev, [id]: null }));
       }
     },
     [recomendacionesMap]
@@ -290,6 +381,17 @@ const MimirResolver = ({ conflictos = [], onResolver = () => {} }) => {
         <div className="py-8 text-center text-gray-500 dark:text-gray-400">
           <Clock className="animate-spin mx-auto mb-3 text-amber-500" />
           Analizando conflicto...
+          {progresoMap[conflicto.id] && (
+            <div className="mt-3 mx-auto w-48">
+              <div className="h-1.5 rounded-full bg-gray-200 dark:bg-gray-700 overflow-hidden">
+                <div
+                  className="h-full bg-gradient-to-r from-amber-400 to-orange-500 transition-all"
+                  style={{ width: `${progresoMap[conflicto.id].progreso}%` }}
+                />
+              </div>
+              <div className="mt-1 text-xs">{progresoMap[conflicto.id].progreso}%</div>
+            </div>
+          )}
         </div>
       );
     }